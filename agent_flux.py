@@ -1,12 +1,42 @@
+import asyncio
+import hashlib
+import json
+
 import replicate
 import requests
 
+import tracing
+
+# Polling starts shortly before a prediction is expected to finish then backs off
+POLL_MIN_SECONDS = 0.5
+POLL_MAX_SECONDS = 5.0
+POLL_BACKOFF = 1.5
+# When a webhook is registered polling is only a fallback in case a delivery gets lost
+WEBHOOK_FALLBACK_SECONDS = 15.0
+FINISHED_STATUSES = ("succeeded", "failed", "canceled")
+
+
+class SharedPrediction:
+    """ An in-flight prediction and the number of callers waiting for it """
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
 
 class FluxAgent:
-    def __init__(self):
+    def __init__(self, webhook_url=None):
         self.name = "FluxBot"
+        # One client (and connection pool) for the lifetime of the agent
+        self.client = replicate.Client()
+        # Public url replicate should notify when a prediction completes, see handle_webhook
+        self.webhook_url = webhook_url
+        self._in_flight = {}
+        self._webhook_events = {}
+        # Moving average of how long each model's predictions take, used to time the first poll
+        self._expected_seconds = {}
 
-    def generate_image(self, model, prompt, steps, controlnet, image_url):
+    def build_input(self, prompt, steps, controlnet, image_url, num_outputs=None):
         input = {
             "width": 1024,
             "height": 1024,
@@ -16,6 +46,8 @@ class FluxAgent:
             "output_quality": 100,
             "num_inference_steps": steps
         }
+        if num_outputs:
+            input["num_outputs"] = num_outputs
         if controlnet:
             input["control_image"] = image_url
             input["control_type"] = "canny"
@@ -26,8 +58,118 @@ class FluxAgent:
             input["image_to_image_strength"] = 0
             input["return_preprocessed_image"] = False
 
-        output = replicate.run(
+        return input
+
+    @tracing.traced("flux.generate")
+    def generate_image(self, model, prompt, steps, controlnet, image_url, num_outputs=None):
+        output = self.client.run(
+            model,
+            input=self.build_input(prompt, steps, controlnet, image_url, num_outputs)
+        )
+        return output
+
+    @tracing.traced("flux.generate")
+    async def async_generate_image(self, model, prompt, steps, controlnet, image_url, num_outputs=None):
+        output = await self.async_predict(
             model,
-            input=input
+            input=self.build_input(prompt, steps, controlnet, image_url, num_outputs)
         )
         return output
+
+    @staticmethod
+    def prediction_key(model, input):
+        encoded = json.dumps({"model": model, "input": input}, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    async def async_predict(self, model, input):
+        """ Runs a prediction without tying up a worker and returns its output.
+        Identical requests that are already in flight share the one prediction. Cancelling the caller
+        cancels the remote prediction too, once nobody else is waiting for it """
+        key = self.prediction_key(model, input)
+        shared = self._in_flight.get(key)
+        if shared is None:
+            shared = SharedPrediction(asyncio.create_task(self._run_prediction(model, input)))
+            self._in_flight[key] = shared
+            shared.task.add_done_callback(lambda task: self._forget(key, shared))
+        shared.waiters += 1
+        try:
+            return await asyncio.shield(shared.task)
+        except asyncio.CancelledError:
+            if shared.waiters == 1 and not shared.task.done():
+                # Forget it first, an identical request arriving while the remote prediction is being cancelled
+                # must start a new one rather than join the dying task
+                self._forget(key, shared)
+                shared.task.cancel()
+            raise
+        finally:
+            shared.waiters -= 1
+
+    def _forget(self, key, shared):
+        # A newer prediction may already be in flight under the same key
+        if self._in_flight.get(key) is shared:
+            del self._in_flight[key]
+
+    async def _create_prediction(self, model, input):
+        params = {}
+        if self.webhook_url:
+            params["webhook"] = self.webhook_url
+            params["webhook_events_filter"] = ["completed"]
+        if ":" in model:
+            # owner/name:version
+            return await self.client.predictions.async_create(version=model.split(":", 1)[1], input=input,
+                                                              **params)
+        # Official models are addressed by name
+        return await self.client.models.predictions.async_create(model=model, input=input, **params)
+
+    async def _run_prediction(self, model, input):
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        with tracing.span("replicate.prediction", model=model) as span:
+            prediction = await self._create_prediction(model, input)
+            span.set(created_seconds=span.elapsed())
+            try:
+                await self._wait_for(prediction, model)
+            except asyncio.CancelledError:
+                # Stop paying for work nobody is waiting for
+                await prediction.async_cancel()
+                raise
+            if prediction.status != "succeeded":
+                raise Exception(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+            metrics = prediction.metrics or {}
+            if metrics.get("predict_time"):
+                span.set(predict_seconds=metrics["predict_time"])
+        elapsed = loop.time() - start_time
+        expected = self._expected_seconds.get(model, elapsed)
+        self._expected_seconds[model] = 0.7 * expected + 0.3 * elapsed
+        return prediction.output
+
+    async def _wait_for(self, prediction, model):
+        """ Waits for a webhook or polls with adaptive backoff until the prediction finishes """
+        event = None
+        if self.webhook_url:
+            event = asyncio.Event()
+            self._webhook_events[prediction.id] = event
+        delay = max(POLL_MIN_SECONDS, 0.8 * self._expected_seconds.get(model, 0))
+        try:
+            while prediction.status not in FINISHED_STATUSES:
+                if event is not None:
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout=WEBHOOK_FALLBACK_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    event.clear()
+                else:
+                    await asyncio.sleep(delay)
+                    delay = min(max(delay * POLL_BACKOFF, POLL_MIN_SECONDS), POLL_MAX_SECONDS)
+                await prediction.async_reload()
+        finally:
+            self._webhook_events.pop(prediction.id, None)
+
+    def handle_webhook(self, payload):
+        """ Called with the body replicate posts to webhook_url. The payload is only used to find the waiter,
+        which then reloads the prediction from the API rather than trusting what was posted """
+        event = self._webhook_events.get(payload.get("id"))
+        if event is None:
+            return False
+        event.set()
+        return True
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+
+import httpx
+
+from agent_flux import FluxAgent
+from agent_prompt import LLM_TIMEOUT_SECONDS, PromptAgent, make_backend
+from agent_review import ReviewAgent
+from agent_sdxl import SDXLAgent
+from image_store import ImageStore
+from progress_poller import ProgressPoller
+from prompt_ranking import PromptScorer
+from render_scheduler import RenderScheduler
+from response_cache import ResponseCache
+from session_store import SessionStore
+from source_image_cache import SourceImageCache
+from tokenizer import Tokenizer
+
+# Maximum number of calls allowed in flight at once for each backend
+DEFAULT_LIMITS = {
+    "llm": 8,
+    "replicate": 8,
+    "vision": 4,
+    "a1111": 2,
+}
+
+
+class AgentPool:
+    """ Process-wide registry of agents.
+    Agents are built once on first use and shared by every page visit, so all sessions reuse the same
+    clients and keep-alive connection pools. Calls are throttled per backend with a bounded semaphore.
+    Nothing session specific may be stored on the agents, see session.Session for that.
+    """
+
+    def __init__(self, local=True, limits=None, cache_path="cache/responses.sqlite3", webhook_url=None,
+                 a1111_urls=None, review_max_resolution=None, llm_backends=None, llm_timeout=LLM_TIMEOUT_SECONDS,
+                 sessions_path="cache/sessions.sqlite3"):
+        self.local = local
+        self.webhook_url = webhook_url
+        self.cache_path = cache_path
+        self.sessions_path = sessions_path
+        self.a1111_urls = a1111_urls
+        # Downscale images to this size and send them inline for review, by url when None
+        self.review_max_resolution = review_max_resolution
+        # Names of the LLM backends prompt requests are hedged across (see agent_prompt.make_backend), in order
+        # of preference. Defaults to the one chosen by local
+        self.llm_backends = llm_backends
+        self.llm_timeout = llm_timeout
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        if a1111_urls and "a1111" not in (limits or {}):
+            # Keep every Automatic 1111 server as busy as a single one would be
+            self.limits["a1111"] = DEFAULT_LIMITS["a1111"] * len(a1111_urls)
+        self._semaphores = {name: threading.BoundedSemaphore(size) for name, size in self.limits.items()}
+        self._async_semaphores = {name: asyncio.Semaphore(size) for name, size in self.limits.items()}
+        # Re-entrant because some factories ask the pool for other agents
+        self._lock = threading.RLock()
+        self._agents = {}
+        self.http_client = None
+        self.async_http_client = None
+
+    def _get(self, name, factory):
+        """ Build the agent the first time it is asked for, only once even if several threads ask together """
+        agent = self._agents.get(name)
+        if agent is None:
+            with self._lock:
+                agent = self._agents.get(name)
+                if agent is None:
+                    agent = factory()
+                    self._agents[name] = agent
+        return agent
+
+    def _get_http_client(self):
+        """ One keep-alive httpx pool shared by the OpenAI compatible clients """
+        if self.http_client is None:
+            self.http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=self.limits["llm"] * 2,
+                                    max_keepalive_connections=self.limits["llm"]),
+                timeout=httpx.Timeout(120.0, connect=5.0))
+        return self.http_client
+
+    def _get_async_http_client(self):
+        """ The same for the asyncio clients, used from the event loop only """
+        if self.async_http_client is None:
+            self.async_http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.limits["llm"] * 2,
+                                    max_keepalive_connections=self.limits["llm"]),
+                timeout=httpx.Timeout(120.0, connect=5.0))
+        return self.async_http_client
+
+    @property
+    def flux(self):
+        return self._get("flux", lambda: FluxAgent(webhook_url=self.webhook_url))
+
+    @property
+    def prompt(self):
+        return self._get("prompt", lambda: PromptAgent(local=self.local, http_client=self._get_http_client(),
+                                                       async_http_client=self._get_async_http_client(),
+                                                       cache=self.response_cache,
+                                                       backends=self._make_llm_backends(),
+                                                       scorer=PromptScorer(self.tokenizer),
+                                                       timeout=self.llm_timeout))
+
+    def _make_llm_backends(self):
+        if not self.llm_backends:
+            return None
+        return [make_backend(name, self._get_http_client(), self._get_async_http_client(), timeout=self.llm_timeout)
+                for name in self.llm_backends]
+
+    @property
+    def response_cache(self):
+        """ LLM response cache, None when cache_path is None """
+        if self.cache_path is None:
+            return None
+        return self._get("response_cache", lambda: ResponseCache(self.cache_path))
+
+    @property
+    def sessions(self):
+        """ Saved session state, shared with the other worker processes """
+        return self._get("sessions", lambda: SessionStore(self.sessions_path))
+
+    @property
+    def review(self):
+        return self._get("review", lambda: ReviewAgent(cache=self.response_cache, image_store=self.image_store,
+                                                       inline_max_resolution=self.review_max_resolution))
+
+    @property
+    def sdxl(self):
+        return self._get("sdxl", lambda: SDXLAgent(image_store=self.image_store, api_urls=self.a1111_urls,
+                                                   source_cache=self.source_images))
+
+    @property
+    def source_images(self):
+        """ Downloaded img2img and ControlNet input images, shared by every render """
+        return self._get("source_images", SourceImageCache)
+
+    @property
+    def render_scheduler(self):
+        """ Fair queue in front of the SDXL agent, one worker per Automatic 1111 server """
+        return self._get("render_scheduler", lambda: RenderScheduler(workers=len(self.sdxl.backends)))
+
+    @property
+    def progress_poller(self):
+        """ Shared loop that keeps every waiting session's progress display up to date """
+        return self._get("progress_poller", lambda: ProgressPoller(self.sdxl, self.render_scheduler))
+
+    @property
+    def image_store(self):
+        return self._get("image_store", ImageStore)
+
+    @property
+    def tokenizer(self):
+        return self._get("tokenizer", Tokenizer)
+
+    def run(self, backend, func, *args, **kwargs):
+        """ Call func while holding one of the backend's slots, blocks while the backend is at its limit.
+        For blocking callers on worker threads, the app itself uses the async agent methods with limit() """
+        with self._semaphores[backend]:
+            return func(*args, **kwargs)
+
+    def limit(self, backend):
+        """ Async context manager holding one of the backend's slots, for calls made on the event loop """
+        return self._async_semaphores[backend]
+
+    def close(self):
+        if self.http_client is not None:
+            self.http_client.close()
+            self.http_client = None
+        if "response_cache" in self._agents:
+            self._agents.pop("response_cache").close()
+        if "sessions" in self._agents:
+            self._agents.pop("sessions").close()
+
+    async def aclose(self):
+        if "progress_poller" in self._agents:
+            await self._agents["progress_poller"].stop()
+        if "render_scheduler" in self._agents:
+            await self._agents["render_scheduler"].stop()
+        if self.async_http_client is not None:
+            await self.async_http_client.aclose()
+            self.async_http_client = None
+        if "sdxl" in self._agents:
+            await self._agents["sdxl"].aclose()
+        if "image_store" in self._agents:
+            await self._agents["image_store"].aclose()
+        self.close()
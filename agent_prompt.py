@@ -1,20 +1,157 @@
+import asyncio
+import contextlib
+import hashlib
 import os
-from openai import OpenAI
-from together import Together
+import threading
+import time
+from collections import OrderedDict
+
+from openai import AsyncOpenAI, OpenAI
+from together import AsyncTogether, Together
+
+import tracing
+
+# LM Studio's OpenAI compatible server, LM_STUDIO_URL points elsewhere (e.g. at fake_backends.py)
+LOCAL_BASE_URL = os.environ.get("LM_STUDIO_URL", "http://localhost:1234/v1")
+LOCAL_MODEL = "lmstudio-community/Llama-3.2-3B-Instruct-GGUF"
+TOGETHER_MODEL = "meta-llama/Llama-3.2-3B-Instruct-Turbo"
+TOGETHER_SAMPLING_PARAMS = {
+    "max_tokens": 512,
+    "temperature": 0.7,
+    "top_p": 0.7,
+    "top_k": 50,
+    "repetition_penalty": 1,
+    "stop": ["<|eot_id|>", "<|eom_id|>"],
+    "truncate": 130560,
+}
+# How long a request waits for an answer before it is also sent to the next backend
+HEDGE_DELAY_SECONDS = 1.0
+# Longest wait for a whole answer (or the first words of a streamed one) before the backend counts as failed
+LLM_TIMEOUT_SECONDS = 60
+# Consecutive failures that open a backend's circuit, and how long it then stays out of use
+FAILURE_THRESHOLD = 2
+CIRCUIT_RESET_SECONDS = 30
+# A backend whose recent answers took longer than this is tried after the others
+SLOW_SECONDS = 10
+
+
+class CircuitOpenError(RuntimeError):
+    """ A backend's circuit didn't let a request through, the backend was not asked """
+
+
+class LLMBackend:
+    """ An OpenAI compatible chat endpoint and the model to ask there, with a circuit breaker.
+    After FAILURE_THRESHOLD failures in a row the backend is skipped for CIRCUIT_RESET_SECONDS, then lets a single
+    trial request through (see attempt); a success closes the circuit, a failure opens it again.
+    Answer times are tracked too """
+
+    def __init__(self, name, client, async_client, model, sampling_params=None, timeout=LLM_TIMEOUT_SECONDS):
+        self.name = name
+        self.client = client
+        self.async_client = async_client
+        self.model = model
+        self.sampling_params = sampling_params or {}
+        self.timeout = timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        # Set while the trial request of a half open circuit is out
+        self.trial_in_flight = False
+        self._trial_lock = threading.Lock()
+        # Moving average of answer time in seconds, None until the first answer
+        self.latency = None
+
+    @property
+    def healthy(self):
+        """ Closed, or half open with its trial request still to be sent """
+        if self.opened_at is None:
+            return True
+        return time.time() - self.opened_at >= CIRCUIT_RESET_SECONDS and not self.trial_in_flight
+
+    @contextlib.contextmanager
+    def attempt(self):
+        """ Wraps sending one request. Raises CircuitOpenError instead while the circuit is open, or half open
+        with its trial request already out, so concurrent requests don't all pile onto a backend that may be down """
+        with self._trial_lock:
+            trial = self.opened_at is not None
+            if trial:
+                if not self.healthy:
+                    raise CircuitOpenError(f"{self.name} failed recently, its circuit is open")
+                self.trial_in_flight = True
+        try:
+            yield
+        finally:
+            if trial:
+                self.trial_in_flight = False
+
+    def record_latency(self, seconds):
+        self.latency = seconds if self.latency is None else 0.7 * self.latency + 0.3 * seconds
+
+    def record_success(self, seconds):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.record_latency(seconds)
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        # A failed trial request opens the circuit again straight away
+        if self.consecutive_failures >= FAILURE_THRESHOLD or self.opened_at is not None:
+            self.opened_at = time.time()
+
+
+class SharedSpeculation:
+    """ A CLIP prompt being generated ahead of time and the number of callers still wanting it """
+
+    def __init__(self, prompt, key, task):
+        self.prompt = prompt
+        self.key = key
+        self.task = task
+        self.waiters = 0
+
+
+def make_backend(name, http_client=None, async_http_client=None, model=None, timeout=LLM_TIMEOUT_SECONDS):
+    """ "local" is LM Studio on this machine, "together" is Together AI (needs TOGETHER_AI_KEY).
+    The clients don't retry by themselves, failing over to another backend is quicker """
+    if name == "local":
+        return LLMBackend(name, OpenAI(base_url=LOCAL_BASE_URL, api_key="lm-studio",
+                                       http_client=http_client, timeout=timeout, max_retries=0),
+                          AsyncOpenAI(base_url=LOCAL_BASE_URL, api_key="lm-studio",
+                                      http_client=async_http_client, timeout=timeout, max_retries=0),
+                          model or LOCAL_MODEL, timeout=timeout)
+    if name == "together":
+        return LLMBackend(name, Together(api_key=os.environ.get('TOGETHER_AI_KEY'), timeout=timeout, max_retries=0),
+                          AsyncTogether(api_key=os.environ.get('TOGETHER_AI_KEY'), timeout=timeout, max_retries=0),
+                          model or TOGETHER_MODEL, TOGETHER_SAMPLING_PARAMS, timeout=timeout)
+    raise ValueError(f"Unknown LLM backend {name}")
 
 
 class PromptAgent:
     """A class to ask an LLM to provide Stable Diffusion prompts based on guidance from the user
-    Llama 3.2 is a little unreliable at randomness, so we use a genders and ethnicities list to create some variation"""
+    Llama 3.2 is a little unreliable at randomness, so we use a genders and ethnicities list to create some variation
+    Given several backends (endpoints and/or models) async requests are hedged: the first backend is asked, and
+    each next one too whenever hedge_delay passes without an answer or a backend fails; the first usable answer
+    wins and the rest are cancelled. async_generate_prompt_candidates asks several at once and ranks the answers."""
 
-    def __init__(self, local):
+    def __init__(self, local, http_client=None, async_http_client=None, cache=None, backends=None,
+                 hedge_delay=HEDGE_DELAY_SECONDS, scorer=None, timeout=LLM_TIMEOUT_SECONDS, slow_seconds=SLOW_SECONDS):
         self.local = local
-        if self.local:
-            self.client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
-            self.model = "lmstudio-community/Llama-3.2-3B-Instruct-GGUF"
-        else:
-            self.client = Together(api_key=os.environ.get('TOGETHER_AI_KEY'))
-            self.model = "meta-llama/Llama-3.2-3B-Instruct-Turbo"
+        if backends is None:
+            backends = [make_backend("local" if local else "together", http_client, async_http_client,
+                                     timeout=timeout)]
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.slow_seconds = slow_seconds
+        # Callable scoring a generated prompt (higher is better), e.g. prompt_ranking.PromptScorer
+        self.scorer = scorer
+        # The first backend, blocking calls start with it
+        self.client = backends[0].client
+        self.async_client = backends[0].async_client
+        self.model = backends[0].model
+        self.sampling_params = backends[0].sampling_params
+        # Optional response_cache.ResponseCache, identical requests are then answered from disk
+        self.cache = cache
+        # prompt hash -> SharedSpeculation generating its CLIP version ahead of time, see speculate_clip_prompt
+        self.clip_speculations = OrderedDict()
+        self.max_clip_speculations = 128
 
         self.messages = []
 
@@ -45,52 +182,334 @@ class PromptAgent:
                                    'Grey car park, dog under car, wet fur, barking, rain, smeared wheels, '
                                    'slick pavement')
         self.shrink_system_prompt = 'Reduce the number of words in the provided prompt while retaining the meaning'
-        self.prompts = []
+
+    def ordered_backends(self):
+        """ Healthy backends in order of preference, those answering slower than slow_seconds moved behind the rest.
+        Raises straight away when every backend's circuit is open rather than waiting on a dead one """
+        healthy = [backend for backend in self.backends if backend.healthy]
+        if not healthy:
+            raise RuntimeError("No LLM backend is available, {} failed recently".format(
+                ", ".join(backend.name for backend in self.backends)))
+        return sorted(healthy, key=lambda backend: backend.latency is not None and backend.latency > self.slow_seconds)
 
     def generate_message(self, messages):
-        """ Attempt to get a response from the AI API"""
+        """ Attempt to get a response from the AI API, failing over to the next backend when one fails """
         try:
-            if not self.local:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=512,
-                    temperature=0.7,
-                    top_p=0.7,
-                    top_k=50,
-                    repetition_penalty=1,
-                    stop=["<|eot_id|>", "<|eom_id|>"],
-                    truncate=130560,
-                    stream=False
-                )
-            else:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages
-                )
-            return response
+            error = None
+            for backend in self.ordered_backends():
+                start = time.monotonic()
+                try:
+                    with backend.attempt(), tracing.span("llm.request", backend=backend.name) as span:
+                        response = backend.client.chat.completions.create(
+                            model=backend.model,
+                            messages=messages,
+                            stream=False,
+                            **backend.sampling_params
+                        )
+                        span.set(**self._usage(response))
+                except CircuitOpenError as e:
+                    # Another request is trying it, that says nothing new about the backend
+                    error = e
+                    continue
+                except Exception as e:
+                    backend.record_failure()
+                    error = e
+                    continue
+                backend.record_success(time.monotonic() - start)
+                return response
+            raise error
         except Exception as e:
             return {"error": str(e)}
 
-    def generate_prompt(self, art_type, media, prompt):
+    def cache_key(self, messages):
+        # The messages alone: any backend may win a hedged race or take over from a failed one, so an answer can't
+        # be filed under a model, and a cached answer serves whichever backends are configured
+        return self.cache.make_key(messages=messages)
+
+    @staticmethod
+    def _usage(response):
+        """ Span attributes describing an LLM response """
+        usage = getattr(response, "usage", None)
+        return {"tokens": usage.total_tokens} if getattr(usage, "total_tokens", None) else {}
+
+    def complete(self, messages, bypass_cache=False):
+        """ Returns the content of the AI response, answered from the cache when possible.
+        bypass_cache always asks the LLM (for variety), the fresh answer still replaces the cached one """
+        with tracing.span("llm.complete", cached=False) as span:
+            key = None
+            if self.cache is not None:
+                key = self.cache_key(messages)
+                if not bypass_cache:
+                    content = self.cache.get(key)
+                    if content is not None:
+                        span.set(cached=True)
+                        return content
+            ai_response = self.generate_message(messages=messages)
+            if isinstance(ai_response, dict):
+                raise RuntimeError(ai_response["error"])
+            content = ai_response.choices[0].message.content
+            span.set(payload_bytes=len(content.encode("utf-8")), **self._usage(ai_response))
+            if key is not None:
+                self.cache.put(key, content)
+            return content
+
+    async def _guarded(self, backend, request):
+        """ Awaits request() within the backend's timeout, keeping its circuit breaker and latency up to date """
+        start = time.monotonic()
+        try:
+            with backend.attempt(), tracing.span("llm.request", backend=backend.name) as span:
+                result = await asyncio.wait_for(request(), backend.timeout)
+                span.set(**self._usage(result))
+        except CircuitOpenError:
+            # Another request is trying it, that says nothing new about the backend
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedged race, so it was at least this slow
+            backend.record_latency(time.monotonic() - start)
+            raise
+        except Exception:
+            backend.record_failure()
+            raise
+        backend.record_success(time.monotonic() - start)
+        return result
+
+    async def _async_request(self, backend, messages):
+        """ Content of one backend's answer, raises if it fails or the answer is empty """
+        async def request():
+            response = await backend.async_client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                stream=False,
+                **backend.sampling_params
+            )
+            content = response.choices[0].message.content
+            if not content or not content.strip():
+                raise RuntimeError(f"{backend.name} returned an empty answer")
+            return content
+
+        return await self._guarded(backend, request)
+
+    async def _hedge(self, call, discard=None):
+        """ Runs call(backend) on the first backend, and on the next one each time hedge_delay passes without a
+        result or a call fails. Returns the first result and cancels the calls still running, results that lost
+        the race are handed to discard. Raises the last error when every backend failed """
+        waiting = self.ordered_backends()
+        running = set()
+        errors = []
+        try:
+            while waiting or running:
+                if waiting:
+                    running.add(asyncio.ensure_future(call(waiting.pop(0))))
+                done, running = await asyncio.wait(running, timeout=self.hedge_delay if waiting else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                errors += [task.exception() for task in done if task.exception() is not None]
+                if succeeded:
+                    for loser in succeeded[1:]:
+                        if discard is not None:
+                            await discard(loser.result())
+                    return succeeded[0].result()
+            raise errors[-1]
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def async_complete(self, messages, bypass_cache=False):
+        """ Async version of complete, hedged across the backends """
+        with tracing.span("llm.complete", cached=False) as span:
+            key = None
+            if self.cache is not None:
+                key = self.cache_key(messages)
+                if not bypass_cache:
+                    content = self.cache.get(key)
+                    if content is not None:
+                        span.set(cached=True)
+                        return content
+            content = await self._hedge(lambda backend: self._async_request(backend, messages))
+            span.set(payload_bytes=len(content.encode("utf-8")))
+            if key is not None:
+                self.cache.put(key, content)
+            return content
+
+    async def stream_message(self, messages, bypass_cache=False):
+        """ Async generator of the AI response as it is generated, one text delta at a time.
+        A cached answer is yielded whole, a completed stream is added to the cache """
+        with tracing.span("llm.stream", cached=False) as span:
+            key = None
+            if self.cache is not None:
+                key = self.cache_key(messages)
+                if not bypass_cache:
+                    content = self.cache.get(key)
+                    if content is not None:
+                        span.set(cached=True)
+                        yield content
+                        return
+            # The backend that starts answering first is streamed from
+            first, deltas = await self._hedge(lambda backend: self._open_stream(backend, messages),
+                                              discard=lambda opened: opened[1].aclose())
+            span.set(first_delta_seconds=span.elapsed())
+            parts = [first]
+            try:
+                yield first
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            finally:
+                await deltas.aclose()
+            content = "".join(parts)
+            span.set(payload_bytes=len(content.encode("utf-8")))
+            if key is not None:
+                self.cache.put(key, content)
+
+    @staticmethod
+    async def _deltas(stream):
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            # openai streams have close(), together's are async generators
+            close = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+            if close is not None:
+                await close()
+
+    async def _open_stream(self, backend, messages):
+        """ Starts a streamed answer and waits for its first text, returns (first text, the remaining deltas) """
+        async def request():
+            stream = await backend.async_client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                stream=True,
+                **backend.sampling_params
+            )
+            deltas = self._deltas(stream)
+            try:
+                return await anext(deltas), deltas
+            except StopAsyncIteration:
+                raise RuntimeError(f"{backend.name} returned an empty answer")
+            except BaseException:
+                await deltas.aclose()
+                raise
+
+        return await self._guarded(backend, request)
+
+    async def async_candidates(self, messages, n):
+        """ n answers asked for concurrently, spread over the backends, best first by the scorer when there is one.
+        Duplicates are dropped so fewer than n may come back, raises if none succeeded """
+        available = self.ordered_backends()
+        backends = [available[index % len(available)] for index in range(n)]
+        results = await asyncio.gather(*[self._async_request(backend, messages) for backend in backends],
+                                       return_exceptions=True)
+        answers = list(dict.fromkeys(result.strip() for result in results if isinstance(result, str)))
+        if not answers:
+            raise next(result for result in results if isinstance(result, BaseException))
+        if self.scorer is not None:
+            scores = await asyncio.to_thread(lambda: {answer: self.scorer(answer) for answer in answers})
+            answers.sort(key=scores.get, reverse=True)
+        return answers
+
+    def prompt_messages(self, art_type, media, prompt, system_prompt=None):
+        """ system_prompt overrides the default t5 system prompt, e.g. one edited by the user for their session """
         message = []
-        message.append({"role": "system", "content": self.t5_system_prompt})
+        message.append({"role": "system", "content": system_prompt or self.t5_system_prompt})
         message.append({"role": "user", "content": "Art Type: " + art_type + "\nMedia:" + media + "\nPrompt:" + prompt})
-        ai_response = self.generate_message(messages=message)
-        self.prompts.append(ai_response.choices[0].message.content)
-        return ai_response.choices[0].message.content
+        return message
 
-    def shrink_prompt(self, prompt):
+    def shrink_messages(self, prompt):
         message = []
         message.append({"role": "system", "content": self.shrink_system_prompt})
         message.append({"role": "user", "content": prompt})
-        ai_response = self.generate_message(messages=message)
-        self.prompts.append(ai_response.choices[0].message.content)
-        return ai_response.choices[0].message.content
+        return message
 
-    def generate_clip_prompt(self, prompt):
+    def clip_messages(self, prompt):
         message = []
         message.append({"role": "system", "content": self.clip_system_prompt})
         message.append({"role": "user", "content": prompt})
-        ai_response = self.generate_message(messages=message)
-        return ai_response.choices[0].message.content
+        return message
+
+    def generate_prompt(self, art_type, media, prompt, system_prompt=None, bypass_cache=False):
+        return self.complete(self.prompt_messages(art_type, media, prompt, system_prompt), bypass_cache=bypass_cache)
+
+    def shrink_prompt(self, prompt, bypass_cache=False):
+        return self.complete(self.shrink_messages(prompt), bypass_cache=bypass_cache)
+
+    def generate_clip_prompt(self, prompt, bypass_cache=False):
+        return self.complete(self.clip_messages(prompt), bypass_cache=bypass_cache)
+
+    async def async_generate_prompt(self, art_type, media, prompt, system_prompt=None, bypass_cache=False):
+        return await self.async_complete(self.prompt_messages(art_type, media, prompt, system_prompt),
+                                         bypass_cache=bypass_cache)
+
+    async def async_generate_prompt_candidates(self, art_type, media, prompt, n=3, system_prompt=None):
+        """ Up to n different prompts, best first """
+        return await self.async_candidates(self.prompt_messages(art_type, media, prompt, system_prompt), n)
+
+    async def async_shrink_prompt(self, prompt, bypass_cache=False):
+        return await self.async_complete(self.shrink_messages(prompt), bypass_cache=bypass_cache)
+
+    async def async_generate_clip_prompt(self, prompt, bypass_cache=False):
+        return await self.async_complete(self.clip_messages(prompt), bypass_cache=bypass_cache)
+
+    @staticmethod
+    def prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def speculate_clip_prompt(self, prompt, bypass_cache=False, limit=None):
+        """ Starts generating the CLIP version of a finished T5 prompt in the background, so it is usually ready
+        before anyone asks for it. Returns a SharedSpeculation, shared by every call for the same prompt, which each
+        caller hands back to release_clip_speculation once it no longer needs it.
+        limit is an optional async context manager held while the LLM is asked (e.g. an AgentPool slot) """
+        key = self.prompt_hash(prompt)
+        shared = self.clip_speculations.get(key)
+        if shared is not None and not shared.task.cancelled():
+            self.clip_speculations.move_to_end(key)
+            shared.waiters += 1
+            return shared
+
+        async def speculate():
+            async with limit or contextlib.nullcontext():
+                return await self.async_generate_clip_prompt(prompt, bypass_cache=bypass_cache)
+
+        def forget_failure(done):
+            # Failures aren't kept, the next request tries again
+            if not done.cancelled() and done.exception() is not None:
+                self._forget_clip_speculation(created)
+
+        created = SharedSpeculation(prompt, key, asyncio.ensure_future(speculate()))
+        created.task.add_done_callback(forget_failure)
+        created.waiters += 1
+        self.clip_speculations[key] = created
+        while len(self.clip_speculations) > self.max_clip_speculations:
+            self.clip_speculations.popitem(last=False)
+        return created
+
+    def clip_speculation(self, prompt):
+        """ The speculative task for prompt, finished or not, None if there is none """
+        shared = self.clip_speculations.get(self.prompt_hash(prompt))
+        return None if shared is None or shared.task.cancelled() else shared.task
+
+    def release_clip_speculation(self, shared):
+        """ Hands back a speculation from speculate_clip_prompt. It is only stopped once nobody else waits for it,
+        a finished one stays cached """
+        shared.waiters -= 1
+        if shared.waiters == 0 and not shared.task.done():
+            self._forget_clip_speculation(shared)
+            shared.task.cancel()
+
+    def _forget_clip_speculation(self, shared):
+        # A newer speculation may already be cached under the same key
+        if self.clip_speculations.get(shared.key) is shared:
+            del self.clip_speculations[shared.key]
+
+    def stream_prompt(self, art_type, media, prompt, system_prompt=None, bypass_cache=False):
+        return self.stream_message(self.prompt_messages(art_type, media, prompt, system_prompt),
+                                   bypass_cache=bypass_cache)
+
+    def stream_shrink_prompt(self, prompt, bypass_cache=False):
+        return self.stream_message(self.shrink_messages(prompt), bypass_cache=bypass_cache)
+
+    def stream_clip_prompt(self, prompt, bypass_cache=False):
+        return self.stream_message(self.clip_messages(prompt), bypass_cache=bypass_cache)
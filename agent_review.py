@@ -1,12 +1,37 @@
+import asyncio
+import hashlib
 import os
-from together import Together
+import httpx
+from together import AsyncTogether, Together
 import base64
 import io
 from PIL import Image
 
+import tracing
+
+# Formats the downscaled image may be sent in, with their mime types
+INLINE_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
 class ReviewAgent:
-    def __init__(self):
+    """ Asks Llama Vision for suggestions to improve an image.
+    Reviews are cached by the content hash of the image, so rating the same image again is instant.
+    With inline_max_resolution set the image is downscaled locally to fit that size and sent inline as JPEG or
+    WebP instead of by url, which cuts upload size and model time and also works for local files.
+    """
+
+    def __init__(self, cache=None, image_store=None, inline_max_resolution=None, inline_format="WEBP",
+                 inline_quality=85):
         self.client = Together(api_key=os.environ.get('TOGETHER_AI_KEY'))
+        self.async_client = AsyncTogether(api_key=os.environ.get('TOGETHER_AI_KEY'))
+        # Optional response_cache.ResponseCache and image_store.ImageStore
+        self.cache = cache
+        self.image_store = image_store
+        if inline_format.upper() not in INLINE_FORMATS:
+            raise ValueError(f"inline_format must be one of {', '.join(INLINE_FORMATS)}")
+        self.inline_max_resolution = inline_max_resolution
+        self.inline_format = inline_format.upper()
+        self.inline_quality = inline_quality
 
     def halve_image_size(self, image):
         # Get the current size of the image
@@ -54,14 +79,9 @@ class ReviewAgent:
         )
         return message.choices[0].message.content
 
-    def review_image(self, url):
-        """ Image halving is current disabled because llama vision is free!"""
-        #image = Image.open(image_path)
-        # Halve the image size before encoding it
-        #resized_image = self.halve_image_size(image)
-        # Convert the resized image to base64
-        #image_base64 = self.image_to_base64(image)
-        message = self.client.chat.completions.create(
+    def review_request(self, url):
+        """ Keyword arguments of the chat completion that reviews the image at url """
+        return dict(
             model="meta-llama/Llama-Vision-Free",
             max_tokens=1024,
             temperature=0.1,
@@ -106,4 +126,100 @@ class ReviewAgent:
 
             ],
         )
-        return message.choices[0].message.content
+
+    def inline_url(self, data):
+        """ Data url of the image downscaled to fit inline_max_resolution """
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((self.inline_max_resolution, self.inline_max_resolution))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffered = io.BytesIO()
+        image.save(buffered, format=self.inline_format, quality=self.inline_quality)
+        encoded = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        return f"data:{INLINE_FORMATS[self.inline_format]};base64,{encoded}"
+
+    def cache_key(self, digest):
+        # Everything of the request but the image itself, which is represented by its hash
+        return self.cache.make_key(request=self.review_request(None), image=digest,
+                                   inline=[self.inline_max_resolution, self.inline_format, self.inline_quality])
+
+    def _stored_bytes(self, url):
+        """ The image from the image store or a local file without any download, None if neither has it """
+        digest = self.image_store.digest_for(url) if self.image_store is not None else None
+        if digest is not None:
+            with open(self.image_store.path(digest), "rb") as file:
+                return file.read()
+        if not url.startswith(("http://", "https://")):
+            with open(url, "rb") as file:
+                return file.read()
+        return None
+
+    def _image_bytes(self, url):
+        data = self._stored_bytes(url)
+        if data is None:
+            response = httpx.get(url, timeout=60.0)
+            response.raise_for_status()
+            data = response.content
+        return data
+
+    async def _async_image_bytes(self, url):
+        if self.image_store is not None and url.startswith(("http://", "https://")):
+            # Downloads into the shared store, once per url
+            await self.image_store.fetch(url)
+        data = await asyncio.to_thread(self._stored_bytes, url)
+        if data is None:
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                response = await client.get(url)
+            response.raise_for_status()
+            data = response.content
+        return data
+
+    def _needs_bytes(self):
+        return self.cache is not None or self.inline_max_resolution is not None
+
+    def _prepare(self, url, data):
+        """ The url to send and the cache key for an image whose bytes are data (None if they aren't needed) """
+        key = self.cache_key(hashlib.sha256(data).hexdigest()) if self.cache is not None else None
+        if self.inline_max_resolution is not None:
+            url = self.inline_url(data)
+        return url, key
+
+    def review_image(self, url, bypass_cache=False):
+        """ Review of the image at url (or a local path when sending inline), from the cache when possible """
+        with tracing.span("vision.review", cached=False) as span:
+            key = None
+            if self._needs_bytes():
+                url, key = self._prepare(url, self._image_bytes(url))
+                if key is not None and not bypass_cache:
+                    content = self.cache.get(key)
+                    if content is not None:
+                        span.set(cached=True)
+                        return content
+            if self.inline_max_resolution is not None:
+                # The image goes in the request as a data url, a plain url is downloaded by the provider instead
+                span.set(payload_bytes=len(url))
+            message = self.client.chat.completions.create(**self.review_request(url))
+            content = message.choices[0].message.content
+            if key is not None:
+                self.cache.put(key, content)
+            return content
+
+    async def async_review_image(self, url, bypass_cache=False):
+        with tracing.span("vision.review", cached=False) as span:
+            key = None
+            if self._needs_bytes():
+                data = await self._async_image_bytes(url)
+                url, key = await asyncio.to_thread(self._prepare, url, data)
+                if key is not None and not bypass_cache:
+                    content = self.cache.get(key)
+                    if content is not None:
+                        span.set(cached=True)
+                        return content
+            if self.inline_max_resolution is not None:
+                # The image goes in the request as a data url, a plain url is downloaded by the provider instead
+                span.set(payload_bytes=len(url))
+            message = await self.async_client.chat.completions.create(**self.review_request(url))
+            content = message.choices[0].message.content
+            if key is not None:
+                self.cache.put(key, content)
+            return content
@@ -1,59 +1,506 @@
+import asyncio
+import contextvars
+import threading
 import time
+from contextlib import contextmanager
+import httpx
 import requests
-import io
+from requests.adapters import HTTPAdapter
 import base64
+import hashlib
+import io
 import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from PIL import Image
 
+import image_transfer
+import tiled_upscale
+import tracing
+
+# Size of the pieces responses are read and decoded in
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# An endpoint that failed is tried again once this long has passed
+UNHEALTHY_RETRY_SECONDS = 30
+
+
+# Set by a caller (the render scheduler sets it to the job) to find its own request in progress_stream reports
+request_tag = contextvars.ContextVar("request_tag", default=None)
+
+
+class RetryableError(Exception):
+    """ The server failed in a way that is worth trying again (5xx) """
+
+
+class SourceImageError(Exception):
+    """ The source image of a request could not be downloaded. Raised while the request body is being sent, but
+    says nothing about the Automatic 1111 server, so it is neither retried nor held against the server """
+
+
+class A1111Backend:
+    """ One Automatic 1111 server, with the number of requests it is working on and whether it looks healthy """
+
+    def __init__(self, api_url):
+        self.api_url = api_url.rstrip('/')
+        self.in_flight = 0
+        self.failed_at = None
+        # request_tag of each request in flight
+        self.tags = []
+
+    @property
+    def healthy(self):
+        return self.failed_at is None or time.time() - self.failed_at > UNHEALTHY_RETRY_SECONDS
 
 
 class SDXLAgent:
     """ This class is used to generate SDXL images from a local Automatic 1111 instance
     Supports txt2img, img2img and extras API (for upscaling)
+    Every call has an async_ twin built on httpx for use straight from the event loop
+    Several A1111 servers can be given, each request goes to the healthy one with the fewest requests in flight.
+    Connections are pooled and kept alive, connection errors and 5xx responses are retried with backoff.
     """
-    def __init__(self):
-        self.api_url = "http://127.0.0.1:7860"
+    def __init__(self, image_store=None, api_urls=None, connect_timeout=5, read_timeout=600, retries=2,
+                 retry_backoff=1.0, source_cache=None):
+        self.backends = [A1111Backend(url) for url in (api_urls or ["http://127.0.0.1:7860"])]
+        # Optional image_store.ImageStore, renders are then kept once per unique image
+        self.image_store = image_store
+        # Optional source_image_cache.SourceImageCache, init and ControlNet images are then fetched once per url
+        self.source_cache = source_cache
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends) + 1, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._async_client = None
+
+    @property
+    def api_url(self):
+        return self.backends[0].api_url
+
+    @property
+    def async_client(self):
+        # Created on first use so it belongs to the running event loop
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16))
+        return self._async_client
+
+    @contextmanager
+    def _lease(self, avoid=()):
+        """ Picks the least loaded healthy backend, preferring ones not in avoid, and counts the request against it """
+        with self._lock:
+            candidates = ([backend for backend in self.backends if backend.healthy and backend not in avoid]
+                          or [backend for backend in self.backends if backend.healthy]
+                          or self.backends)
+            backend = min(candidates, key=lambda candidate: candidate.in_flight)
+            backend.in_flight += 1
+            tag = request_tag.get()
+            if tag is not None:
+                backend.tags.append(tag)
+        try:
+            yield backend
+        finally:
+            with self._lock:
+                backend.in_flight -= 1
+                if tag is not None:
+                    backend.tags.remove(tag)
+
+    def health_check(self):
+        """ Probes every backend, returns {api_url: healthy} """
+        for backend in self.backends:
+            try:
+                response = self.session.get(f'{backend.api_url}/internal/ping', timeout=self.timeout[0])
+                backend.failed_at = None if response.status_code == 200 else time.time()
+            except requests.RequestException:
+                backend.failed_at = time.time()
+        return {backend.api_url: backend.failed_at is None for backend in self.backends}
+
+    async def async_health_check(self):
+        async def probe(backend):
+            try:
+                response = await self.async_client.get(f'{backend.api_url}/internal/ping', timeout=self.timeout[0])
+                backend.failed_at = None if response.status_code == 200 else time.time()
+            except httpx.HTTPError:
+                backend.failed_at = time.time()
+
+        await asyncio.gather(*[probe(backend) for backend in self.backends])
+        return {backend.api_url: backend.failed_at is None for backend in self.backends}
+
+    async def async_progress(self, backend):
+        """ A1111's report on what the backend is rendering: progress (0-1), eta_relative, state with
+        sampling_step / sampling_steps, and current_image, a base64 PNG preview when live previews are enabled """
+        response = await self.async_client.get(f'{backend.api_url}/sdapi/v1/progress',
+                                               params={'skip_current_image': 'false'}, timeout=self.timeout[0])
+        response.raise_for_status()
+        return response.json()
+
+    async def progress_stream(self, interval=1.0):
+        """ Yields {request_tag: progress report} every interval seconds for the tagged requests in flight.
+        Only busy backends are asked, each once however many requests it serves """
+        while True:
+            with self._lock:
+                busy = [(backend, list(backend.tags)) for backend in self.backends if backend.tags]
+            reports = await asyncio.gather(*[self.async_progress(backend) for backend, _ in busy],
+                                           return_exceptions=True)
+            progress = {}
+            for (backend, tags), report in zip(busy, reports):
+                if isinstance(report, Exception):
+                    continue
+                for tag in tags:
+                    progress[tag] = report
+            yield progress
+            await asyncio.sleep(interval)
 
     def download_and_encode_image(self, image_url):
+        if self.source_cache is not None:
+            cached = self.source_cache.get(image_url)
+            if cached is not None:
+                return cached.encoded.decode('utf-8')
         # Download the image
-        response = requests.get(image_url)
+        response = self.session.get(image_url, timeout=self.timeout)
         if response.status_code == 200:
+            if self.source_cache is not None:
+                return self.source_cache.put(image_url, response.content).encoded.decode('utf-8')
             # Encode the image in base64
             encoded_image = base64.b64encode(response.content).decode('utf-8')
             return encoded_image
         else:
             raise Exception("Failed to download image")
 
-    def upscale_image(self, image_path):
-        with open(image_path, 'rb') as file:
-            image_data = file.read()
-        encoded_image = base64.b64encode(image_data).decode('utf-8')
-        payload = {
+    def url_image_chunks(self, image_url):
+        """ The image at image_url for a streamed request: its cached encoding when there is one, otherwise a
+        download that fills the cache on the way through """
+        if self.source_cache is None:
+            return self.download_image_chunks(image_url)
+        cached = self.source_cache.get(image_url)
+        if cached is not None:
+            return image_transfer.EncodedChunks(cached.encoded)
+        return self._caching_chunks(image_url, self.download_image_chunks(image_url))
+
+    def _caching_chunks(self, image_url, chunks):
+        data = bytearray()
+        for chunk in chunks:
+            data += chunk
+            yield chunk
+        self.source_cache.put(image_url, bytes(data))
+
+    def async_url_image_chunks(self, image_url):
+        if self.source_cache is None:
+            return self.async_download_image_chunks(image_url)
+        cached = self.source_cache.get(image_url)
+        if cached is not None:
+            return image_transfer.EncodedChunks(cached.encoded)
+        return self._async_caching_chunks(image_url, self.async_download_image_chunks(image_url))
+
+    async def _async_caching_chunks(self, image_url, chunks):
+        data = bytearray()
+        async for chunk in chunks:
+            data += chunk
+            yield chunk
+        await asyncio.to_thread(self.source_cache.put, image_url, bytes(data))
+
+    def download_image_chunks(self, image_url):
+        """ Streams an image from a url, a chunk at a time """
+        try:
+            with self.session.get(image_url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    raise SourceImageError(f"Failed to download image: status {response.status_code}")
+                yield from response.iter_content(image_transfer.READ_SIZE)
+        except requests.RequestException as e:
+            raise SourceImageError(f"Failed to download image: {e}") from e
+
+    async def async_download_image_chunks(self, image_url):
+        try:
+            async with self.async_client.stream('GET', image_url) as response:
+                if response.status_code != 200:
+                    raise SourceImageError(f"Failed to download image: status {response.status_code}")
+                async for chunk in response.aiter_bytes(image_transfer.READ_SIZE):
+                    yield chunk
+        except httpx.HTTPError as e:
+            raise SourceImageError(f"Failed to download image: {e}") from e
+
+    def _output_opener(self, file_path, store=True):
+        """ Where Base64FieldWriter writes each returned image: a temporary file in the image store when there
+        is one (and store is set), otherwise file_path (with _1, _2... appended for any further images) """
+        def open_output(index):
+            if self.image_store is not None and store:
+                return self.image_store.open_temporary()
+            if index:
+                root, extension = os.path.splitext(file_path)
+                return open(f'{root}_{index}{extension}', 'wb')
+            return open(file_path, 'wb')
+        return open_output
+
+    def _finish_outputs(self, paths, store=True):
+        if self.image_store is None or not store:
+            return paths
+        return [self.image_store.commit(path) for path in paths]
+
+    @staticmethod
+    def _discard_outputs(writer):
+        """ Removes what a failed response left behind, e.g. temporary files in the image store """
+        for path in writer.abort():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already committed to the store or never created
+                pass
+
+    def _check_status(self, endpoint, response):
+        if response.status_code >= 500:
+            raise RetryableError(f'{endpoint} failed with status {response.status_code}: {response.text[:500]}')
+        if response.status_code != 200:
+            raise Exception(f'{endpoint} failed with status {response.status_code}: {response.text[:500]}')
+
+    def _post_streamed(self, endpoint, payload, image_source, response_key, file_path, store=True):
+        """ Posts payload with the image from image_source (a function returning an iterator of its bytes) base64
+        encoded into it on the fly, then decodes the image(s) under response_key in the reply straight to disk.
+        Neither side is ever held in memory whole. Returns the paths, store=False keeps them out of the image store """
+        failed = []
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            with self._lease(avoid=failed) as backend:
+                try:
+                    return self._post_streamed_to(backend, endpoint, payload, image_source, response_key, file_path,
+                                                  store)
+                except (requests.ConnectionError, RetryableError):
+                    if attempt == self.retries:
+                        raise
+                    backend.failed_at = time.time()
+                    failed.append(backend)
+            time.sleep(delay)
+            delay *= 2
+
+    @staticmethod
+    def _span_name(endpoint):
+        # /sdapi/v1/txt2img -> a1111.txt2img
+        return 'a1111.' + endpoint.rsplit('/', 1)[-1]
+
+    @staticmethod
+    def _output_bytes(paths):
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def _post_streamed_to(self, backend, endpoint, payload, image_source, response_key, file_path, store=True):
+        with tracing.span(self._span_name(endpoint), backend=backend.api_url) as span:
+            writer = image_transfer.Base64FieldWriter(response_key, self._output_opener(file_path, store))
+            image_chunks = image_source() if image_source else None
+            try:
+                with self.session.post(url=f'{backend.api_url}{endpoint}',
+                                       data=image_transfer.iter_json_body(payload, image_chunks),
+                                       headers={'Content-Type': 'application/json'}, stream=True,
+                                       timeout=self.timeout) as response:
+                    self._check_status(endpoint, response)
+                    for chunk in response.iter_content(RESPONSE_CHUNK_SIZE):
+                        writer.feed(chunk)
+                paths = self._finish_outputs(writer.close(), store)
+            except BaseException:
+                self._discard_outputs(writer)
+                raise
+            backend.failed_at = None
+            span.set(images=len(paths), payload_bytes=self._output_bytes(paths))
+            return paths
+
+    async def _async_post_streamed(self, endpoint, payload, image_source, response_key, file_path, store=True):
+        failed = []
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            with self._lease(avoid=failed) as backend:
+                try:
+                    return await self._async_post_streamed_to(backend, endpoint, payload, image_source, response_key,
+                                                              file_path, store)
+                except (httpx.ConnectError, httpx.ConnectTimeout, RetryableError):
+                    if attempt == self.retries:
+                        raise
+                    backend.failed_at = time.time()
+                    failed.append(backend)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def _async_post_streamed_to(self, backend, endpoint, payload, image_source, response_key, file_path,
+                                      store=True):
+        with tracing.span(self._span_name(endpoint), backend=backend.api_url) as span:
+            writer = image_transfer.Base64FieldWriter(response_key, self._output_opener(file_path, store))
+            image_chunks = image_source() if image_source else None
+            try:
+                async with self.async_client.stream('POST', f'{backend.api_url}{endpoint}',
+                                                    content=image_transfer.aiter_json_body(payload, image_chunks),
+                                                    headers={'Content-Type': 'application/json'}) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                    self._check_status(endpoint, response)
+                    async for chunk in response.aiter_bytes(RESPONSE_CHUNK_SIZE):
+                        writer.feed(chunk)
+                paths = await asyncio.to_thread(self._finish_outputs, writer.close(), store)
+            except BaseException:
+                self._discard_outputs(writer)
+                raise
+            backend.failed_at = None
+            span.set(images=len(paths), payload_bytes=self._output_bytes(paths))
+            return paths
+
+    def upscale_payload(self, encoded_image, scale=4):
+        return {
               "resize_mode": 0,
               "gfpgan_visibility": 0,
               "codeformer_visibility": 0,
               "codeformer_weight": 0,
-              "upscaling_resize": 4,
+              "upscaling_resize": scale,
               "upscaling_crop": True,
               "upscaler_1": "ESRGAN_4x",
               "upscale_first": False,
               "image": encoded_image
         }
 
-        response = requests.post(url=f'{self.api_url}/sdapi/v1/extra-single-image', json=payload)
-        r = response.json()
-        sd_image = Image.open(io.BytesIO(base64.b64decode(r['image'])))
-        sd_image.save('final_upscaled.png')
+    def upscale_image(self, image_path, output_path=None):
+        """ 4x upscale in a single request. Returns the path of the result: content addressed in the image store
+        when there is one, otherwise output_path or, without one, a file named after its content """
+        payload = self.upscale_payload(image_transfer.IMAGE_PLACEHOLDER)
+        unnamed = output_path is None and self.image_store is None
+        path = self._post_streamed('/sdapi/v1/extra-single-image', payload, lambda: image_transfer.iter_file(image_path),
+                                   'image', self._unnamed_path('upscaled') if unnamed else output_path)[0]
+        return self._name_by_content(path, 'upscaled') if unnamed else path
 
-    def img2img(self, img2img_prompt, counter, image_path, image_url, adetailer):
+    async def async_upscale_image(self, image_path, output_path=None):
+        payload = self.upscale_payload(image_transfer.IMAGE_PLACEHOLDER)
+        unnamed = output_path is None and self.image_store is None
+        paths = await self._async_post_streamed('/sdapi/v1/extra-single-image', payload,
+                                                lambda: image_transfer.aiter_file(image_path), 'image',
+                                                self._unnamed_path('upscaled') if unnamed else output_path)
+        if unnamed:
+            return await asyncio.to_thread(self._name_by_content, paths[0], 'upscaled')
+        return paths[0]
 
-        if counter == 1:
-            encoded_image = self.download_and_encode_image(image_url)
-        else:
-            with open(image_path, 'rb') as file:
-                image_data = file.read()
-            encoded_image = base64.b64encode(image_data).decode('utf-8')
+    @staticmethod
+    def _unnamed_path(prefix):
+        # Unique, so concurrent requests never write into each other's file
+        return f'{prefix}_{uuid.uuid4().hex}.part'
+
+    @staticmethod
+    def _name_by_content(path, prefix):
+        """ Renames a finished file to prefix_<sha256>.png (like _save_image names its files), returns the path """
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            while chunk := file.read(RESPONSE_CHUNK_SIZE):
+                sha256.update(chunk)
+        named = f'{prefix}_{sha256.hexdigest()}.png'
+        os.replace(path, named)
+        return named
+
+    def _upscale_tile(self, data, scale, tile_path):
+        payload = self.upscale_payload(image_transfer.IMAGE_PLACEHOLDER, scale)
+        encoded = base64.b64encode(data)
+        return self._post_streamed('/sdapi/v1/extra-single-image', payload,
+                                   lambda: image_transfer.EncodedChunks(encoded), 'image', tile_path, store=False)[0]
+
+    async def _async_upscale_tile(self, data, scale, tile_path):
+        payload = self.upscale_payload(image_transfer.IMAGE_PLACEHOLDER, scale)
+        encoded = base64.b64encode(data)
+        paths = await self._async_post_streamed('/sdapi/v1/extra-single-image', payload,
+                                                lambda: image_transfer.EncodedChunks(encoded), 'image', tile_path,
+                                                store=False)
+        return paths[0]
+
+    def _save_image(self, image, output_path=None):
+        """ Saves a PIL image into the image store, or to output_path, or when neither is available to a file
+        named after its content. Returns the path """
+        if self.image_store is not None:
+            with self.image_store.open_temporary() as file:
+                image.save(file, format='PNG')
+            return self.image_store.commit(file.name)
+        if output_path is None:
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            output_path = f'upscaled_{hashlib.sha256(buffer.getvalue()).hexdigest()}.png'
+            with open(output_path, 'wb') as file:
+                file.write(buffer.getvalue())
+            return output_path
+        image.save(output_path)
+        return output_path
+
+    @tracing.traced("a1111.upscale_tiled")
+    def upscale_tiled(self, image_path, scale=4, tile_size=tiled_upscale.DEFAULT_TILE_SIZE,
+                      overlap=tiled_upscale.DEFAULT_OVERLAP, progress=None, output_path=None):
+        """ Upscales the image a tile at a time, every backend working on tiles in parallel, then blends the
+        tiles back together. No single request has to carry the whole image, so size is bounded by neither the
+        server's memory nor its timeout. progress(done, total) is called as each tile comes back.
+        Returns the path of the result, content addressed in the image store when there is one """
+        image = Image.open(image_path).convert('RGB')
+        boxes = tiled_upscale.tile_boxes(image.width, image.height, tile_size, overlap)
+
+        def upscale(box, tile_path):
+            self._upscale_tile(tiled_upscale.encode_tile(image, box), scale, tile_path)
+
+        with tempfile.TemporaryDirectory() as directory:
+            tile_paths = [os.path.join(directory, f'tile_{index}.png') for index in range(len(boxes))]
+            # One tile per backend at a time, _lease spreads them over the backends
+            with ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+                futures = [executor.submit(upscale, box, tile_path) for box, tile_path in zip(boxes, tile_paths)]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    future.result()
+                    if progress:
+                        progress(done, len(boxes))
+            result = tiled_upscale.stitch(image.size, scale, boxes, tile_paths)
+        return self._save_image(result, output_path)
 
+    @tracing.traced("a1111.upscale_tiled")
+    async def async_upscale_tiled(self, image_path, scale=4, tile_size=tiled_upscale.DEFAULT_TILE_SIZE,
+                                  overlap=tiled_upscale.DEFAULT_OVERLAP, progress=None, output_path=None):
+        image = await asyncio.to_thread(lambda: Image.open(image_path).convert('RGB'))
+        boxes = tiled_upscale.tile_boxes(image.width, image.height, tile_size, overlap)
+        slots = asyncio.Semaphore(len(self.backends))
+        done = 0
+
+        async def upscale(box, tile_path):
+            nonlocal done
+            async with slots:
+                data = await asyncio.to_thread(tiled_upscale.encode_tile, image, box)
+                await self._async_upscale_tile(data, scale, tile_path)
+            done += 1
+            if progress:
+                progress(done, len(boxes))
+
+        with tempfile.TemporaryDirectory() as directory:
+            tile_paths = [os.path.join(directory, f'tile_{index}.png') for index in range(len(boxes))]
+            await asyncio.gather(*[upscale(box, tile_path) for box, tile_path in zip(boxes, tile_paths)])
+            result = await asyncio.to_thread(tiled_upscale.stitch, image.size, scale, boxes, tile_paths)
+        return await asyncio.to_thread(self._save_image, result, output_path)
+
+    def batches(self, batch_size=1, n_iter=1, seeds=None):
+        """ (seed, batch_size, n_iter) for each A1111 call needed. A1111 gives the images of a batch consecutive
+        seeds, so a list of seeds takes one call per run of consecutive seeds (one call for [5, 6, 7, 8]) """
+        if not seeds:
+            return [(-1, batch_size, n_iter)]
+        runs = []
+        for seed in seeds:
+            if runs and runs[-1][0] + runs[-1][1] == seed:
+                runs[-1][1] += 1
+            else:
+                runs.append([seed, 1])
+        return [(seed, count, 1) for seed, count in runs]
+
+    def apply_batch(self, payload, seed, batch_size, n_iter):
+        payload["seed"] = seed
+        payload["batch_size"] = batch_size
+        payload["n_iter"] = n_iter
+        if batch_size * n_iter > 1:
+            # Otherwise A1111 puts a grid of the whole batch in front of the images
+            payload["override_settings"] = {"return_grid": False}
+        return payload
+
+    def keep_renders(self, paths, count):
+        """ ControlNet appends its detected maps after the rendered images, drop anything past the renders """
+        for extra in paths[count:]:
+            if extra not in paths[:count] and os.path.exists(extra):
+                os.remove(extra)
+        return paths[:count]
+
+    def img2img_payload(self, img2img_prompt, encoded_image, adetailer):
         payload = {
 
                 "prompt": img2img_prompt,
@@ -81,17 +528,40 @@ class SDXLAgent:
                     }
                 ]
             }
+        return payload
 
-        response = requests.post(url=f'{self.api_url}/sdapi/v1/img2img', json=payload)
-        r = response.json()
-        file_path = f'images/sdxl_image_{time.time()}.png'
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        sd_image = Image.open(io.BytesIO(base64.b64decode(r['images'][0])))
-        sd_image.save(file_path)
-        return file_path
+    def img2img(self, img2img_prompt, counter, image_path, image_url, adetailer, batch_size=1, n_iter=1, seeds=None):
+        """ Returns the paths of every image rendered, batch_size * n_iter (or one per seed) of them """
+        if counter == 1:
+            image_source = lambda: self.url_image_chunks(image_url)
+        else:
+            image_source = lambda: image_transfer.iter_file(image_path)
 
-    def txt2img(self, prompt, id, hires, adetailer, controlnet, image_url):
+        paths = []
+        for seed, size, iterations in self.batches(batch_size, n_iter, seeds):
+            payload = self.apply_batch(self.img2img_payload(img2img_prompt, image_transfer.IMAGE_PLACEHOLDER, adetailer),
+                                       seed, size, iterations)
+            paths += self.keep_renders(self._post_streamed('/sdapi/v1/img2img', payload, image_source, 'images',
+                                                           f'images/sdxl_image_{time.time()}.png'), size * iterations)
+        return paths
+
+    async def async_img2img(self, img2img_prompt, counter, image_path, image_url, adetailer, batch_size=1, n_iter=1,
+                            seeds=None):
+        if counter == 1:
+            image_source = lambda: self.async_url_image_chunks(image_url)
+        else:
+            image_source = lambda: image_transfer.aiter_file(image_path)
+
+        paths = []
+        for seed, size, iterations in self.batches(batch_size, n_iter, seeds):
+            payload = self.apply_batch(self.img2img_payload(img2img_prompt, image_transfer.IMAGE_PLACEHOLDER, adetailer),
+                                       seed, size, iterations)
+            rendered = await self._async_post_streamed('/sdapi/v1/img2img', payload, image_source, 'images',
+                                                       f'images/sdxl_image_{time.time()}.png')
+            paths += self.keep_renders(rendered, size * iterations)
+        return paths
+
+    def txt2img_payload(self, prompt, hires, adetailer, controlnet_image):
 
         payload = {
             "prompt": prompt,
@@ -127,8 +597,8 @@ class SDXLAgent:
                 ]
             }
 
-        # Conditionally add ControlNet to alwayson_scripts if controlnet is True
-        if controlnet:
+        # Conditionally add ControlNet to alwayson_scripts if there's a control image
+        if controlnet_image:
             if "alwayson_scripts" not in payload:
                 payload["alwayson_scripts"] = {}
             payload["alwayson_scripts"]["controlnet"] = {
@@ -137,7 +607,7 @@ class SDXLAgent:
                         "is_img2img": False,
                         "is_ui:": False,
                         "enabled": True,
-                        "image": self.download_and_encode_image(image_url),
+                        "image": controlnet_image,
                         "module": "canny",
                         "model": "diffusers_xl_canny_mid [112a778d]",
                         "weight": 0.50,
@@ -145,11 +615,40 @@ class SDXLAgent:
                     }
                 ]
             }
+        return payload
+
+    def txt2img(self, prompt, id, hires, adetailer, controlnet, image_url, batch_size=1, n_iter=1, seeds=None):
+        """ Returns the paths of every image rendered, batch_size * n_iter (or one per seed) of them """
+        image_source = (lambda: self.url_image_chunks(image_url)) if controlnet else None
+        batches = self.batches(batch_size, n_iter, seeds)
+        paths = []
+        for seed, size, iterations in batches:
+            payload = self.apply_batch(self.txt2img_payload(prompt, hires, adetailer,
+                                                            image_transfer.IMAGE_PLACEHOLDER if controlnet else None),
+                                       seed, size, iterations)
+            file_path = 'output{}.png'.format(id) if len(batches) == 1 else 'output{}_{}.png'.format(id, seed)
+            paths += self.keep_renders(self._post_streamed('/sdapi/v1/txt2img', payload, image_source, 'images',
+                                                           file_path), size * iterations)
+        return paths
+
+    async def async_txt2img(self, prompt, id, hires, adetailer, controlnet, image_url, batch_size=1, n_iter=1,
+                            seeds=None):
+        image_source = (lambda: self.async_url_image_chunks(image_url)) if controlnet else None
+        batches = self.batches(batch_size, n_iter, seeds)
+        paths = []
+        for seed, size, iterations in batches:
+            payload = self.apply_batch(self.txt2img_payload(prompt, hires, adetailer,
+                                                            image_transfer.IMAGE_PLACEHOLDER if controlnet else None),
+                                       seed, size, iterations)
+            file_path = 'output{}.png'.format(id) if len(batches) == 1 else 'output{}_{}.png'.format(id, seed)
+            rendered = await self._async_post_streamed('/sdapi/v1/txt2img', payload, image_source, 'images', file_path)
+            paths += self.keep_renders(rendered, size * iterations)
+        return paths
 
-        response = requests.post(url=f'{self.api_url}/sdapi/v1/txt2img', json=payload)
-        r = response.json()
-        sd_image = Image.open(io.BytesIO(base64.b64decode(r['images'][0])))
-        sd_image.save('output{}.png'.format(id))
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
 
 
 def test_img2img():
@@ -1,51 +1,202 @@
 import asyncio
+import os
 import time
+from collections import Counter
+
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
+from nicegui import ui, app
+from agent_pool import AgentPool
+from agent_prompt import LLM_TIMEOUT_SECONDS
+from multiworker import WORKER_COOKIE, worker_url
+from render_scheduler import PRIORITY_PREVIEW, PRIORITY_RENDER, PRIORITY_UPSCALE
+from prompt_compression import CLIP_TOKEN_BUDGET, PromptCompressor, T5_TOKEN_BUDGET
+from session import Session
+from tokenizer import SequenceLengthCounter
+import tracing
+
+# Agents and their clients are shared by every page visit, see AgentPool
+# Set PROMPTGLOW_WEBHOOK_URL to this server's public /webhooks/replicate url to be notified when
+# predictions finish, otherwise they are polled
+# A1111_URLS is a comma separated list of Automatic 1111 servers to share SDXL work between
+# PROMPTGLOW_LLM_BACKENDS (e.g. local,together) hedges prompt requests across several LLM backends
+# PROMPTGLOW_LLM_TIMEOUT is how many seconds an LLM backend may take before failing over to the next one
+# PROMPTGLOW_REVIEW_MAX_RESOLUTION downscales images to that many pixels and sends them inline for review
+# PROMPTGLOW_PORT is the port to serve on, 8080 by default
+# PROMPTGLOW_WORKER is set by multiworker.py on the worker processes it runs behind one port
+# PROMPTGLOW_TRACE_FILE appends a JSON line for every traced call (LLM, Replicate, A1111, review, tokenizer)
+worker = os.environ.get('PROMPTGLOW_WORKER')
+webhook_url = os.environ.get('PROMPTGLOW_WEBHOOK_URL')
+if webhook_url and worker is not None:
+    # Behind multiworker.py only this process is waiting for its predictions
+    webhook_url = worker_url(webhook_url, worker)
+agent_pool = AgentPool(local=True, webhook_url=webhook_url,
+                       a1111_urls=[url for url in os.environ.get('A1111_URLS', '').split(',') if url] or None,
+                       review_max_resolution=int(os.environ.get('PROMPTGLOW_REVIEW_MAX_RESOLUTION', 0)) or None,
+                       llm_backends=[name for name in os.environ.get('PROMPTGLOW_LLM_BACKENDS', '').split(',')
+                                     if name] or None,
+                       llm_timeout=float(os.environ.get('PROMPTGLOW_LLM_TIMEOUT', LLM_TIMEOUT_SECONDS)))
+app.on_shutdown(agent_pool.aclose)
+tracing.tracer.configure(os.environ.get('PROMPTGLOW_TRACE_FILE'))
+app.on_shutdown(tracing.tracer.close)
+# Load the CLIP vocabulary in the background once the server is up rather than at import time
+app.on_startup(lambda: agent_pool.tokenizer.preload())
+# Slides kept in the carousel at once, and how many more 'load older' brings back
+MAX_LIVE_SLIDES = 20
+LOAD_OLDER_BATCH = 10
+# Session id -> pages open in this process, several tabs of one browser share a session
+open_pages = Counter()
+
+
+@app.middleware('http')
+async def mark_worker(request: Request, call_next):
+    """ Tells the multiworker proxy which worker this browser's pages (and their websockets) live on """
+    response = await call_next(request)
+    if worker is not None and request.cookies.get(WORKER_COOKIE) != worker:
+        response.set_cookie(WORKER_COOKIE, worker, httponly=True, samesite='lax')
+    return response
+
+
+@app.get('/images/{file_path:path}')
+def serve_image(file_path: str, request: Request):
+    """ Serves generated images with ETags, content addressed ones are cached by the browser for good """
+    return agent_pool.image_store.serve(file_path, request.headers.get('if-none-match'))
+
+
+@app.get('/metrics')
+def metrics():
+    """ Latency percentiles, call, error, payload and token counts of every traced call, for Prometheus """
+    return PlainTextResponse(tracing.tracer.render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.post('/webhooks/replicate')
+async def replicate_webhook(request: Request):
+    """ Replicate calls this when a prediction completes """
+    return {'handled': agent_pool.flux.handle_webhook(await request.json())}
 
-from nicegui import run, ui, app
-from agent_prompt import PromptAgent
-from agent_flux import FluxAgent
-from agent_review import ReviewAgent
-from agent_sdxl import SDXLAgent
-from tokenizer import Tokenizer
 
 @ui.page('/')
 def main():
-    app.add_static_files('/images', 'images')
 
-
-    async def update_timer(label, start_time):
-        """ Starts a timer and updates the given label with elapsed time"""
-        while True:
-            elapsed_time = time.time() - start_time
-            label.set_text(f"Elapsed time: {elapsed_time:.2f} seconds")
-            await asyncio.sleep(0.1)  # Update every 100ms
+    def watch_progress(label, start_time, job=None, preview_image=None):
+        """ Keeps the label up to date with elapsed time, the queue position while job waits and A1111's progress
+        once it renders, showing its live previews in preview_image. Driven by the shared progress poller until
+        progress_poller.unwatch is called with the returned handle """
+        def show(progress):
+            label.set_text(progress.describe())
+            if preview_image is not None and progress.preview:
+                preview_image.set_source(progress.preview)
+        return progress_poller.watch(show, job, start_time)
+
+
+    async def stream_into(textarea, deltas):
+        """ Fills the textarea progressively as the LLM streams its answer, returns the complete text.
+        What was there stays until the first words arrive, and is put back if the answer fails """
+        original = textarea.value
+        text = ''
+        try:
+            async with agent_pool.limit('llm'):
+                async for delta in deltas:
+                    text += delta
+                    textarea.value = text
+        except BaseException:
+            textarea.value = original
+            raise
+        return text
 
 
     async def generate_prompts():
         """ uses prompt agent to generate an embellished prompt from the user's initial prompt """
-        generated_prompt = None
         # Start up the spinner
         with prompt_textarea:
             spinner = ui.spinner('dots', size='xl')
             spinner.visible = True
         try:
-            generated_prompt = await run.io_bound(prompt_agent.generate_prompt,
-                                                  art_type=art_type.value,
-                                                  media=media.value,
-                                                  prompt=user_prompt.value)
+            if prompt_candidate_count.value > 1:
+                generated_prompt = await generate_prompt_candidates()
+            else:
+                prompt_candidates.set_visibility(False)
+                generated_prompt = await stream_into(prompt_textarea,
+                                                     prompt_agent.stream_prompt(art_type=art_type.value,
+                                                                                media=media.value,
+                                                                                prompt=user_prompt.value,
+                                                                                system_prompt=session.t5_system_prompt,
+                                                                                bypass_cache=bypass_cache.value))
+            await session.add_prompt(generated_prompt)
+            speculate_clip_prompt(generated_prompt)
         except Exception as e:
             ui.notify(f'Unable to get a prompt: {e}', type='negative')
         finally:
-            prompt_textarea.value = generated_prompt
             spinner.visible = False
 
 
+    async def generate_prompt_candidates():
+        """ Asks for several prompts at once, shows the best and offers the others in the candidates select """
+        async with agent_pool.limit('llm'):
+            candidates = await prompt_agent.async_generate_prompt_candidates(art_type=art_type.value,
+                                                                             media=media.value,
+                                                                             prompt=user_prompt.value,
+                                                                             n=prompt_candidate_count.value,
+                                                                             system_prompt=session.t5_system_prompt)
+        prompt_candidates.set_options(candidates, value=candidates[0])
+        prompt_candidates.set_visibility(len(candidates) > 1)
+        prompt_textarea.value = candidates[0]
+        return candidates[0]
+
+
+    def choose_prompt_candidate(e):
+        if e.value and e.value != prompt_textarea.value:
+            prompt_textarea.value = e.value
+            speculate_clip_prompt(e.value)
+
+
     async def shrink_prompt():
-        """ Asks the LLM to reduce the words in the prompt """
+        """ Shortens an over long prompt locally when that is enough, otherwise asks the LLM to reduce its words """
         prompt = prompt_textarea.value
-        shrunken_prompt = await run.io_bound(prompt_agent.shrink_prompt,
-                                             prompt=prompt)
-        prompt_textarea.value = shrunken_prompt
+        compression = None
+        # Only a prompt over the budget is shortened locally, one that already fits asked to be reworded
+        if prompt and await asyncio.to_thread(tokenizer.get_sequence_length, prompt) > T5_TOKEN_BUDGET:
+            compression = await asyncio.to_thread(prompt_compressor.compress, prompt, T5_TOKEN_BUDGET)
+        if compression and compression.fits:
+            shrunken_prompt = compression.prompt
+            prompt_textarea.value = shrunken_prompt
+        else:
+            try:
+                shrunken_prompt = await stream_into(prompt_textarea,
+                                                    prompt_agent.stream_shrink_prompt(prompt=prompt,
+                                                                                      bypass_cache=bypass_cache.value))
+            except Exception as e:
+                ui.notify(f'Unable to shrink the prompt: {e}', type='negative')
+                return
+        await session.add_prompt(shrunken_prompt)
+        speculate_clip_prompt(shrunken_prompt)
+
+
+    def speculate_clip_prompt(prompt):
+        """ Starts on the CLIP version of a finished prompt in the background so the SDXL dialog rarely waits """
+        previous = session.clip_speculation
+        session.clip_speculation = prompt_agent.speculate_clip_prompt(prompt, bypass_cache=bypass_cache.value,
+                                                                      limit=agent_pool.limit('llm'))
+        if previous is not None:
+            # Other sessions may be waiting for the same prompt, it only stops once none are
+            prompt_agent.release_clip_speculation(previous)
+
+
+    def drop_stale_clip_speculation():
+        """ The prompt was edited, its speculative CLIP version is of no use to this session any more """
+        speculation = session.clip_speculation
+        if speculation is not None and speculation.prompt != prompt_textarea.value:
+            session.clip_speculation = None
+            prompt_agent.release_clip_speculation(speculation)
+
+
+    async def fit_clip_prompt(clip_prompt):
+        """ CLIP ignores whatever is past its token budget, so an LLM answer that runs over is shortened locally """
+        if await asyncio.to_thread(tokenizer.get_sequence_length, clip_prompt) <= CLIP_TOKEN_BUDGET:
+            return clip_prompt
+        compression = await asyncio.to_thread(prompt_compressor.compress, clip_prompt, CLIP_TOKEN_BUDGET)
+        # Even when it still doesn't fit, the clauses dropped are the least important rather than the last ones
+        return compression.prompt
 
 
     async def generate_clip_prompt():
@@ -53,9 +204,15 @@ def main():
         with sdxl_clip_prompt:
             spinner = ui.spinner('dots', size='xl')
             spinner.visible = True
-        clip_prompt = await run.io_bound(prompt_agent.generate_clip_prompt, prompt=t5_prompt)
-        sdxl_clip_prompt.value = clip_prompt
-        spinner.visible = False
+        try:
+            clip_prompt = await stream_into(sdxl_clip_prompt,
+                                            prompt_agent.stream_clip_prompt(prompt=t5_prompt,
+                                                                            bypass_cache=bypass_cache.value))
+            sdxl_clip_prompt.value = await fit_clip_prompt(clip_prompt)
+        except Exception as e:
+            ui.notify(f'Unable to get a CLIP prompt: {e}', type='negative')
+        finally:
+            spinner.visible = False
 
 
     async def improve_prompt():
@@ -66,26 +223,68 @@ def main():
         with prompt_textarea:
             spinner = ui.spinner('dots', size='xl')
             spinner.visible = True
-        generated_prompt = await run.io_bound(prompt_agent.generate_prompt,
-                                              art_type=art_type.value,
-                                              media=media.value,
-                                              prompt=improvements_prompt)  # Actual prompt generation
-        prompt_textarea.value = generated_prompt
-        spinner.visible = False
+        try:
+            generated_prompt = await stream_into(prompt_textarea,
+                                                 prompt_agent.stream_prompt(art_type=art_type.value,
+                                                                            media=media.value,
+                                                                            prompt=improvements_prompt,
+                                                                            system_prompt=session.t5_system_prompt,
+                                                                            bypass_cache=bypass_cache.value))
+            await session.add_prompt(generated_prompt)
+        except Exception as e:
+            ui.notify(f'Unable to improve the prompt: {e}', type='negative')
+        finally:
+            spinner.visible = False
 
 
-    def update_sequence_length():
+    async def update_sequence_length():
         """ Keeps the sequence length variable updated if the prompt is changed """
+        drop_stale_clip_speculation()
         if prompt_textarea.value:
-            token_count = tokenizer.get_sequence_length(prompt_textarea.value)
-            sequence_length.set_text("Sequence Length: {}/256".format(token_count))
+            token_count = await sequence_length_counter.count(prompt_textarea.value)
+            if token_count:
+                sequence_length.set_text("Sequence Length: {}/{} ({:.1f} ms)".format(token_count.count,
+                                                                                       T5_TOKEN_BUDGET,
+                                                                                       token_count.seconds * 1000))
+
+
+    async def run_flux(**kwargs):
+        """ Runs a flux prediction as a task that the cancel button can cancel, along with the remote prediction """
+        async def limited():
+            async with agent_pool.limit('replicate'):
+                return await flux_agent.async_generate_image(**kwargs)
+
+        task = asyncio.create_task(limited())
+        flux_tasks.add(task)
+        flux_cancel_button.style('visibility: visible')
+        try:
+            return await task
+        finally:
+            flux_tasks.discard(task)
+            if not flux_tasks:
+                flux_cancel_button.style('visibility: hidden')
+
+
+    def cancel_flux():
+        for task in flux_tasks:
+            task.cancel()
+
+
+    async def keep_locally(url):
+        """ Downloads a result into the shared image store once, so the carousel can show a local thumbnail.
+        Returns the digest of the copy, None if it couldn't be kept """
+        try:
+            return await image_store.fetch(url)
+        except Exception as e:
+            ui.notify(f'Unable to keep a local copy of the image: {str(e)}', type='warning')
+            return None
 
 
     async def generate_image():
         """ Uses Flux Agent to create an image from the prompt """
         prompt = prompt_textarea.value
         flux_generate_button.disable()
-        timer_task = None
+        timer = None
         urls = None
         start_time = time.time()
         with carousel_placeholder:
@@ -94,20 +293,23 @@ def main():
         try:
             # Start the processing timer
 
-            timer_task = asyncio.create_task((update_timer(stopwatch_label, start_time)))
-            urls = await run.io_bound(flux_agent.generate_image, model="black-forest-labs/flux-schnell",
-                                      prompt=prompt, steps=4, controlnet=False, image_url=None)
+            timer = watch_progress(stopwatch_label, start_time)
+            urls = await run_flux(model="black-forest-labs/flux-schnell",
+                                  prompt=prompt, steps=4, controlnet=False, image_url=None)
+        except asyncio.CancelledError:
+            ui.notify('Image generation cancelled', type='warning')
         except Exception as e:
             ui.notify(f'Unable to get an image: {str(e)}', type='negative')
         finally:
-            if timer_task:
-                timer_task.cancel()
+            if timer:
+                progress_poller.unwatch(timer)
             flux_generate_button.enable()
             # End the timer
             end_time = time.time()
             if urls:
                 url = urls[0]
-                flux_image_urls.append(url)
+                digest = await keep_locally(url)
+                await session.add_image_url(url, digest)
             else:
                 ui.notify('No valid image url returned', type='negative')
             review_button.style('visibility: visible')
@@ -122,29 +324,31 @@ def main():
         """ Creates a flux dev image from the prompt and uses the image as a controlnet """
         prompt = prompt_textarea.value
         control_url = flux_image_label.text
-        timer_task = None
+        timer = None
         start_time = time.time()
         urls = None
         with carousel_placeholder:
             spinner = ui.spinner(size='xl')
             spinner.visible = True
         try:
-            timer_task = asyncio.create_task((update_timer(stopwatch_label, start_time)))
-            urls = await run.io_bound(flux_agent.generate_image,
-                                      model="xlabs-ai/flux-dev-controlnet"
-                                            ":f2c31c31d81278a91b2447a304dae654c64a5d5a70340fba811bb1cbd41019a2",
-                                      prompt=prompt, steps=28,
-                                      controlnet=True, image_url=control_url)
+            timer = watch_progress(stopwatch_label, start_time)
+            urls = await run_flux(model="xlabs-ai/flux-dev-controlnet"
+                                        ":f2c31c31d81278a91b2447a304dae654c64a5d5a70340fba811bb1cbd41019a2",
+                                  prompt=prompt, steps=28,
+                                  controlnet=True, image_url=control_url)
+        except asyncio.CancelledError:
+            ui.notify('Image generation cancelled', type='warning')
         except Exception as e:
             ui.notify(f'Unable to get an image: {str(e)}', type='negative')
         finally:
-            if timer_task:
-                timer_task.cancel()
+            if timer:
+                progress_poller.unwatch(timer)
             # End the timer
             end_time = time.time()
             if urls:
                 url = urls[0]
-                flux_image_urls.append(url)
+                digest = await keep_locally(url)
+                await session.add_image_url(url, digest)
             review_button.style('visibility: visible')
             sdxl_button.style('visibility: visible')
             spinner.visible = False
@@ -157,28 +361,84 @@ def main():
         with review_row:
             review_spinner = ui.spinner('dots', size='xl')
         try:
-            review.content = await run.io_bound(review_agent.review_image, url=flux_image_label.text)
+            async with agent_pool.limit('vision'):
+                review.content = await review_agent.async_review_image(url=flux_image_label.text,
+                                                                       bypass_cache=bypass_cache.value)
         except Exception as e:
             ui.notify(f'Unable to generate a review: {str(e)}', type='negative')
         finally:
             review_spinner.visible = False
 
 
-    def sdxl_dialog_manager():
+    async def sdxl_dialog_manager():
         sdxl_dialog.open()
+        # Usually the CLIP prompt was worked out while the user looked at the flux image
+        speculation = prompt_agent.clip_speculation(prompt_textarea.value)
+        if speculation is None:
+            return
+        with sdxl_clip_prompt:
+            spinner = ui.spinner('dots', size='xl')
+            spinner.visible = not speculation.done()
+        try:
+            sdxl_clip_prompt.value = await fit_clip_prompt(await asyncio.shield(speculation))
+        except (asyncio.CancelledError, Exception):
+            # The Get CLIP button is still there
+            pass
+        finally:
+            spinner.visible = False
 
 
-    def update_carousel():
-        carousel_placeholder.clear()
+    def add_slide(index, newest):
+        """ Adds a slide for flux_image_urls[index], named after its index, at the front or the back """
+        url = flux_image_urls[index]
         with carousel_placeholder:
-            for url in reversed(flux_image_urls):
-                with ui.carousel_slide().classes('p-0'):
-                    with ui.row():
-                        ui.image(url).classes('w-[600px]')
-                        ui.button(icon='fullscreen', on_click=open_lightbox).props('round color=blue').classes('absolute bottom-0 left-0 m-2')
-                        ui.button(icon='file_download', on_click=lambda: ui.download(src=url)).props('round color=blue').classes('absolute bottom-0 right-0 m-2')
-        carousel_placeholder.value = 'slide_1'
+            with ui.carousel_slide(name=f'image_{index}').classes('p-0') as slide:
+                with ui.row():
+                    ui.image(image_store.thumbnail_url(url)).classes('w-[600px]')
+                    ui.button(icon='fullscreen', on_click=open_lightbox).props('round color=blue').classes('absolute bottom-0 left-0 m-2')
+                    ui.button(icon='file_download', on_click=lambda: ui.download(src=image_store.local_url(url))).props('round color=blue').classes('absolute bottom-0 right-0 m-2')
+        if newest:
+            slide.move(target_index=0)
+        live_slides[index] = slide
+
+
+    def update_carousel():
+        """ Prepends a slide for the newest image. Only the newest MAX_LIVE_SLIDES stay in the page,
+        older ones come back with 'load older' """
+        if not flux_image_urls:
+            return
+        if not live_slides:
+            # Get rid of the placeholder
+            carousel_placeholder.clear()
+        newest_index = len(flux_image_urls) - 1
+        if newest_index not in live_slides:
+            add_slide(newest_index, newest=True)
+        trim_slides()
+        carousel_placeholder.value = f'image_{newest_index}'
         set_current_image()
+        update_load_older_button()
+
+
+    def load_older():
+        """ Appends the next batch of older slides to the end of the carousel """
+        nonlocal loaded_older
+        oldest_index = min(live_slides)
+        for index in range(oldest_index - 1, max(oldest_index - LOAD_OLDER_BATCH, 0) - 1, -1):
+            add_slide(index, newest=False)
+            loaded_older += 1
+        trim_slides()
+        update_load_older_button()
+
+
+    def trim_slides():
+        """ Removes the oldest slides beyond MAX_LIVE_SLIDES, plus however many the user asked back with
+        'load older' so those stay until the page is reloaded """
+        while len(live_slides) > MAX_LIVE_SLIDES + loaded_older:
+            carousel_placeholder.remove(live_slides.pop(min(live_slides)))
+
+
+    def update_load_older_button():
+        load_older_button.style('visibility: visible' if live_slides and min(live_slides) > 0 else 'visibility: hidden')
 
     def update_media():
         selected_art_type = art_type.value
@@ -199,62 +459,160 @@ def main():
             # Let's get out of here if we haven't created the list yet
             return
         slide_value = carousel_placeholder.value
+        if not slide_value or not slide_value.startswith('image_'):
+            # Still showing the placeholder
+            return
 
-        # Extract the index from the slide value (e.g., "slide_1" -> 1)
-        slide_index = int(slide_value.replace('slide_', '')) - 1  # Subtract 1 to get zero-based index
-
-        # Since the list was reversed when building the carousel, adjust the index accordingly
-        original_index = len(flux_image_urls) - 1 - slide_index
+        # Slides are named after their index in the list (e.g., "image_3" -> flux_image_urls[3])
+        original_index = int(slide_value.replace('image_', ''))
 
         # Get the corresponding URL from the original list
         current_url = flux_image_urls[original_index]
         flux_image_label.set_text(current_url)
-        sdxl_image.set_source(current_url)
+        sdxl_image.set_source(image_store.local_url(current_url))
 
     def open_lightbox():
-        large_image.set_source(flux_image_label.text)
+        large_image.set_source(image_store.local_url(flux_image_label.text))
         lightbox_dialog.open()
 
     def open_system_prompt_dialog():
         system_prompt_dialog.open()
-    def update_system_prompt():
-        prompt_agent.t5_system_prompt = system_prompt.value
+    async def update_system_prompt():
+        await session.set_system_prompt(system_prompt.value)
         system_prompt.update()
         ui.notify('System Prompt has been changed for this session only.', type='positive')
 
-    async def generate_sdxl():
-        """ Uses a local Automatic 1111 installation to create an SDXL image to image rendering """
-        # Start the processing timer
-        start_time = time.time()
-        timer_task = asyncio.create_task((update_timer(sdxl_stopwatch_label, start_time)))
-        file_path = None
+    async def wait_for_render(job):
+        """ Shows the progress of a scheduled job until it is done. Returns its result, None if it failed or was
+        cancelled """
+        sdxl_jobs.add(job)
+        sdxl_cancel_button.style('visibility: visible')
+        timer = watch_progress(sdxl_stopwatch_label, time.time(), job, preview_image=sdxl_image)
         try:
-            file_path = await run.io_bound(sdxl_agent.img2img, img2img_prompt=prompt_textarea.value,
-                                           counter=1,
-                                           image_path="nicegui_img2img.png",
-                                           image_url=flux_image_label.text,
-                                           adetailer=True
-                                           )
+            return await job.wait()
+        except asyncio.CancelledError:
+            ui.notify('SDXL render cancelled', type='warning')
         except Exception as e:
             ui.notify(f'Unable to get an image: {str(e)}', type='negative')
         finally:
-            timer_task.cancel()
-            if file_path:
-                sdxl_image.source = file_path
-            else:
-                ui.notify('No valid file path returned to display', type='negative')
-
-
+            progress_poller.unwatch(timer)
+            sdxl_jobs.discard(job)
+            if not sdxl_jobs:
+                sdxl_cancel_button.style('visibility: hidden')
+        return None
 
-
-
-    prompts = []
-    flux_agent = FluxAgent()
-    prompt_agent = PromptAgent(local=True)
-    review_agent = ReviewAgent()
-    sdxl_agent = SDXLAgent()
-    tokenizer = Tokenizer()
-    flux_image_urls = []
+    async def generate_sdxl():
+        """ Uses a local Automatic 1111 installation to create an SDXL image to image rendering """
+        nonlocal sdxl_render_path
+        # The local copy outlives the remote url, counter 1 would download image_url instead of reading image_path
+        local_path = image_store.local_path(flux_image_label.text)
+        # Renders wait their turn in the shared scheduler so every session gets a fair share of the GPUs
+        job = render_scheduler.submit(session.id, sdxl_agent.async_img2img,
+                                      img2img_prompt=prompt_textarea.value,
+                                      counter=1 if local_path is None else 2,
+                                      image_path=local_path or "nicegui_img2img.png",
+                                      image_url=flux_image_label.text,
+                                      adetailer=True,
+                                      batch_size=sdxl_variations.value,
+                                      priority=PRIORITY_RENDER)
+        file_paths = await wait_for_render(job)
+        if file_paths:
+            sdxl_render_path = file_paths[0]
+            sdxl_image.source = image_store.url_for(file_paths[0])
+            show_sdxl_variations(file_paths)
+            sdxl_upscale_button.style('visibility: visible')
+        elif job.state != job.CANCELLED:
+            ui.notify('No valid file path returned to display', type='negative')
+
+    async def preview_sdxl():
+        """ A quick text to image rendering of the prompt, ahead of every render and upscale in the queue """
+        job = render_scheduler.submit(session.id, sdxl_agent.async_txt2img,
+                                      prompt=prompt_textarea.value,
+                                      id=f'_preview_{session.id}',
+                                      hires=False,
+                                      adetailer=False,
+                                      controlnet=False,
+                                      image_url=None,
+                                      priority=PRIORITY_PREVIEW)
+        file_paths = await wait_for_render(job)
+        if file_paths:
+            sdxl_image.source = image_store.url_for(file_paths[0])
+
+    async def upscale_sdxl():
+        """ 4x upscale of the last render, a tile at a time over every A1111 server. It waits behind previews and
+        renders, then the bar fills as the tiles come back """
+        def show_tiles(done, total):
+            sdxl_upscale_progress.set_value(done / total)
+
+        sdxl_upscale_progress.set_value(0)
+        sdxl_upscale_progress.set_visibility(True)
+        job = render_scheduler.submit(session.id, sdxl_agent.async_upscale_tiled, sdxl_render_path,
+                                      progress=show_tiles, priority=PRIORITY_UPSCALE)
+        try:
+            path = await wait_for_render(job)
+        finally:
+            sdxl_upscale_progress.set_visibility(False)
+        if path:
+            sdxl_image.source = image_store.url_for(path)
+            sdxl_variations_grid.clear()
+
+    def show_sdxl_variations(file_paths):
+        """ Thumbnails of every image in a batch, clicking one shows it large """
+        sdxl_variations_grid.clear()
+        if len(file_paths) < 2:
+            return
+        with sdxl_variations_grid:
+            for file_path in file_paths:
+                url = image_store.url_for(file_path)
+                ui.image(url).style('width: 120px; cursor: pointer').on('click',
+                                                                        lambda url=url: sdxl_image.set_source(url))
+
+    def cancel_sdxl():
+        for job in list(sdxl_jobs):
+            render_scheduler.cancel(job)
+
+    def close_page():
+        """ Called once the browser is gone for good (NiceGUI waits for it to reconnect first) """
+        if session.clip_speculation is not None:
+            prompt_agent.release_clip_speculation(session.clip_speculation)
+            session.clip_speculation = None
+        open_pages[session.id] -= 1
+        if open_pages[session.id] > 0:
+            # Other tabs of the session keep their jobs
+            cancel_sdxl()
+            return
+        del open_pages[session.id]
+        # Nobody is left to see what the session has queued or rendering
+        render_scheduler.cancel_session(session.id)
+
+
+    flux_agent = agent_pool.flux
+    prompt_agent = agent_pool.prompt
+    review_agent = agent_pool.review
+    sdxl_agent = agent_pool.sdxl
+    tokenizer = agent_pool.tokenizer
+    image_store = agent_pool.image_store
+    sequence_length_counter = SequenceLengthCounter(tokenizer)
+    prompt_compressor = PromptCompressor(tokenizer)
+    # Keyed by the browser's signed cookie, so a reload, another tab or another worker carries on the session
+    session = Session.load(agent_pool.sessions, app.storage.browser['id'],
+                           t5_system_prompt=prompt_agent.t5_system_prompt)
+    flux_image_urls = session.flux_image_urls
+    # The local copies of a returning session's images, whichever worker fetched them
+    for url, digest in session.image_digests.items():
+        image_store.remember(url, digest)
+    render_scheduler = agent_pool.render_scheduler
+    progress_poller = agent_pool.progress_poller
+    open_pages[session.id] += 1
+    ui.context.client.on_disconnect(close_page)
+    sdxl_jobs = set()
+    # Last SDXL rendering, what the upscale button upscales
+    sdxl_render_path = None
+    flux_tasks = set()
+    # flux_image_urls index -> carousel slide, for the slides currently in the page
+    live_slides = {}
+    # Slides brought back with 'load older', on top of MAX_LIVE_SLIDES
+    loaded_older = 0
     animation_media = ['Cut-Out', 'Claymation', 'Cel', 'Computer', 'Stop Motion', '3D Pixar', '3D', 'Simpsons']
     photograph_media = ['Film', 'Digital']
     drawing_media = ['Brush', 'Finger', 'Pen', 'Ballpoint Pen', 'Eraser', 'Fountain Pen', 'Technical Pen', 'Marker',
@@ -273,7 +631,14 @@ def main():
             with ui.row():
                 ui.button('get a prompt', on_click=generate_prompts)
                 ui.button('edit system prompt', on_click=open_system_prompt_dialog, icon="settings").props('outline')
-            prompt_textarea = ui.textarea('Embellished Prompt',
+                # Identical requests are answered from the response cache unless the user asks for variety
+                bypass_cache = ui.checkbox('bypass cache').tooltip('Always ask the LLM for a fresh answer')
+                prompt_candidate_count = ui.select([1, 3, 5], value=1, label='Candidates').style(
+                    'width: 100px').tooltip('Ask for several prompts at once and keep the best')
+            prompt_candidates = ui.select([], label='Other candidates',
+                                          on_change=choose_prompt_candidate).style('width:75%')
+            prompt_candidates.set_visibility(False)
+            prompt_textarea = ui.textarea('Embellished Prompt', value=session.prompts[-1] if session.prompts else '',
                                           on_change=lambda e: update_sequence_length()).props('autogrow').style(
                 'width:75%;')
 
@@ -281,6 +646,8 @@ def main():
             with ui.row():
                 ui.button('shrink prompt', on_click=shrink_prompt)
                 flux_generate_button = ui.button('generate image', on_click=generate_image)
+                flux_cancel_button = ui.button('cancel', on_click=cancel_flux).props('outline').style(
+                    'visibility: hidden')
 
 
         with ui.column().classes('w-1/2 pt-10'):
@@ -294,6 +661,7 @@ def main():
                 review_button = ui.button('rate image', on_click=review_image).style('visibility: hidden')
                 sdxl_button = ui.button('SDXL', on_click=sdxl_dialog_manager).style('visibility: hidden')
                 flux_button = ui.button('send to flux dev', on_click=generate_image_flux_dev).style('visibility: hidden')
+                load_older_button = ui.button('load older', on_click=load_older).props('outline').style('visibility: hidden')
                 flux_image_label = ui.label().style('visibility: hidden')
 
     with ui.dialog() as review_dialog, ui.card().style('width:50%; max-width: none') as review_card:
@@ -308,7 +676,15 @@ def main():
         sdxl_clip_prompt = ui.textarea().props('autogrow').style('width: 100%')
         ui.button('Get CLIP', on_click=generate_clip_prompt).style('visibility: visible')
         sdxl_image = ui.image().style('height: 60%')
-        sdxl_go_button = ui.button('go', on_click=generate_sdxl).style('visibility: visible')
+        sdxl_upscale_progress = ui.linear_progress(value=0, show_value=False)
+        sdxl_upscale_progress.set_visibility(False)
+        sdxl_variations_grid = ui.row()
+        with ui.row():
+            sdxl_variations = ui.select([1, 2, 4], value=1, label='Variations').style('width: 100px')
+            ui.button('preview', on_click=preview_sdxl).props('outline')
+            sdxl_go_button = ui.button('go', on_click=generate_sdxl).style('visibility: visible')
+            sdxl_upscale_button = ui.button('upscale', on_click=upscale_sdxl).style('visibility: hidden')
+            sdxl_cancel_button = ui.button('cancel', on_click=cancel_sdxl).props('outline').style('visibility: hidden')
 
     with ui.dialog().props('maximized').classes('bg-black') as lightbox_dialog:
         with ui.row():
@@ -318,9 +694,20 @@ def main():
 
     with ui.dialog() as system_prompt_dialog, ui.card().style('width:50%; max-width: none'):
             ui.label('System Prompt').style('font-size: 18pt')
-            system_prompt = ui.textarea(value=prompt_agent.t5_system_prompt).props('autogrow').style('width:100%')
+            system_prompt = ui.textarea(value=session.t5_system_prompt).props('autogrow').style('width:100%')
             ui.button('update', on_click=update_system_prompt)
 
+    if flux_image_urls:
+        # A returning session gets its history back
+        update_carousel()
+        review_button.style('visibility: visible')
+        sdxl_button.style('visibility: visible')
+        flux_button.style('visibility: visible')
+
 
-ui.run(title='Prompt Glow')
+# The browser id cookie is signed with a secret every worker shares. Workers are only reached through the
+# multiworker.py proxy, which restarts them rather than have them reload
+ui.run(title='Prompt Glow', port=int(os.environ.get('PROMPTGLOW_PORT', 8080)),
+       host='127.0.0.1' if worker is not None else None,
+       storage_secret=agent_pool.sessions.secret(), reload=worker is None, show=worker is None)
 
@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import fake_backends
+import tracing
+
+# A result is flagged when it is this much worse than the baseline
+DEFAULT_TOLERANCE = 0.2
+USER_PROMPTS = ("a lighthouse in a storm", "an old fisherman mending nets", "a fox in fresh snow",
+                "a neon lit street market at night", "a cellist on an empty stage", "a greenhouse full of orchids")
+FLUX_MODEL = "black-forest-labs/flux-schnell"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Result:
+    """ What one scenario measured """
+
+    def __init__(self, scenario, concurrency, latencies, errors, seconds, peak_rss_bytes):
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.seconds = seconds
+        self.peak_rss_bytes = peak_rss_bytes
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / self.seconds if self.seconds else 0.0
+
+    def percentile(self, quantile):
+        # Nearest rank
+        if not self.latencies:
+            return None
+        return self.latencies[min(len(self.latencies) - 1, max(0, int(round(quantile * len(self.latencies))) - 1))]
+
+    def to_dict(self):
+        return {"scenario": self.scenario, "concurrency": self.concurrency, "requests": len(self.latencies),
+                "errors": self.errors, "seconds": self.seconds, "throughput": self.throughput,
+                "p50": self.percentile(0.5), "p95": self.percentile(0.95), "p99": self.percentile(0.99),
+                "max": self.latencies[-1] if self.latencies else None, "peak_rss_bytes": self.peak_rss_bytes}
+
+    def describe(self):
+        if not self.latencies:
+            return f"{self.scenario:<10} c={self.concurrency:<3} no successful requests, {self.errors} errors"
+        return (f"{self.scenario:<10} c={self.concurrency:<3} {len(self.latencies)} ok {self.errors} err  "
+                f"{self.throughput:8.2f}/s  p50 {self.percentile(0.5) * 1000:8.1f} ms  "
+                f"p95 {self.percentile(0.95) * 1000:8.1f} ms  p99 {self.percentile(0.99) * 1000:8.1f} ms  "
+                f"peak RSS {self.peak_rss_bytes / 2 ** 20:7.1f} MiB")
+
+
+def reset_peak_rss():
+    """ Starts this process's peak RSS afresh, so each scenario reports its own. Only Linux can, elsewhere
+    peak_rss_bytes stays the peak since the process started """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    if who == resource.RUSAGE_SELF:
+        # Unlike ru_maxrss VmHWM follows reset_peak_rss
+        try:
+            with open('/proc/self/status') as file:
+                for line in file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+async def drive(call, requests, concurrency):
+    """ Runs call(index) requests times with at most concurrency calls in flight.
+    Returns the latencies of the calls that succeeded, the number that failed and the wall time """
+    indices = iter(range(requests))
+    latencies = []
+    errors = []
+
+    async def worker():
+        for index in indices:
+            start = time.perf_counter()
+            try:
+                await call(index)
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    if errors:
+        print(f"  first error: {errors[0]!r}", file=sys.stderr)
+    return latencies, len(errors), time.perf_counter() - start
+
+
+def start_fakes(args):
+    """ Runs fake_backends.py in its own process so its memory and CPU aren't counted here.
+    Returns the process and the environment pointing at it """
+    command = [sys.executable, os.path.join(HERE, "fake_backends.py"), "--json",
+               "--a1111-servers", str(args.a1111_servers), "--llm-latency", str(args.llm_latency),
+               "--a1111-latency", str(args.a1111_latency), "--replicate-latency", str(args.replicate_latency),
+               "--jitter", str(args.jitter), "--reply-words", str(args.reply_words),
+               "--word-delay", str(args.word_delay), "--image-size", str(args.image_size)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return process, json.loads(process.stdout.readline())
+
+
+def user_prompt(index):
+    # Unique per request so nothing is answered from a cache or coalesced
+    return f"{USER_PROMPTS[index % len(USER_PROMPTS)]}, variation {index}"
+
+
+def agent_scenarios(agent_pool, args, review_url):
+    """ scenario name -> call(index) driving one agent method the way the app does, under the pool's limits """
+    from pipeline import Pipeline
+
+    async def prompt(index):
+        async with agent_pool.limit('llm'):
+            await agent_pool.prompt.async_generate_prompt("Photograph", "Digital", user_prompt(index),
+                                                          bypass_cache=True)
+
+    async def stream(index):
+        messages = agent_pool.prompt.prompt_messages("Photograph", "Digital", user_prompt(index))
+        async with agent_pool.limit('llm'):
+            async for _ in agent_pool.prompt.stream_message(messages, bypass_cache=True):
+                pass
+
+    async def review(index):
+        async with agent_pool.limit('vision'):
+            await agent_pool.review.async_review_image(f"{review_url}?{index}", bypass_cache=True)
+
+    async def flux(index):
+        async with agent_pool.limit('replicate'):
+            await agent_pool.flux.async_generate_image(model=FLUX_MODEL, prompt=user_prompt(index), steps=4,
+                                                       controlnet=False, image_url=None)
+
+    async def sdxl(index):
+        async with agent_pool.limit('a1111'):
+            await agent_pool.sdxl.async_txt2img(prompt=user_prompt(index), id=f'_bench_{index}', hires=False,
+                                                adetailer=False, controlnet=False, image_url=None,
+                                                batch_size=args.batch_size)
+
+    async def upscale(index):
+        async with agent_pool.limit('a1111'):
+            await agent_pool.sdxl.async_upscale_tiled(source_path, tile_size=args.tile_size,
+                                                      output_path=f'images/bench_upscaled_{index}.png')
+
+    async def pipeline(index):
+        # One user prompt through every stage: prompt, flux and sdxl renders, review and upscaling
+        items = await Pipeline(agent_pool, "Photograph", "Digital", backends=("flux", "sdxl"), review=True,
+                               upscale=True, upscale_tile_size=args.tile_size).run([user_prompt(index)])
+        failed = [item.error for item in items if item.error]
+        if failed:
+            raise Exception(failed[0])
+
+    source_path = 'images/bench_source.png'
+    return {"prompt": prompt, "stream": stream, "review": review, "flux": flux, "sdxl": sdxl, "upscale": upscale,
+            "pipeline": pipeline}
+
+
+async def run_agents(args, scenarios, env):
+    """ Drives the agents in this process against the fakes """
+    # The agents read their endpoints from the environment when they are imported and built
+    os.environ.update(env)
+    from agent_pool import AgentPool
+
+    agent_pool = AgentPool(local=True, cache_path=None, a1111_urls=env["A1111_URLS"].split(","))
+    os.makedirs('images', exist_ok=True)
+    with open('images/bench_source.png', 'wb') as file:
+        file.write(fake_backends.noise_png(args.image_size, args.image_size))
+    calls = agent_scenarios(agent_pool, args, f"{env['REPLICATE_BASE_URL']}/files/review.png")
+    results = []
+    try:
+        for scenario in scenarios:
+            reset_peak_rss()
+            latencies, errors, seconds = await drive(calls[scenario], args.requests, args.concurrency)
+            results.append(Result(scenario, args.concurrency, latencies, errors, seconds, peak_rss_bytes()))
+            print(results[-1].describe(), flush=True)
+    finally:
+        await agent_pool.aclose()
+    if args.spans:
+        # Where the time went, per traced call
+        print(tracing.tracer.render_metrics())
+    return results
+
+
+async def run_app(args, env):
+    """ Starts app.py against the fakes and loads its page (every load builds the whole UI and a session) """
+    port = args.app_port
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, "app.py")], cwd=os.getcwd(),
+                               env=dict(os.environ, **env, PROMPTGLOW_PORT=str(port)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            deadline = time.time() + 60
+            while True:
+                try:
+                    (await client.get('/metrics')).raise_for_status()
+                    break
+                except httpx.HTTPError:
+                    if time.time() > deadline or process.poll() is not None:
+                        raise RuntimeError("app.py did not start")
+                    await asyncio.sleep(0.5)
+
+            async def page(index):
+                (await client.get('/')).raise_for_status()
+
+            latencies, errors, seconds = await drive(page, args.requests, args.concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+    # The app ran in a child process, its peak is only known once it has been waited for
+    result = Result("app", args.concurrency, latencies, errors, seconds, peak_rss_bytes(resource.RUSAGE_CHILDREN))
+    print(result.describe(), flush=True)
+    return result
+
+
+def compare(results, baseline_path, tolerance):
+    """ Regressions against a previous --output file: lower throughput or higher p95 beyond tolerance """
+    with open(baseline_path) as file:
+        baseline = {(entry["scenario"], entry["concurrency"]): entry for entry in map(json.loads, file)}
+    regressions = []
+    for result in results:
+        before = baseline.get((result.scenario, result.concurrency))
+        now = result.to_dict()
+        if before is None or not now["requests"]:
+            continue
+        if before["throughput"] and now["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result.scenario}: throughput {before['throughput']:.2f}/s -> "
+                               f"{now['throughput']:.2f}/s")
+        if before["p95"] and now["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{result.scenario}: p95 {before['p95'] * 1000:.1f} ms -> {now['p95'] * 1000:.1f} ms")
+        if before["peak_rss_bytes"] and now["peak_rss_bytes"] > before["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(f"{result.scenario}: peak RSS {before['peak_rss_bytes'] / 2 ** 20:.1f} MiB -> "
+                               f"{now['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+    return regressions
+
+
+async def _main(args):
+    scenarios = args.scenario or ["prompt", "stream", "review", "flux", "sdxl", "upscale"]
+    # Paths given on the command line are relative to where the benchmark was started, not the scratch directory
+    for name in ("output", "baseline", "workdir"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    fakes, env = start_fakes(args)
+    # Renders and upscales land in a scratch directory, not next to the real images
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="promptglow-bench-"))
+    try:
+        results = []
+        agent_scenario_names = [scenario for scenario in scenarios if scenario != "app"]
+        if agent_scenario_names:
+            results += await run_agents(args, agent_scenario_names, env)
+        if "app" in scenarios:
+            results.append(await run_app(args, env))
+    finally:
+        fakes.terminate()
+        fakes.wait()
+    if args.output:
+        with open(args.output, 'a') as file:
+            for result in results:
+                file.write(json.dumps(result.to_dict()) + "\n")
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the agents, the pipeline and the app against local fakes "
+                                                 "of every backend (see fake_backends.py)")
+    parser.add_argument("--scenario", action="append",
+                        choices=["prompt", "stream", "review", "flux", "sdxl", "upscale", "pipeline", "app"],
+                        help="may be given more than once, defaults to every agent scenario")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1, help="images per sdxl request")
+    parser.add_argument("--tile-size", type=int, default=512, help="tile size of the upscale scenario")
+    parser.add_argument("--app-port", type=int, default=8199)
+    parser.add_argument("--workdir", help="where images are written, a new temporary directory by default")
+    parser.add_argument("--spans", action="store_true", help="also print the traced calls of the agent scenarios")
+    parser.add_argument("--output", help="append the results to this JSONL file")
+    parser.add_argument("--baseline", help="JSONL file of an earlier run, exit with 1 on regressions against it")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    fake_backends.add_arguments(parser)
+    # Faster than real backends so a run takes seconds, the harness is after the overhead of this code
+    parser.set_defaults(llm_latency=0.05, a1111_latency=0.2, replicate_latency=0.2, image_size=512)
+    asyncio.run(_main(parser.parse_args()))
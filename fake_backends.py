@@ -0,0 +1,399 @@
+import argparse
+import base64
+import functools
+import io
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Stand-ins for LM Studio / Together, Automatic 1111 and Replicate so the agents, the pipeline and the app can be
+# run and benchmarked offline. Latencies are in seconds, each request takes latency +- jitter
+DEFAULT_LLM_LATENCY = 0.2
+DEFAULT_A1111_LATENCY = 2.0
+DEFAULT_REPLICATE_LATENCY = 1.5
+DEFAULT_JITTER = 0.2
+# Words in each LLM answer, and the delay between streamed words
+DEFAULT_REPLY_WORDS = 60
+DEFAULT_WORD_DELAY = 0.005
+# Size of generated images. They are noise, so PNG can't compress them and payloads are realistically large
+DEFAULT_IMAGE_SIZE = 1024
+WORDS = ("portrait", "soft", "light", "golden", "hour", "cinematic", "detailed", "texture", "shallow", "depth",
+         "of", "field", "moody", "color", "grading", "wide", "angle", "film", "grain", "backlit", "mist", "ornate")
+
+
+@functools.lru_cache(maxsize=16)
+def noise_png(width, height):
+    """ PNG bytes of random noise, made once per size """
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=16)
+def noise_png_base64(width, height):
+    return base64.b64encode(noise_png(width, height)).decode("ascii")
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """ Hands every request to the route of the FakeBackend serving it """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        """ The request body, de-chunked: the agents stream their uploads with chunked transfer encoding """
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def send_json(self, value, status=200):
+        self.send_bytes(json.dumps(value).encode("utf-8"), "application/json", status)
+
+    def send_bytes(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self):
+        backend = self.server.backend
+        backend.requests += 1
+        path = self.path.split("?", 1)[0]
+        body = self.read_body() if self.command == "POST" else b""
+        for method, pattern, route in backend.routes:
+            match = pattern.fullmatch(path)
+            if method == self.command and match:
+                try:
+                    route(self, body, *match.groups())
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up, e.g. a hedged request that lost the race
+                    pass
+                return
+        self.send_json({"error": f"no route for {self.command} {path}"}, 404)
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+
+
+class FakeBackend:
+    """ A threaded HTTP server answering like a real backend after a configurable delay.
+    start() serves on a background thread (port 0 picks a free one), url is where it listens """
+
+    def __init__(self, latency, jitter=DEFAULT_JITTER):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.routes = []
+        self.server = None
+
+    def route(self, method, pattern, handler):
+        self.routes.append((method, re.compile(pattern), handler))
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter) * self.latency)
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.backend = self
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start() if self.server is None else self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeLLM(FakeBackend):
+    """ OpenAI compatible /v1/chat/completions, streamed or not, as served by LM Studio and Together.
+    Answers are reply_words random words, the vision review goes through the same endpoint """
+
+    def __init__(self, latency=DEFAULT_LLM_LATENCY, jitter=DEFAULT_JITTER, reply_words=DEFAULT_REPLY_WORDS,
+                 word_delay=DEFAULT_WORD_DELAY):
+        super().__init__(latency, jitter)
+        self.reply_words = reply_words
+        self.word_delay = word_delay
+        self.route("POST", r"/v1/chat/completions", self.chat_completions)
+        self.route("GET", r"/v1/models", self.models)
+
+    def reply(self):
+        return " ".join(random.choice(WORDS) for _ in range(self.reply_words))
+
+    @staticmethod
+    def _usage(request, words):
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in request.get("messages", []))
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": words, "total_tokens": prompt_tokens + words}
+
+    def chat_completions(self, handler, body):
+        request = json.loads(body or b"{}")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {"id": completion_id, "created": int(time.time()), "model": request.get("model", "fake")}
+        time.sleep(self.delay())
+        if not request.get("stream"):
+            handler.send_json(dict(base, object="chat.completion", choices=[
+                {"index": 0, "finish_reason": "stop", "logprobs": None,
+                 "message": {"role": "assistant", "content": self.reply()}}],
+                usage=self._usage(request, self.reply_words)))
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send_event(data):
+            event = f"data: {data}\n\n".encode("utf-8")
+            handler.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+            handler.wfile.flush()
+
+        words = self.reply().split(" ")
+        for index, word in enumerate(words):
+            delta = {"content": word if index == 0 else " " + word}
+            if index == 0:
+                delta["role"] = "assistant"
+            send_event(json.dumps(dict(base, object="chat.completion.chunk",
+                                       choices=[{"index": 0, "delta": delta, "finish_reason": None}])))
+            time.sleep(self.word_delay)
+        send_event(json.dumps(dict(base, object="chat.completion.chunk",
+                                   choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                                   usage=self._usage(request, len(words)))))
+        send_event("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+
+    def models(self, handler, body):
+        handler.send_json({"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "fake"}]})
+
+
+class FakeA1111(FakeBackend):
+    """ Automatic 1111's txt2img, img2img, extra-single-image, progress and ping endpoints.
+    Renders are image_size noise, batch_size * n_iter of them; upscales are the input size times the scale """
+
+    def __init__(self, latency=DEFAULT_A1111_LATENCY, jitter=DEFAULT_JITTER, image_size=DEFAULT_IMAGE_SIZE,
+                 upscale_latency=None):
+        super().__init__(latency, jitter)
+        self.image_size = image_size
+        # Upscaling takes a fraction of a render unless set
+        self.upscale_latency = latency / 4 if upscale_latency is None else upscale_latency
+        self._lock = threading.Lock()
+        # start time -> expected duration of each request being served
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self.route("POST", r"/sdapi/v1/(txt2img|img2img)", self.render)
+        self.route("POST", r"/sdapi/v1/extra-single-image", self.upscale)
+        self.route("GET", r"/sdapi/v1/progress", self.progress)
+        self.route("GET", r"/internal/ping", lambda handler, body: handler.send_json({}))
+
+    def _work(self, seconds):
+        job_id = next(self._job_ids)
+        with self._lock:
+            self._jobs[job_id] = (time.time(), seconds)
+        try:
+            time.sleep(seconds)
+        finally:
+            with self._lock:
+                self._jobs.pop(job_id)
+
+    def render(self, handler, body, endpoint):
+        request = json.loads(body or b"{}")
+        count = request.get("batch_size", 1) * request.get("n_iter", 1)
+        width = request.get("width") or self.image_size
+        height = request.get("height") or self.image_size
+        self._work(self.delay())
+        images = [noise_png_base64(width, height)] * count
+        handler.send_json({"images": images, "parameters": request, "info": json.dumps({"seed": request.get("seed")})})
+
+    def upscale(self, handler, body):
+        request = json.loads(body or b"{}")
+        scale = request.get("upscaling_resize", 4)
+        with Image.open(io.BytesIO(base64.b64decode(request.get("image", "")))) as image:
+            width, height = image.size
+        self._work(max(0.0, self.upscale_latency + random.uniform(-self.jitter, self.jitter) * self.upscale_latency))
+        handler.send_json({"image": noise_png_base64(int(width * scale), int(height * scale)), "html_info": ""})
+
+    def progress(self, handler, body):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if not jobs:
+            handler.send_json({"progress": 0, "eta_relative": 0, "state": {"job_count": 0}, "current_image": None})
+            return
+        start, seconds = min(jobs)
+        fraction = min(1.0, (time.time() - start) / seconds) if seconds else 1.0
+        steps = 30
+        handler.send_json({"progress": fraction, "eta_relative": max(0.0, start + seconds - time.time()),
+                           "state": {"job_count": len(jobs), "sampling_step": int(fraction * steps),
+                                     "sampling_steps": steps},
+                           "current_image": noise_png_base64(64, 64)})
+
+
+class FakeReplicate(FakeBackend):
+    """ Replicate's predictions API (create by model or version, get, cancel) and the output files.
+    A prediction succeeds latency seconds after it is created with num_outputs image_size PNG urls """
+
+    def __init__(self, latency=DEFAULT_REPLICATE_LATENCY, jitter=DEFAULT_JITTER, image_size=DEFAULT_IMAGE_SIZE):
+        super().__init__(latency, jitter)
+        self.image_size = image_size
+        self._lock = threading.Lock()
+        self._predictions = {}
+        self.route("POST", r"/v1/models/([^/]+/[^/]+)/predictions", self.create_for_model)
+        self.route("POST", r"/v1/predictions", self.create)
+        self.route("GET", r"/v1/predictions/([^/]+)", self.get)
+        self.route("POST", r"/v1/predictions/([^/]+)/cancel", self.cancel)
+        self.route("GET", r"/files/([^/]+)\.png", self.file)
+
+    def _prediction(self, prediction_id):
+        """ The prediction as the API reports it now """
+        with self._lock:
+            record = self._predictions[prediction_id]
+        prediction = dict(record["prediction"])
+        if prediction["status"] == "starting" and time.time() >= record["done_at"]:
+            outputs = record["input"].get("num_outputs", 1)
+            prediction.update(status="succeeded", completed_at=_timestamp(time.time()),
+                              output=[f"{self.url}/files/{prediction_id}-{index}.png" for index in range(outputs)],
+                              metrics={"predict_time": record["done_at"] - record["created"]})
+            with self._lock:
+                record["prediction"] = prediction
+        elif prediction["status"] == "starting" and time.time() >= record["created"] + 0.1:
+            prediction["status"] = "processing"
+        return prediction
+
+    def _create(self, handler, body, model, version):
+        request = json.loads(body or b"{}")
+        prediction_id = uuid.uuid4().hex[:26]
+        now = time.time()
+        prediction = {"id": prediction_id, "model": model, "version": version or "", "status": "starting",
+                      "input": request.get("input", {}), "output": None, "error": None, "logs": "",
+                      "metrics": {}, "created_at": _timestamp(now), "started_at": _timestamp(now),
+                      "completed_at": None,
+                      "urls": {"get": f"{self.url}/v1/predictions/{prediction_id}",
+                               "cancel": f"{self.url}/v1/predictions/{prediction_id}/cancel"}}
+        with self._lock:
+            self._predictions[prediction_id] = {"prediction": prediction, "input": prediction["input"],
+                                                "created": now, "done_at": now + self.delay()}
+        wait = re.match(r"wait(?:=(\d+))?", handler.headers.get("Prefer", ""))
+        if wait:
+            # Prefer: wait holds the response until the prediction is done (or the given seconds pass)
+            with self._lock:
+                done_at = self._predictions[prediction_id]["done_at"]
+            time.sleep(max(0.0, min(done_at - time.time(), float(wait.group(1) or 60))))
+        handler.send_json(self._prediction(prediction_id), 201)
+
+    def create_for_model(self, handler, body, model):
+        self._create(handler, body, model, None)
+
+    def create(self, handler, body):
+        self._create(handler, body, "fake/model", json.loads(body or b"{}").get("version"))
+
+    def get(self, handler, body, prediction_id):
+        if prediction_id not in self._predictions:
+            handler.send_json({"detail": "Not found."}, 404)
+            return
+        handler.send_json(self._prediction(prediction_id))
+
+    def cancel(self, handler, body, prediction_id):
+        if prediction_id not in self._predictions:
+            handler.send_json({"detail": "Not found."}, 404)
+            return
+        prediction = self._prediction(prediction_id)
+        if prediction["status"] not in ("succeeded", "failed", "canceled"):
+            prediction["status"] = "canceled"
+            with self._lock:
+                self._predictions[prediction_id]["prediction"] = prediction
+        handler.send_json(prediction)
+
+    def file(self, handler, body, name):
+        handler.send_bytes(noise_png(self.image_size, self.image_size), "image/png")
+
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + f".{int(seconds % 1 * 1e6):06d}Z"
+
+
+def environment(llm, a1111_list, replicate):
+    """ Environment variables pointing the agents (and app.py) at the fakes """
+    return {
+        "LM_STUDIO_URL": f"{llm.url}/v1",
+        "TOGETHER_BASE_URL": f"{llm.url}/v1",
+        "TOGETHER_AI_KEY": "fake",
+        "TOGETHER_API_KEY": "fake",
+        "REPLICATE_BASE_URL": replicate.url,
+        "REPLICATE_API_TOKEN": "fake",
+        "A1111_URLS": ",".join(a1111.url for a1111 in a1111_list),
+    }
+
+
+def start_all(args):
+    """ Starts every fake described by the command line arguments, returns (llm, [a1111...], replicate) """
+    llm = FakeLLM(latency=args.llm_latency, jitter=args.jitter, reply_words=args.reply_words,
+                  word_delay=args.word_delay).start(args.host, args.llm_port)
+    a1111_list = [FakeA1111(latency=args.a1111_latency, jitter=args.jitter, image_size=args.image_size)
+                  .start(args.host, args.a1111_port + index if args.a1111_port else 0)
+                  for index in range(args.a1111_servers)]
+    replicate = FakeReplicate(latency=args.replicate_latency, jitter=args.jitter,
+                              image_size=args.image_size).start(args.host, args.replicate_port)
+    return llm, a1111_list, replicate
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--llm-port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--a1111-port", type=int, default=0, help="first port, the next servers count up from it")
+    parser.add_argument("--replicate-port", type=int, default=0)
+    parser.add_argument("--a1111-servers", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=DEFAULT_LLM_LATENCY)
+    parser.add_argument("--a1111-latency", type=float, default=DEFAULT_A1111_LATENCY)
+    parser.add_argument("--replicate-latency", type=float, default=DEFAULT_REPLICATE_LATENCY)
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER, help="share of the latency added or removed")
+    parser.add_argument("--reply-words", type=int, default=DEFAULT_REPLY_WORDS)
+    parser.add_argument("--word-delay", type=float, default=DEFAULT_WORD_DELAY)
+    parser.add_argument("--image-size", type=int, default=DEFAULT_IMAGE_SIZE, help="width and height of images")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve stand-ins for the LLM, Automatic 1111 and Replicate APIs")
+    add_arguments(parser)
+    parser.add_argument("--json", action="store_true", help="print the environment as one JSON line")
+    args = parser.parse_args()
+    llm, a1111_list, replicate = start_all(args)
+    env = environment(llm, a1111_list, replicate)
+    if args.json:
+        print(json.dumps(env), flush=True)
+    else:
+        for name, value in env.items():
+            print(f"export {name}={value}")
+        print("# then run app.py, pipeline.py or benchmark.py with these set", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
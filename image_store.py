@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+
+import httpx
+from PIL import Image
+from starlette.responses import FileResponse, Response
+
+IMAGES_DIR = "images"
+# Content addressed files never change, so browsers may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=0, must-revalidate"
+
+
+class ImageStore:
+    """ Content addressed local copies of generated images.
+    Each image is stored once as images/store/<sha256>.<ext> with a small WebP thumbnail beside it for the
+    carousel. Remote results are downloaded only once however many sessions show them.
+    """
+
+    def __init__(self, root=os.path.join(IMAGES_DIR, "store"), thumbnail_size=640):
+        self.root = root
+        self.thumbnail_root = os.path.join(root, "thumbs")
+        self.thumbnail_size = thumbnail_size
+        os.makedirs(self.thumbnail_root, exist_ok=True)
+        # remote url -> digest of what was downloaded from it
+        self._digests = {}
+        # remote url -> download task, so concurrent requests for the same url share one fetch
+        self._downloads = {}
+        self._http_client = None
+
+    def path(self, digest, extension="png"):
+        return os.path.join(self.root, f"{digest}.{extension}")
+
+    def thumbnail_path(self, digest):
+        return os.path.join(self.thumbnail_root, f"{digest}.webp")
+
+    @staticmethod
+    def url_for(path):
+        """ Url a file below the images directory is served at """
+        return "/" + os.path.relpath(path).replace(os.sep, "/")
+
+    def put_bytes(self, data, extension="png"):
+        """ Stores the image (if it isn't already) and returns its digest """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest, extension)
+        if not os.path.exists(path):
+            # Write then rename so a half written file is never served
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        if not os.path.exists(self.thumbnail_path(digest)):
+            self.make_thumbnail(io.BytesIO(data), digest)
+        return digest
+
+    def open_temporary(self):
+        """ Open binary file inside the store to write an image into, hand its name to commit when done """
+        return tempfile.NamedTemporaryFile(dir=self.root, suffix=".tmp", delete=False)
+
+    def commit(self, temporary_path, extension="png"):
+        """ Moves a file written via open_temporary to its content address and returns the stored path.
+        The file is hashed from disk in chunks so it is never loaded whole """
+        sha256 = hashlib.sha256()
+        with open(temporary_path, "rb") as file:
+            while chunk := file.read(1024 * 1024):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        path = self.path(digest, extension)
+        if os.path.exists(path):
+            os.remove(temporary_path)
+        else:
+            os.replace(temporary_path, path)
+        if not os.path.exists(self.thumbnail_path(digest)):
+            self.make_thumbnail(path, digest)
+        return path
+
+    def make_thumbnail(self, image_file, digest):
+        """ Writes the WebP thumbnail of image_file (a path or binary file object) """
+        image = Image.open(image_file)
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        temp_path = f"{self.thumbnail_path(digest)}.{os.getpid()}.tmp"
+        image.save(temp_path, format="WEBP", quality=80)
+        os.replace(temp_path, self.thumbnail_path(digest))
+
+    def digest_for(self, url):
+        """ Digest of a remote image that has already been fetched, otherwise None """
+        return self._digests.get(url)
+
+    def remember(self, url, digest):
+        """ Links a remote url to an image stored earlier, e.g. before a restart or by another worker.
+        Ignored when that image is no longer in the store """
+        if digest and os.path.exists(self.path(digest)):
+            self._digests[url] = digest
+
+    def local_path(self, url):
+        """ Path of the stored copy of a remote image, None if it isn't stored """
+        digest = self._digests.get(url)
+        return self.path(digest) if digest else None
+
+    def local_url(self, url):
+        """ Local url of a fetched remote image, or the remote url itself if it isn't stored """
+        digest = self._digests.get(url)
+        return self.url_for(self.path(digest)) if digest else url
+
+    def thumbnail_url(self, url):
+        digest = self._digests.get(url)
+        return self.url_for(self.thumbnail_path(digest)) if digest else url
+
+    async def fetch(self, url):
+        """ Downloads a remote image into the store once and returns its digest """
+        digest = self._digests.get(url)
+        if digest:
+            return digest
+        download = self._downloads.get(url)
+        if download is None:
+            download = asyncio.ensure_future(self._download(url))
+            self._downloads[url] = download
+            download.add_done_callback(lambda task: self._downloads.pop(url, None))
+        return await asyncio.shield(download)
+
+    async def _download(self, url):
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=5.0))
+        response = await self._http_client.get(url)
+        response.raise_for_status()
+        digest = await asyncio.to_thread(self.put_bytes, response.content)
+        self._digests[url] = digest
+        return digest
+
+    def serve(self, relative_path, if_none_match=None):
+        """ Response for a file below the images directory with an ETag and caching headers """
+        images_dir = os.path.realpath(IMAGES_DIR)
+        path = os.path.realpath(os.path.join(images_dir, relative_path))
+        if not path.startswith(images_dir + os.sep) or not os.path.isfile(path):
+            return Response(status_code=404)
+        if path.startswith(os.path.realpath(self.root) + os.sep):
+            etag = '"{}"'.format(os.path.splitext(os.path.basename(path))[0])
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            stat = os.stat(path)
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            cache_control = MUTABLE_CACHE_CONTROL
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        # Streamed from disk by starlette, never held in memory whole
+        return FileResponse(path, headers=headers)
+
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
@@ -0,0 +1,212 @@
+import asyncio
+import base64
+import binascii
+import json
+
+# Stands in for the base64 image inside a payload, it is swapped for the streamed encoding on the way out
+IMAGE_PLACEHOLDER = "__PROMPTGLOW_IMAGE__"
+# Multiple of 3 so every chunk base64 encodes without padding
+READ_SIZE = 3 * 64 * 1024
+
+
+def _rechunk(chunks):
+    """ Regroups byte chunks of any size into multiples of 3 bytes (bar the last) """
+    remainder = b""
+    for chunk in chunks:
+        data = remainder + chunk
+        cut = len(data) - len(data) % 3
+        remainder = data[cut:]
+        if cut:
+            yield data[:cut]
+    if remainder:
+        yield remainder
+
+
+def iter_file(path, read_size=READ_SIZE):
+    with open(path, "rb") as file:
+        while chunk := file.read(read_size):
+            yield chunk
+
+
+async def aiter_file(path, read_size=READ_SIZE):
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, read_size):
+            yield chunk
+
+
+class EncodedChunks:
+    """ An image that is already base64 encoded, passed as image_chunks so it goes out without encoding again """
+
+    def __init__(self, encoded, chunk_size=4 * READ_SIZE // 3):
+        self.encoded = encoded
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        view = memoryview(self.encoded)
+        for start in range(0, len(view), self.chunk_size):
+            yield bytes(view[start:start + self.chunk_size])
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+
+def _split_body(payload):
+    body = json.dumps(payload)
+    placeholder = json.dumps(IMAGE_PLACEHOLDER)
+    if placeholder not in body:
+        return body.encode("utf-8"), b""
+    prefix, suffix = body.split(placeholder, 1)
+    return (prefix + '"').encode("utf-8"), ('"' + suffix).encode("utf-8")
+
+
+def iter_json_body(payload, image_chunks=None):
+    """ Yields the json encoding of payload with IMAGE_PLACEHOLDER replaced by the base64 encoding of
+    image_chunks, encoded a chunk at a time so neither the image nor its encoding is ever held whole """
+    prefix, suffix = _split_body(payload)
+    yield prefix
+    if isinstance(image_chunks, EncodedChunks) and suffix:
+        yield from image_chunks
+        yield suffix
+    elif image_chunks is not None and suffix:
+        for chunk in _rechunk(image_chunks):
+            yield base64.b64encode(chunk)
+        yield suffix
+
+
+async def aiter_json_body(payload, image_chunks=None):
+    """ Async version of iter_json_body, image_chunks is an async iterator """
+    prefix, suffix = _split_body(payload)
+    yield prefix
+    if isinstance(image_chunks, EncodedChunks) and suffix:
+        for chunk in image_chunks:
+            yield chunk
+        yield suffix
+    elif image_chunks is not None and suffix:
+        remainder = b""
+        async for chunk in image_chunks:
+            data = remainder + chunk
+            cut = len(data) - len(data) % 3
+            remainder = data[cut:]
+            if cut:
+                yield base64.b64encode(data[:cut])
+        if remainder:
+            yield base64.b64encode(remainder)
+        yield suffix
+
+
+class Base64FieldWriter:
+    """ Incremental parser that finds the base64 string(s) under key in a streamed json response
+    (e.g. "images": ["...", "..."] or "image": "...") and decodes each straight into a file from open_output.
+    Nothing but the current chunk is held in memory.
+    """
+
+    SEARCHING, AFTER_KEY, BEFORE_VALUE, BEFORE_STRING, IN_STRING, AFTER_STRING, DONE = range(7)
+
+    def __init__(self, key, open_output):
+        self.token = json.dumps(key).encode("utf-8")
+        self.open_output = open_output
+        self.state = self.SEARCHING
+        self.in_array = False
+        self.outputs = []
+        self._file = None
+        self._tail = b""
+        self._pending = b""
+
+    def feed(self, chunk):
+        position = 0
+        while position < len(chunk) and self.state != self.DONE:
+            if self.state == self.SEARCHING:
+                data = self._tail + chunk[position:]
+                found = data.find(self.token)
+                if found < 0:
+                    # Keep enough to spot the key split across two chunks
+                    self._tail = data[-(len(self.token) - 1):]
+                    return
+                position = position + found + len(self.token) - len(self._tail)
+                self._tail = b""
+                self.state = self.AFTER_KEY
+                continue
+            byte = chunk[position:position + 1]
+            if self.state == self.AFTER_KEY:
+                if byte == b":":
+                    self.state = self.BEFORE_VALUE
+                elif not byte.isspace():
+                    # The same text as a value rather than a key, look further
+                    self.state = self.SEARCHING
+                    continue
+                position += 1
+            elif self.state == self.BEFORE_VALUE:
+                if byte == b"[":
+                    self.in_array = True
+                    self.state = self.BEFORE_STRING
+                elif byte == b'"':
+                    self._start_string()
+                elif not byte.isspace():
+                    # null or some other value, there is no image
+                    self.state = self.DONE
+                position += 1
+            elif self.state == self.BEFORE_STRING:
+                if byte == b'"':
+                    self._start_string()
+                elif byte == b"]":
+                    self.state = self.DONE
+                position += 1
+            elif self.state == self.IN_STRING:
+                end = chunk.find(b'"', position)
+                if end < 0:
+                    self._write(chunk[position:])
+                    return
+                self._write(chunk[position:end])
+                self._end_string()
+                position = end + 1
+            elif self.state == self.AFTER_STRING:
+                if byte == b",":
+                    self.state = self.BEFORE_STRING
+                elif byte == b"]":
+                    self.state = self.DONE
+                position += 1
+
+    def _start_string(self):
+        self._file = self.open_output(len(self.outputs))
+        self.state = self.IN_STRING
+
+    def _write(self, data):
+        # json may escape the slashes of base64, and chunks rarely end on a 4 character boundary
+        data = (self._pending + data).replace(b"\\/", b"/")
+        if data.endswith(b"\\"):
+            data, self._pending = data[:-1], b"\\"
+        else:
+            self._pending = b""
+        cut = len(data) - len(data) % 4
+        self._pending = data[cut:] + self._pending
+        if cut:
+            try:
+                self._file.write(base64.b64decode(data[:cut]))
+            except binascii.Error as e:
+                raise ValueError(f"Invalid base64 in response: {e}")
+
+    def _end_string(self):
+        if self._pending:
+            self._file.write(base64.b64decode(self._pending + b"=" * (-len(self._pending) % 4)))
+            self._pending = b""
+        self._file.close()
+        self.outputs.append(self._file.name)
+        self._file = None
+        self.state = self.AFTER_STRING if self.in_array else self.DONE
+
+    def close(self):
+        """ Returns the paths written, raises if the response ended before the field did """
+        if self._file is not None:
+            self._file.close()
+            raise ValueError("Response ended in the middle of an image")
+        return self.outputs
+
+    def abort(self):
+        """ Closes the file being written, if any, and returns the paths of every file opened, complete or not """
+        paths = list(self.outputs)
+        if self._file is not None:
+            self._file.close()
+            paths.append(self._file.name)
+            self._file = None
+        return paths
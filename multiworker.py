@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+import zlib
+
+# Set by each worker on its responses, the proxy sends the browser back to the worker that served its page
+WORKER_COOKIE = "promptglow_worker"
+WORKER_COOKIE_PATTERN = re.compile(rb"(?:^|[;\s])" + WORKER_COOKIE.encode("ascii") + rb"=(\d+)")
+# Names the worker in the query of requests that carry no cookie, i.e. Replicate's webhooks, see worker_url
+WORKER_PARAMETER = "worker"
+WORKER_QUERY_PATTERN = re.compile(rb"\S+ [^ ?]*\?(?:[^ #]*&)?" + WORKER_PARAMETER.encode("ascii") +
+                                  rb"=(\d+)(?:[& #]|\r?$)", re.MULTILINE)
+FIRST_WORKER_PORT = 8100
+# A worker that exits is started again after this many seconds, doubling while it keeps failing quickly
+RESTART_DELAY_SECONDS = 1.0
+MAX_RESTART_DELAY_SECONDS = 30.0
+# Largest request head the proxy reads to find the cookie
+MAX_HEAD_BYTES = 64 * 1024
+PIPE_CHUNK_SIZE = 64 * 1024
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def worker_url(url, index):
+    """ url with the worker index in its query, so the proxy sends requests to it on to that worker """
+    separator = "&" if urllib.parse.urlsplit(url).query else "?"
+    return f"{url}{separator}{WORKER_PARAMETER}={index}"
+
+
+class Worker:
+    """ One app.py process on its own port """
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.started = None
+        self.restart_delay = RESTART_DELAY_SECONDS
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+
+class MultiWorkerServer:
+    """ Runs several app.py workers behind one port.
+    NiceGUI keeps every open page (and its websocket) inside the process that rendered it, so the proxy is sticky:
+    a browser goes back to the worker named in its WORKER_COOKIE, and the first request of a new browser is placed
+    by a hash of its address. Webhooks go to the worker named in their url instead (see worker_url), only the
+    worker that started a prediction is waiting for it. Workers that exit are restarted; meanwhile their browsers are moved to another worker,
+    which rebuilds the page from the shared session store (see session_store.SessionStore).
+    """
+
+    def __init__(self, workers=None, host="0.0.0.0", port=8080, first_worker_port=FIRST_WORKER_PORT):
+        self.host = host
+        self.port = port
+        self.workers = [Worker(index, first_worker_port + index) for index in range(workers or os.cpu_count() or 1)]
+        self._server = None
+
+    def _spawn(self, worker):
+        worker.process = subprocess.Popen([sys.executable, os.path.join(HERE, "app.py")],
+                                          env=dict(os.environ, PROMPTGLOW_PORT=str(worker.port),
+                                                   PROMPTGLOW_WORKER=str(worker.index)))
+        worker.started = time.time()
+
+    async def _supervise(self):
+        while True:
+            for worker in self.workers:
+                if worker.alive or time.time() - worker.started < worker.restart_delay:
+                    continue
+                # Back off while a worker dies straight after starting, reset once it stayed up a while
+                if time.time() - worker.started < MAX_RESTART_DELAY_SECONDS:
+                    worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY_SECONDS)
+                else:
+                    worker.restart_delay = RESTART_DELAY_SECONDS
+                print(f"worker {worker.index} exited with {worker.process.returncode}, restarting", file=sys.stderr)
+                self._spawn(worker)
+            await asyncio.sleep(RESTART_DELAY_SECONDS)
+
+    def candidates(self, head, peer):
+        """ Workers to try for a connection, the sticky one first """
+        match = WORKER_QUERY_PATTERN.match(head) or WORKER_COOKIE_PATTERN.search(head)
+        if match and int(match.group(1)) < len(self.workers):
+            first = int(match.group(1))
+        else:
+            first = zlib.crc32(str(peer).encode("utf-8")) % len(self.workers)
+        return self.workers[first:] + self.workers[:first]
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            head = await client_reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            head = e.partial
+        except asyncio.LimitOverrunError:
+            head = await client_reader.read(MAX_HEAD_BYTES)
+        except ConnectionError:
+            client_writer.close()
+            return
+        peer = client_writer.get_extra_info("peername")
+        upstream = None
+        for worker in self.candidates(head, peer[0] if peer else None):
+            if not worker.alive:
+                continue
+            try:
+                upstream = await asyncio.open_connection("127.0.0.1", worker.port)
+                break
+            except OSError:
+                # Still starting up or on its way down
+                continue
+        if upstream is None:
+            client_writer.close()
+            return
+        upstream_reader, upstream_writer = upstream
+        upstream_writer.write(head)
+        await asyncio.gather(self._pipe(client_reader, upstream_writer), self._pipe(upstream_reader, client_writer))
+        for writer in (upstream_writer, client_writer):
+            writer.close()
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(PIPE_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
+
+    async def serve(self):
+        # Being terminated takes the workers down too, rather than leave them orphaned
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        for worker in self.workers:
+            self._spawn(worker)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_HEAD_BYTES)
+        print(f"{len(self.workers)} workers on ports {self.workers[0].port}-{self.workers[-1].port}, "
+              f"serving on http://{self.host}:{self.port}", file=sys.stderr)
+        try:
+            async with self._server:
+                await asyncio.gather(self._server.serve_forever(), self._supervise())
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run several app.py workers behind one port with sticky sessions")
+    parser.add_argument("--workers", type=int, help="defaults to the number of cores")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('PROMPTGLOW_PORT', 8080)))
+    parser.add_argument("--first-worker-port", type=int, default=FIRST_WORKER_PORT,
+                        help="workers listen on consecutive ports from here, on 127.0.0.1")
+    args = parser.parse_args()
+    try:
+        asyncio.run(MultiWorkerServer(args.workers, args.host, args.port, args.first_worker_port).serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
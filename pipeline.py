@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import time
+
+import image_transfer
+from agent_pool import AgentPool
+
+FLUX_MODEL = "black-forest-labs/flux-schnell"
+# Most outputs flux-schnell will return from a single prediction
+FLUX_MAX_OUTPUTS = 4
+# Tells the workers of a stage that nothing more is coming
+_DONE = object()
+
+
+class PipelineItem:
+    """ One image travelling through the pipeline, along with everything learnt about it on the way """
+
+    def __init__(self, user_prompt, prompt=None, backend=None):
+        self.user_prompt = user_prompt
+        self.prompt = prompt
+        self.backend = backend
+        self.image = None
+        self.review = None
+        self.upscaled = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "user_prompt": self.user_prompt,
+            "prompt": self.prompt,
+            "backend": self.backend,
+            "image": self.image,
+            "review": self.review,
+            "upscaled": self.upscaled,
+            "error": self.error,
+        }
+
+
+class Pipeline:
+    """ Headless batch mode: expands each user prompt with the PromptAgent, renders images_per_prompt images per
+    prompt on every backend (flux and/or sdxl), then optionally reviews and upscales them.
+    Stages are connected by bounded queues and each runs as many workers as its backend's limit in the
+    AgentPool, so every backend is kept busy without the earlier stages racing too far ahead.
+    """
+
+    def __init__(self, agent_pool, art_type, media, images_per_prompt=1, backends=("flux",), review=False,
+                 upscale=False, queue_size=16, upscale_tile_size=None):
+        self.agent_pool = agent_pool
+        self.art_type = art_type
+        self.media = media
+        self.images_per_prompt = images_per_prompt
+        self.backends = backends
+        self.review = review
+        self.upscale = upscale
+        # Upscale in tiles of this size spread over every A1111 server, whole images when None
+        self.upscale_tile_size = upscale_tile_size
+        self.queue_size = queue_size
+        self.run_id = int(time.time())
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _failed(item, error, backend=None):
+        """ A new item recording that item failed. item itself is left alone, the same one may be on its way
+        through other backends """
+        failed = PipelineItem(item.user_prompt, item.prompt, backend=backend or item.backend)
+        failed.image = item.image
+        failed.error = error
+        return failed
+
+    async def _stage(self, inbox, outboxes, workers, handle, backend=None):
+        """ Runs workers that take items from inbox and put whatever handle yields for each into every outbox.
+        A failing item is passed on as a failure (of backend, when the stage renders on one) so it still shows up
+        in the results """
+        async def worker():
+            while True:
+                item = await inbox.get()
+                if item is _DONE:
+                    # Hand the signal on to the next worker of this stage
+                    await inbox.put(_DONE)
+                    return
+                try:
+                    async for result in handle(item):
+                        for outbox in outboxes:
+                            await outbox.put(result)
+                except Exception as e:
+                    failed = self._failed(item, str(e), backend)
+                    for outbox in outboxes:
+                        await outbox.put(failed)
+
+        await asyncio.gather(*[worker() for _ in range(workers)])
+
+    async def _expand_prompt(self, item):
+        async with self.agent_pool.limit('llm'):
+            item.prompt = await self.agent_pool.prompt.async_generate_prompt(art_type=self.art_type,
+                                                                             media=self.media,
+                                                                             prompt=item.user_prompt)
+        yield item
+
+    async def _render_flux(self, item):
+        if item.error:
+            # The prompt failed, which is reported once per backend
+            yield self._failed(item, item.error, "flux")
+            return
+        remaining = self.images_per_prompt
+        while remaining:
+            num_outputs = min(remaining, FLUX_MAX_OUTPUTS)
+            async with self.agent_pool.limit('replicate'):
+                urls = await self.agent_pool.flux.async_generate_image(model=FLUX_MODEL, prompt=item.prompt, steps=4,
+                                                                       controlnet=False, image_url=None,
+                                                                       num_outputs=num_outputs)
+            for url in urls:
+                image_item = PipelineItem(item.user_prompt, item.prompt, backend="flux")
+                image_item.image = str(url)
+                yield image_item
+            remaining -= num_outputs
+
+    async def _render_sdxl(self, item):
+        if item.error:
+            yield self._failed(item, item.error, "sdxl")
+            return
+        # One batched request renders every image of the prompt, the model is only set up once
+        async with self.agent_pool.limit('a1111'):
+            paths = await self.agent_pool.sdxl.async_txt2img(prompt=item.prompt,
+                                                             id=f'_pipeline_{self.run_id}_{next(self._counter)}',
+                                                             hires=False, adetailer=False, controlnet=False,
+                                                             image_url=None, batch_size=self.images_per_prompt)
+        for path in paths:
+            image_item = PipelineItem(item.user_prompt, item.prompt, backend="sdxl")
+            image_item.image = path
+            yield image_item
+
+    async def _review(self, item):
+        # Sent by url the vision model needs a public one, local sdxl renders can only be reviewed inline
+        review_agent = self.agent_pool.review
+        if not item.error and (item.image.startswith("http") or review_agent.inline_max_resolution):
+            async with self.agent_pool.limit('vision'):
+                item.review = await review_agent.async_review_image(url=item.image)
+        yield item
+
+    async def _upscale(self, item):
+        if not item.error:
+            sdxl_agent = self.agent_pool.sdxl
+            image_path = item.image
+            if image_path.startswith("http"):
+                image_path = await self._download(image_path)
+            output_path = f'images/upscaled_{self.run_id}_{next(self._counter)}.png'
+            async with self.agent_pool.limit('a1111'):
+                if self.upscale_tile_size:
+                    item.upscaled = await sdxl_agent.async_upscale_tiled(image_path, tile_size=self.upscale_tile_size,
+                                                                         output_path=output_path)
+                else:
+                    item.upscaled = await sdxl_agent.async_upscale_image(image_path, output_path=output_path)
+        yield item
+
+    async def _download(self, url):
+        """ Streams a remote image to a local file a chunk at a time, returns its path """
+        path = f'images/pipeline_{self.run_id}_{next(self._counter)}.png'
+        try:
+            async with self.agent_pool.sdxl.async_client.stream('GET', url) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as file:
+                    async for chunk in response.aiter_bytes(image_transfer.READ_SIZE):
+                        await asyncio.to_thread(file.write, chunk)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return path
+
+    async def run(self, user_prompts):
+        """ Pushes every user prompt through the pipeline, returns a PipelineItem per image (or failure) """
+        limits = self.agent_pool.limits
+        renderers = {"flux": (self._render_flux, limits["replicate"]),
+                     "sdxl": (self._render_sdxl, limits["a1111"])}
+        prompt_queue = asyncio.Queue(self.queue_size)
+        render_queues = {backend: asyncio.Queue(self.queue_size) for backend in self.backends}
+        review_queue = asyncio.Queue(self.queue_size) if self.review else None
+        upscale_queue = asyncio.Queue(self.queue_size) if self.upscale else None
+        results = asyncio.Queue()
+        after_render = review_queue or upscale_queue or results
+        after_review = upscale_queue or results
+
+        async def feed():
+            for user_prompt in user_prompts:
+                await prompt_queue.put(PipelineItem(user_prompt))
+            await prompt_queue.put(_DONE)
+
+        async def expand_prompts():
+            await self._stage(prompt_queue, list(render_queues.values()), limits["llm"], self._expand_prompt)
+            for queue in render_queues.values():
+                await queue.put(_DONE)
+
+        async def render():
+            await asyncio.gather(*[self._stage(render_queues[backend], [after_render], renderers[backend][1],
+                                               renderers[backend][0], backend=backend)
+                                   for backend in self.backends])
+            await after_render.put(_DONE)
+
+        stages = [feed(), expand_prompts(), render()]
+        if review_queue:
+            async def review():
+                await self._stage(review_queue, [after_review], limits["vision"], self._review)
+                await after_review.put(_DONE)
+            stages.append(review())
+        if upscale_queue:
+            async def upscale():
+                await self._stage(upscale_queue, [results], limits["a1111"], self._upscale)
+                await results.put(_DONE)
+            stages.append(upscale())
+
+        await asyncio.gather(*stages)
+        items = []
+        while not results.empty():
+            item = results.get_nowait()
+            if item is not _DONE:
+                items.append(item)
+        return items
+
+
+async def _main(args):
+    with open(args.prompts) as file:
+        user_prompts = [line.strip() for line in file if line.strip()]
+    limits = {}
+    if args.flux_concurrency:
+        limits["replicate"] = args.flux_concurrency
+    if args.sdxl_concurrency:
+        limits["a1111"] = args.sdxl_concurrency
+    agent_pool = AgentPool(local=not args.together, limits=limits)
+    pipeline = Pipeline(agent_pool, art_type=args.art_type, media=args.media, images_per_prompt=args.images,
+                        backends=tuple(args.backend or ["flux"]), review=args.review, upscale=args.upscale,
+                        queue_size=args.queue_size, upscale_tile_size=args.upscale_tile_size)
+    start_time = time.time()
+    try:
+        items = await pipeline.run(user_prompts)
+    finally:
+        await agent_pool.aclose()
+    with open(args.output, 'w') as file:
+        for item in items:
+            file.write(json.dumps(item.to_dict()) + "\n")
+    failed = sum(1 for item in items if item.error)
+    print(f"{len(items) - failed} images, {failed} failures in {time.time() - start_time:.2f} seconds "
+          f"-> {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render a list of prompts (one per line) without the UI")
+    parser.add_argument("prompts", help="text file with one user prompt per line")
+    parser.add_argument("--art-type", default="Photograph")
+    parser.add_argument("--media", default="Digital")
+    parser.add_argument("--images", type=int, default=1, help="images per prompt on each backend")
+    parser.add_argument("--backend", action="append", choices=["flux", "sdxl"],
+                        help="may be given more than once, defaults to flux")
+    parser.add_argument("--review", action="store_true", help="review each flux image with the vision model")
+    parser.add_argument("--upscale", action="store_true", help="4x upscale each image through Automatic 1111")
+    parser.add_argument("--upscale-tile-size", type=int,
+                        help="upscale in tiles of this many pixels, spread over every Automatic 1111 server")
+    parser.add_argument("--together", action="store_true", help="generate prompts via Together instead of LM Studio")
+    parser.add_argument("--flux-concurrency", type=int)
+    parser.add_argument("--sdxl-concurrency", type=int)
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--output", default="pipeline_results.jsonl")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+# How often waiting sessions are updated
+PROGRESS_INTERVAL = 0.5
+
+
+class Progress:
+    """ What a waiting session is told on each tick """
+
+    def __init__(self, elapsed, position=None, report=None):
+        self.elapsed = elapsed
+        # Jobs ahead in the render queue, None when not queued
+        self.position = position
+        # A1111 progress report (see SDXLAgent.async_progress), None when nothing is known
+        self.report = report
+
+    @property
+    def fraction(self):
+        return self.report.get("progress", 0) if self.report else None
+
+    @property
+    def preview(self):
+        """ Data url of A1111's live preview, None if there is none """
+        image = self.report.get("current_image") if self.report else None
+        return f"data:image/png;base64,{image}" if image else None
+
+    def describe(self):
+        if self.position is not None:
+            return f"Queued, {self.position} job(s) ahead"
+        text = f"Elapsed time: {self.elapsed:.1f} seconds"
+        if self.report:
+            state = self.report.get("state") or {}
+            if state.get("sampling_steps"):
+                text += f", step {state.get('sampling_step', 0)}/{state['sampling_steps']}"
+            text += f", {self.fraction * 100:.0f}%"
+            if self.report.get("eta_relative"):
+                text += f", about {self.report['eta_relative']:.0f} seconds left"
+        return text
+
+
+class ProgressPoller:
+    """ One loop per process feeding progress to every waiting session.
+    Replaces a timer per waiting job: each tick asks every busy A1111 server for its progress once (see
+    SDXLAgent.progress_stream) and hands each watcher the elapsed time, its queue position or its render's report.
+    The loop only runs while someone is watching.
+    """
+
+    def __init__(self, sdxl_agent, render_scheduler, interval=PROGRESS_INTERVAL):
+        self.sdxl_agent = sdxl_agent
+        self.render_scheduler = render_scheduler
+        self.interval = interval
+        # watch handle -> (callback, job, start time)
+        self._watchers = {}
+        self._task = None
+
+    def watch(self, callback, job=None, start_time=None):
+        """ Calls callback(Progress) every tick until unwatch(handle). job is a RenderJob to report on, without one
+        the callback only gets the elapsed time. Returns the handle """
+        handle = object()
+        self._watchers[handle] = (callback, job, start_time or time.time())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+        return handle
+
+    def unwatch(self, handle):
+        self._watchers.pop(handle, None)
+
+    async def _loop(self):
+        stream = self.sdxl_agent.progress_stream(self.interval)
+        try:
+            async for reports in stream:
+                if not self._watchers:
+                    # Cleared before anything can await, so the next watch() starts a fresh loop
+                    self._task = None
+                    return
+                now = time.time()
+                positions = self.render_scheduler.positions()
+                for callback, job, start_time in list(self._watchers.values()):
+                    position = positions.get(job) if job is not None else None
+                    progress = Progress(now - start_time, position, reports.get(job) if job is not None else None)
+                    try:
+                        callback(progress)
+                    except Exception:
+                        # A closed page must not stop the updates of everyone else
+                        pass
+        finally:
+            await stream.aclose()
+
+    async def stop(self):
+        self._watchers.clear()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,133 @@
+import re
+from collections import namedtuple
+
+# Tokens a prompt may use: CLIP's 77 less the start and end tokens, and the T5 encoder of Flux
+CLIP_TOKEN_BUDGET = 75
+T5_TOKEN_BUDGET = 256
+
+# Words that add length but rarely change the image
+FILLERS = (r"(?:very|really|extremely|incredibly|highly|quite|rather|somewhat|truly|absolutely|just|simply|"
+           r"basically|actually|literally|that is|which is|there is|there are|in order to|as well as)")
+# A run of fillers along with the indefinite article in front of it, which may have to change (a very old -> an old)
+FILLER_PATTERN = re.compile(r"\b(?:(?-i:(a|an|A|An))\s+)?" + FILLERS + r"\s+(?:" + FILLERS + r"\s+)*",
+                            re.IGNORECASE)
+# Words that take "an"
+VOWEL_SOUND_PATTERN = re.compile(r"(?!one\b|uni|us[eu]|eu|ur[aeiou])(?:[aeiou]|hour|honest|honou?r|heir)",
+                                 re.IGNORECASE)
+# Only a lowercase article starting a clause is dropped, not the A of "vitamin A" or one inside a phrase
+ARTICLE_PATTERN = re.compile(r"((?:^|[,;.])[^\S\n]*)(?:a|an|the)[^\S\n]+", re.MULTILINE)
+# Stable Diffusion emphasis syntax, (text:1.3)
+WEIGHT_PATTERN = re.compile(r"\(([^():]*):\s*([0-9.]+)\)")
+CLAUSE_SEPARATOR = re.compile(r"(\s*[,;]\s*|(?<=\.)\s+|\s*\n\s*)")
+WORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z'-]*")
+STOP_WORDS = {"a", "an", "the", "and", "or", "of", "in", "on", "at", "to", "with", "by", "for", "from", "is",
+              "are", "its", "his", "her", "their", "as", "into", "under", "over"}
+
+Compression = namedtuple("Compression", ["prompt", "tokens", "fits"])
+
+
+def _split_clauses(prompt):
+    """ The clauses of a prompt and the separator following each ("" after the last) """
+    parts = CLAUSE_SEPARATOR.split(prompt)
+    return parts[0::2], parts[1::2] + [""]
+
+
+def _join_clauses(clauses, separators, keep=None):
+    parts = []
+    for index, (clause, separator) in enumerate(zip(clauses, separators)):
+        if clause and (keep is None or index in keep):
+            parts += [clause, separator]
+        elif "\n" in separator and parts:
+            # A dropped clause that ended a line takes its line break with it otherwise
+            parts[-1] = separator
+    return _tidy("".join(parts))
+
+
+def _tidy(prompt):
+    """ Collapses runs of spaces and stray separators, line breaks stay where they are """
+    prompt = re.sub(r"[^\S\n]+", " ", prompt)
+    prompt = re.sub(r" ?\n ?", "\n", prompt)
+    prompt = re.sub(r"\s+([,;.])", r"\1", prompt)
+    prompt = re.sub(r"([,;])(?:\s*[,;])+", r"\1", prompt)
+    return prompt.strip(" ,;\n")
+
+
+def _drop_fillers(match):
+    article = match.group(1)
+    if article is None:
+        return ""
+    agreeing = "an" if VOWEL_SOUND_PATTERN.match(match.string, match.end()) else "a"
+    return (agreeing.capitalize() if article[0] == "A" else agreeing) + " "
+
+
+def strip_fillers(prompt):
+    return _tidy(FILLER_PATTERN.sub(_drop_fillers, prompt))
+
+
+def strip_articles(prompt):
+    return _tidy(ARTICLE_PATTERN.sub(r"\1", prompt))
+
+
+def drop_repeated_modifiers(prompt):
+    """ Removes later uses of a descriptive word that is already in the prompt when it modifies something,
+    i.e. isn't the last word of its clause (soft light, soft shadows -> soft light, shadows) """
+    seen = set()
+    clauses, separators = _split_clauses(prompt)
+    shortened = []
+    for clause in clauses:
+        words = clause.split(" ")
+        kept = []
+        for position, word in enumerate(words):
+            key = word.lower().strip(".()")
+            is_last = position == len(words) - 1
+            if key in seen and not is_last and WORD_PATTERN.fullmatch(key) and key not in STOP_WORDS:
+                continue
+            if WORD_PATTERN.fullmatch(key) and key not in STOP_WORDS:
+                seen.add(key)
+            kept.append(word)
+        shortened.append(" ".join(kept))
+    return _join_clauses(shortened, separators)
+
+
+def _clause_weight(clause, position):
+    """ Explicit (text:weight) emphasis counts first, then earlier clauses outweigh later ones """
+    weights = [float(weight) for _, weight in WEIGHT_PATTERN.findall(clause)]
+    return max(weights) if weights else 1.0, -position
+
+
+class PromptCompressor:
+    """ Deterministic, local prompt shortening against a token budget.
+    Applies progressively stronger edits (fillers, repeated modifiers, articles, then the lowest weight
+    clauses) and stops as soon as the prompt fits, counting with the same tokenizer as the sequence length
+    display. Takes milliseconds, so the LLM is only needed when this can't reach the budget.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def count(self, prompt):
+        return self.tokenizer.get_sequence_length(prompt)
+
+    def compress(self, prompt, budget=T5_TOKEN_BUDGET):
+        """ Returns a Compression with the shortened prompt, its token count and whether it fits """
+        prompt = _tidy(prompt)
+        tokens = self.count(prompt)
+        for step in (strip_fillers, drop_repeated_modifiers, strip_articles):
+            if tokens <= budget:
+                return Compression(prompt, tokens, True)
+            prompt = step(prompt)
+            tokens = self.count(prompt)
+        return self._trim_clauses(prompt, tokens, budget)
+
+    def _trim_clauses(self, prompt, tokens, budget):
+        clauses, separators = _split_clauses(prompt)
+        # The first clause carries the subject and is never dropped
+        droppable = sorted(range(1, len(clauses)), key=lambda index: _clause_weight(clauses[index], index))
+        keep = set(range(len(clauses)))
+        for index in droppable:
+            if tokens <= budget:
+                break
+            keep.discard(index)
+            prompt = _join_clauses(clauses, separators, keep)
+            tokens = self.count(prompt)
+        return Compression(prompt, tokens, tokens <= budget)
@@ -0,0 +1,38 @@
+import re
+
+from prompt_compression import STOP_WORDS, T5_TOKEN_BUDGET, WORD_PATTERN
+
+# A prompt using less than this share of the budget is probably missing detail
+MIN_FILL = 0.2
+# The model talking about the prompt instead of just giving it
+CHATTER_PATTERN = re.compile(r"^\s*(?:here is|here's|sure|certainly|revised prompt|prompt:)", re.IGNORECASE)
+
+
+class PromptScorer:
+    """ Cheap local score of a generated prompt for picking the best of several candidates, higher is better.
+    Rewards using a sensible share of the token budget without going over it, and penalises repeated words and
+    answers that chat about the prompt rather than being one.
+    """
+
+    def __init__(self, tokenizer=None, budget=T5_TOKEN_BUDGET):
+        self.tokenizer = tokenizer
+        self.budget = budget
+
+    def count(self, prompt):
+        if self.tokenizer is None:
+            # Roughly what CLIP makes of English text
+            return int(len(prompt.split()) * 1.3)
+        return self.tokenizer.get_sequence_length(prompt)
+
+    def __call__(self, prompt):
+        words = [word.lower() for word in WORD_PATTERN.findall(prompt)]
+        content_words = [word for word in words if word not in STOP_WORDS]
+        if not content_words:
+            return float("-inf")
+        fill = self.count(prompt) / self.budget
+        # Going over the budget loses detail at the end, so it costs more than being short
+        score = -4 * max(0.0, fill - 1) - max(0.0, MIN_FILL - fill)
+        score -= 2 * (1 - len(set(content_words)) / len(content_words))
+        if CHATTER_PATTERN.search(prompt):
+            score -= 1
+        return score
@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import tracing
+from agent_sdxl import request_tag
+
+# Lower runs first
+PRIORITY_PREVIEW = 0
+PRIORITY_RENDER = 1
+PRIORITY_UPSCALE = 2
+# A waiting job is promoted one priority level for every this many seconds it has waited, so nothing starves
+AGING_SECONDS = 60
+
+
+class RenderJob:
+    """ A queued call to the SDXL agent. Await wait() for its result """
+
+    QUEUED, RUNNING, DONE, CANCELLED = "queued", "running", "done", "cancelled"
+
+    def __init__(self, session_id, priority, func, args, kwargs, sequence):
+        self.session_id = session_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.sequence = sequence
+        self.submitted = time.time()
+        self.state = self.QUEUED
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+
+    def wait(self):
+        return asyncio.shield(self.future)
+
+
+class RenderScheduler:
+    """ In-process job queue in front of SDXLAgent.
+    Runs one job per worker (one per A1111 server keeps every GPU busy). The next job is the one with the
+    best priority, aged by how long it has waited; between sessions at the same level the session served
+    least recently goes first, so one user queueing many renders can't starve the others.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._queued = []
+        self._running = set()
+        self._last_served = {}
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._tasks = []
+
+    def _start(self):
+        if not self._tasks:
+            self._wakeup = asyncio.Condition()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, session_id, func, *args, priority=PRIORITY_RENDER, **kwargs):
+        """ Queues await func(*args, **kwargs) on behalf of a session and returns its RenderJob """
+        self._start()
+        job = RenderJob(session_id, priority, func, args, kwargs, next(self._sequence))
+        self._queued.append(job)
+        asyncio.create_task(self._notify())
+        return job
+
+    async def _notify(self):
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    def _order_key(self, job, now, last_served):
+        aged_priority = job.priority - int((now - job.submitted) // AGING_SECONDS)
+        return aged_priority, last_served.get(job.session_id, 0), job.sequence
+
+    def _pick(self):
+        now = time.time()
+        job = min(self._queued, key=lambda queued: self._order_key(queued, now, self._last_served))
+        self._queued.remove(job)
+        self._last_served[job.session_id] = now
+        tracing.record("render.queue_wait", now - job.submitted, priority=job.priority)
+        return job
+
+    def position(self, job):
+        """ How many queued jobs will start before this one, 0 means it is next. None once it has started """
+        if job.state != RenderJob.QUEUED:
+            return None
+        return self.positions().get(job)
+
+    def positions(self):
+        """ position() of every queued job at once, as {job: position}. Callers asking about several jobs should
+        take this once rather than call position() for each """
+        now = time.time()
+        # Jobs of one session share last_served, so among themselves they always go in _order_key order. Replaying
+        # the picks only needs each session's next job, in a heap keyed as _pick would see it
+        by_session = {}
+        for job in self._queued:
+            by_session.setdefault(job.session_id, []).append(job)
+        heads = []
+        for session_id, jobs in by_session.items():
+            # Next job last
+            jobs.sort(key=lambda queued: self._order_key(queued, now, self._last_served), reverse=True)
+            heads.append((self._order_key(jobs[-1], now, self._last_served), session_id))
+        heapq.heapify(heads)
+        positions = {}
+        while heads:
+            _, session_id = heapq.heappop(heads)
+            jobs = by_session[session_id]
+            positions[jobs.pop()] = len(positions)
+            if jobs:
+                last_served = {session_id: now + len(positions)}
+                heapq.heappush(heads, (self._order_key(jobs[-1], now, last_served), session_id))
+        return positions
+
+    def queue_length(self):
+        return len(self._queued)
+
+    def cancel(self, job):
+        """ Removes a queued job or cancels a running one """
+        if job.state == RenderJob.QUEUED:
+            self._queued.remove(job)
+            job.state = RenderJob.CANCELLED
+            job.future.cancel()
+        elif job.state == RenderJob.RUNNING and job.task is not None:
+            job.task.cancel()
+
+    def cancel_session(self, session_id):
+        """ Cancels every queued and running job of a session, e.g. once its user has left """
+        for job in [job for job in self._queued + list(self._running) if job.session_id == session_id]:
+            self.cancel(job)
+
+    async def _run(self, job):
+        # The task has its own copy of the context, the tag lets progress reports be matched to the job
+        request_tag.set(job)
+        with tracing.span("render.job", priority=job.priority):
+            return await job.func(*job.args, **job.kwargs)
+
+    async def _worker(self):
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: self._queued)
+                job = self._pick()
+            job.state = RenderJob.RUNNING
+            job.task = asyncio.create_task(self._run(job))
+            self._running.add(job)
+            try:
+                result = await job.task
+            except asyncio.CancelledError:
+                job.state = RenderJob.CANCELLED
+                job.future.cancel()
+                if asyncio.current_task().cancelling():
+                    # The worker itself is being stopped
+                    raise
+            except Exception as e:
+                job.state = RenderJob.DONE
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                job.state = RenderJob.DONE
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._running.discard(job)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """ On-disk cache of LLM responses.
+    Entries are keyed by a hash of everything that goes into the request (messages, model and sampling
+    parameters), expire after ttl seconds and the least recently used are evicted beyond max_entries.
+    """
+
+    def __init__(self, path="cache/responses.sqlite3", ttl=7 * 24 * 3600, max_entries=5000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                         "(key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(**request):
+        """ Content address of a request, the arguments must be json serializable """
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key):
+        """ Returns the cached value or None if missing or expired """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if now - created > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            return value
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                             (key, value, now, now))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self._db.execute("DELETE FROM responses WHERE key IN "
+                         "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,53 @@
+import asyncio
+import uuid
+
+
+class Session:
+    """ Lightweight per browser state.
+    Agents are shared by the whole process (see agent_pool.AgentPool) so anything one user can change
+    or accumulate lives here instead. With a store (see session_store.SessionStore) the system prompt, prompts
+    and image urls are saved as they change and come back on the next visit, whichever worker serves it.
+    The saving happens on a thread, so the add and set methods are awaited.
+    """
+
+    def __init__(self, t5_system_prompt, id=None, store=None):
+        self.id = id or uuid.uuid4().hex
+        self.store = store
+        self.t5_system_prompt = t5_system_prompt
+        self.flux_image_urls = []
+        # image url -> digest of its local copy in the image store (see image_store.ImageStore), remote result
+        # urls expire but the copy stays
+        self.image_digests = {}
+        self.prompts = []
+        # agent_prompt.SharedSpeculation of the CLIP version of the current T5 prompt, held until it is released
+        self.clip_speculation = None
+
+    @classmethod
+    def load(cls, store, id, t5_system_prompt):
+        """ The saved session id, or a new one under that id. t5_system_prompt is the default system prompt """
+        session = cls(t5_system_prompt, id, store)
+        saved = store.load(id)
+        if saved is not None:
+            session.t5_system_prompt = saved.system_prompt or t5_system_prompt
+            session.prompts = saved.prompts
+            session.flux_image_urls = saved.image_urls
+            session.image_digests = saved.image_digests
+        return session
+
+    async def add_prompt(self, prompt):
+        self.prompts.append(prompt)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.add, self.id, "prompt", prompt)
+
+    async def add_image_url(self, url, digest=None):
+        """ digest is that of the image's local copy, if one was kept """
+        self.flux_image_urls.append(url)
+        if digest:
+            self.image_digests[url] = digest
+        if self.store is not None:
+            await asyncio.to_thread(self.store.add, self.id, "image_url", url, digest)
+
+    async def set_system_prompt(self, system_prompt):
+        self.t5_system_prompt = system_prompt
+        if self.store is not None:
+            await asyncio.to_thread(self.store.set_system_prompt, self.id, system_prompt)
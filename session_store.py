@@ -0,0 +1,91 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+SavedSession = namedtuple("SavedSession", ["system_prompt", "prompts", "image_urls", "image_digests"])
+
+
+class SessionStore:
+    """ On-disk session state shared by every worker process (see multiworker.py), so a session can be served by
+    any worker and survives restarts. Prompts and image urls are appended as rows rather than rewriting a list,
+    so two tabs of one session never lose each other's additions. An image url is saved with the digest of its
+    copy in the image store, remote urls expire. Sessions unused for ttl seconds are dropped.
+    """
+
+    def __init__(self, path="cache/sessions.sqlite3", ttl=90 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Other workers may hold the write lock for a moment
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # Readers don't block the writer (and vice versa) across processes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, system_prompt TEXT, updated REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS session_items "
+                         "(session_id TEXT, kind TEXT, value TEXT, created REAL, digest TEXT)")
+        if "digest" not in [row[1] for row in self._db.execute("PRAGMA table_info(session_items)")]:
+            try:
+                # Stores written before digests were kept
+                self._db.execute("ALTER TABLE session_items ADD COLUMN digest TEXT")
+            except sqlite3.OperationalError:
+                # Another worker starting at the same time added it first
+                pass
+        self._db.execute("CREATE INDEX IF NOT EXISTS session_items_session ON session_items (session_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self._evict(time.time())
+        self._db.commit()
+
+    def load(self, session_id):
+        """ Returns the SavedSession or None if there is none """
+        with self._lock:
+            row = self._db.execute("SELECT system_prompt FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            items = self._db.execute("SELECT kind, value, digest FROM session_items WHERE session_id = ? "
+                                     "ORDER BY rowid", (session_id,)).fetchall()
+        return SavedSession(row[0], [value for kind, value, _ in items if kind == "prompt"],
+                            [value for kind, value, _ in items if kind == "image_url"],
+                            {value: digest for kind, value, digest in items if kind == "image_url" and digest})
+
+    def add(self, session_id, kind, value, digest=None):
+        """ Appends a "prompt" or "image_url" to the session, an image url with the digest of its local copy """
+        now = time.time()
+        with self._lock:
+            self._touch(session_id, now)
+            self._db.execute("INSERT INTO session_items (session_id, kind, value, created, digest) "
+                             "VALUES (?, ?, ?, ?, ?)", (session_id, kind, value, now, digest))
+            self._db.commit()
+
+    def set_system_prompt(self, session_id, system_prompt):
+        now = time.time()
+        with self._lock:
+            self._touch(session_id, now)
+            self._db.execute("UPDATE sessions SET system_prompt = ? WHERE id = ?", (system_prompt, session_id))
+            self._db.commit()
+
+    def secret(self, name="storage_secret"):
+        """ A random secret made by whichever process asks first and then shared by all, e.g. for signing cookies """
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)",
+                             (name, secrets.token_urlsafe(32)))
+            self._db.commit()
+            return self._db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0]
+
+    def _touch(self, session_id, now):
+        self._db.execute("INSERT INTO sessions (id, updated) VALUES (?, ?) "
+                         "ON CONFLICT (id) DO UPDATE SET updated = excluded.updated", (session_id, now))
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM session_items WHERE session_id IN (SELECT id FROM sessions WHERE updated < ?)",
+                         (now - self.ttl,))
+        self._db.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
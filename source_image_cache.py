@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+# data is the image file as downloaded, encoded its base64 form ready to go into an A1111 request
+CachedImage = namedtuple("CachedImage", ["data", "encoded"])
+
+
+class SourceImageCache:
+    """ Bounded cache of the images SDXL renders start from (img2img init images and ControlNet inputs), keyed by
+    their url. Refining the same Flux image several times then downloads and base64 encodes it only once.
+    Recently used images are kept in memory up to max_memory_bytes, and on disk below root up to max_disk_bytes;
+    the least recently used go first when either is full.
+    """
+
+    def __init__(self, root="cache/source_images", max_memory_bytes=128 * 1024 * 1024,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        self.root = root
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+
+    @staticmethod
+    def _size(image):
+        return len(image.data) + len(image.encoded)
+
+    def _paths(self, url):
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, f"{name}.img"), os.path.join(self.root, f"{name}.b64")
+
+    def get(self, url):
+        """ Returns the CachedImage for url or None """
+        with self._lock:
+            image = self._memory.get(url)
+            if image is not None:
+                self._memory.move_to_end(url)
+                return image
+        data_path, encoded_path = self._paths(url)
+        try:
+            with open(data_path, "rb") as file:
+                data = file.read()
+            with open(encoded_path, "rb") as file:
+                encoded = file.read()
+        except FileNotFoundError:
+            return None
+        # Touched so disk eviction sees it as recently used
+        os.utime(data_path)
+        image = CachedImage(data, encoded)
+        self._remember(url, image)
+        return image
+
+    def put(self, url, data):
+        """ Caches the downloaded bytes of url along with their encoding and returns the CachedImage """
+        image = CachedImage(data, base64.b64encode(data))
+        data_path, encoded_path = self._paths(url)
+        for path, content in ((data_path, image.data), (encoded_path, image.encoded)):
+            # Write then rename so a half written file is never read back
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        self._remember(url, image)
+        self._evict_disk()
+        return image
+
+    def _remember(self, url, image):
+        size = self._size(image)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(url, None)
+            if previous is not None:
+                self._memory_bytes -= self._size(previous)
+            self._memory[url] = image
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= self._size(evicted)
+
+    def _evict_disk(self):
+        entries = {}
+        with os.scandir(self.root) as scan:
+            for entry in scan:
+                name, extension = os.path.splitext(entry.name)
+                if extension not in (".img", ".b64"):
+                    continue
+                stat = entry.stat()
+                used, size = entries.get(name, (0, 0))
+                # The .img file carries the last use time of the pair
+                entries[name] = (stat.st_mtime if extension == ".img" else used, size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for name, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_disk_bytes:
+                break
+            for extension in (".img", ".b64"):
+                try:
+                    os.remove(os.path.join(self.root, name + extension))
+                except FileNotFoundError:
+                    pass
+            total -= size
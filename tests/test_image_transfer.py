@@ -0,0 +1,131 @@
+import base64
+import io
+import json
+
+import pytest
+
+import image_transfer
+from image_transfer import Base64FieldWriter
+
+
+class MemoryFile(io.BytesIO):
+    """ A file Base64FieldWriter can write into that keeps its content after close """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.content = None
+
+    def close(self):
+        if self.content is None:
+            self.content = self.getvalue()
+        super().close()
+
+
+class Outputs:
+    def __init__(self):
+        self.files = {}
+
+    def __call__(self, index):
+        file = self.files[f"out_{index}"] = MemoryFile(f"out_{index}")
+        return file
+
+    def content(self, name):
+        return self.files[name].content
+
+
+def feed(writer, body, chunk_size):
+    for start in range(0, len(body), chunk_size):
+        writer.feed(body[start:start + chunk_size])
+    return writer.close()
+
+
+IMAGES = [bytes(range(256)) * 3, b"second image", b"x"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 100000])
+def test_array_of_images_in_any_chunking(chunk_size):
+    body = json.dumps({"parameters": {"prompt": "images"},
+                       "images": [base64.b64encode(image).decode() for image in IMAGES],
+                       "info": "{}"}).encode()
+    outputs = Outputs()
+    paths = feed(Base64FieldWriter("images", outputs), body, chunk_size)
+    assert paths == ["out_0", "out_1", "out_2"]
+    assert [outputs.content(path) for path in paths] == IMAGES
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 9, 100000])
+def test_single_image_field(chunk_size):
+    body = json.dumps({"html_info": "", "image": base64.b64encode(IMAGES[0]).decode()}).encode()
+    outputs = Outputs()
+    paths = feed(Base64FieldWriter("image", outputs), body, chunk_size)
+    assert [outputs.content(path) for path in paths] == [IMAGES[0]]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 100000])
+def test_escaped_slashes_are_unescaped(chunk_size):
+    # Some json encoders write base64's "/" as "\/"
+    image = bytes([0xff] * 30)
+    encoded = base64.b64encode(image).decode()
+    assert "/" in encoded
+    body = ('{"images": ["' + encoded.replace("/", "\\/") + '"]}').encode()
+    outputs = Outputs()
+    paths = feed(Base64FieldWriter("images", outputs), body, chunk_size)
+    assert outputs.content(paths[0]) == image
+
+
+def test_key_text_as_a_value_is_skipped():
+    body = json.dumps({"prompt": "images", "images": [base64.b64encode(b"real").decode()]}).encode()
+    outputs = Outputs()
+    paths = feed(Base64FieldWriter("images", outputs), body, 1)
+    assert [outputs.content(path) for path in paths] == [b"real"]
+
+
+def test_null_field_writes_nothing():
+    outputs = Outputs()
+    assert feed(Base64FieldWriter("image", outputs), b'{"image": null, "info": "aGVsbG8="}', 2) == []
+
+
+def test_empty_array_writes_nothing():
+    outputs = Outputs()
+    assert feed(Base64FieldWriter("images", outputs), b'{"images": [], "info": "{}"}', 3) == []
+
+
+def test_missing_field_writes_nothing():
+    outputs = Outputs()
+    assert feed(Base64FieldWriter("images", outputs), b'{"detail": "Not Found"}', 4) == []
+
+
+def test_truncated_response_raises_on_close():
+    body = json.dumps({"images": [base64.b64encode(IMAGES[0]).decode()]}).encode()
+    writer = Base64FieldWriter("images", Outputs())
+    writer.feed(body[:len(body) // 2])
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_invalid_base64_raises():
+    writer = Base64FieldWriter("images", Outputs())
+    with pytest.raises(ValueError):
+        writer.feed(b'{"images": ["ab!d"]}')
+
+
+def test_abort_returns_finished_and_partial_files():
+    first = base64.b64encode(IMAGES[0]).decode()
+    body = ('{"images": ["' + first + '", "' + first).encode()
+    outputs = Outputs()
+    writer = Base64FieldWriter("images", outputs)
+    writer.feed(body)
+    assert writer.abort() == ["out_0", "out_1"]
+    assert outputs.files["out_1"].closed
+    # Nothing is left open for close to complain about
+    assert writer.close() == ["out_0"]
+
+
+@pytest.mark.parametrize("image", [b"", b"a", b"ab", b"abc", bytes(range(256)) * 5])
+def test_json_body_streams_the_image_in(image):
+    payload = {"init_images": [image_transfer.IMAGE_PLACEHOLDER], "steps": 8}
+    chunks = [image[start:start + 7] for start in range(0, len(image), 7)]
+    body = json.loads(b"".join(image_transfer.iter_json_body(payload, chunks)))
+    assert base64.b64decode(body["init_images"][0]) == image
+    assert body["steps"] == 8
@@ -0,0 +1,203 @@
+import asyncio
+import threading
+
+import pytest
+
+import agent_prompt
+from agent_prompt import CIRCUIT_RESET_SECONDS, FAILURE_THRESHOLD, CircuitOpenError, LLMBackend, PromptAgent
+
+
+class Clock:
+    """ Stands in for time.time in agent_prompt """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(agent_prompt.time, "time", clock)
+    return clock
+
+
+def open_circuit(backend):
+    for _ in range(FAILURE_THRESHOLD):
+        backend.record_failure()
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    backend = LLMBackend("local", None, None, "model")
+    for _ in range(FAILURE_THRESHOLD - 1):
+        backend.record_failure()
+    assert backend.healthy
+    backend.record_failure()
+    assert not backend.healthy
+
+
+def test_a_success_resets_the_failure_count(clock):
+    backend = LLMBackend("local", None, None, "model")
+    for _ in range(FAILURE_THRESHOLD - 1):
+        backend.record_failure()
+    backend.record_success(0.5)
+    backend.record_failure()
+    assert backend.healthy
+
+
+def test_open_circuit_refuses_requests(clock):
+    backend = LLMBackend("local", None, None, "model")
+    open_circuit(backend)
+    with pytest.raises(CircuitOpenError):
+        with backend.attempt():
+            pytest.fail("an open circuit let a request through")
+
+
+def test_half_open_circuit_lets_one_trial_through(clock):
+    backend = LLMBackend("local", None, None, "model")
+    open_circuit(backend)
+    clock.now += CIRCUIT_RESET_SECONDS
+    assert backend.healthy
+    with backend.attempt():
+        assert backend.trial_in_flight
+        assert not backend.healthy
+        with pytest.raises(CircuitOpenError):
+            with backend.attempt():
+                pass
+    # Neither a success nor a failure was recorded, the next request is the trial
+    assert not backend.trial_in_flight
+    assert backend.healthy
+
+
+def test_successful_trial_closes_the_circuit(clock):
+    backend = LLMBackend("local", None, None, "model")
+    open_circuit(backend)
+    clock.now += CIRCUIT_RESET_SECONDS
+    with backend.attempt():
+        pass
+    backend.record_success(0.5)
+    assert backend.opened_at is None
+    # Closed, so requests are no longer one at a time
+    with backend.attempt(), backend.attempt():
+        pass
+
+
+def test_failed_trial_opens_the_circuit_again(clock):
+    backend = LLMBackend("local", None, None, "model")
+    open_circuit(backend)
+    clock.now += CIRCUIT_RESET_SECONDS
+    with pytest.raises(RuntimeError):
+        with backend.attempt():
+            raise RuntimeError("still down")
+    backend.record_failure()
+    assert not backend.healthy
+    clock.now += CIRCUIT_RESET_SECONDS - 1
+    assert not backend.healthy
+
+
+def test_only_one_thread_gets_the_trial(clock):
+    backend = LLMBackend("local", None, None, "model")
+    open_circuit(backend)
+    clock.now += CIRCUIT_RESET_SECONDS
+    admitted = []
+    refused = []
+    # The trial stays out until every other thread has tried
+    release = threading.Event()
+    start = threading.Barrier(8)
+
+    def request():
+        start.wait()
+        try:
+            with backend.attempt():
+                admitted.append(threading.current_thread())
+                release.wait(5)
+        except CircuitOpenError:
+            refused.append(threading.current_thread())
+            if len(refused) == 7:
+                release.set()
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 1
+    assert len(refused) == 7
+
+
+class Message:
+    def __init__(self, content):
+        self.content = content
+
+
+class Response:
+    def __init__(self, content):
+        self.choices = [type("Choice", (), {"message": Message(content)})()]
+        self.usage = None
+
+
+class AsyncCompletions:
+    def __init__(self, name, calls, fail=False, delay=0.05):
+        self.name = name
+        self.calls = calls
+        self.fail = fail
+        self.delay = delay
+
+    async def create(self, **kwargs):
+        self.calls.append(self.name)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(f"{self.name} is down")
+        return Response(f"answer from {self.name}")
+
+
+def fake_backend(name, calls, **kwargs):
+    client = type("Client", (), {})()
+    client.chat = type("Chat", (), {})()
+    client.chat.completions = AsyncCompletions(name, calls, **kwargs)
+    return LLMBackend(name, None, client, "model")
+
+
+def agent_with(*backends, hedge_delay=5.0):
+    agent = PromptAgent.__new__(PromptAgent)
+    agent.backends = list(backends)
+    agent.hedge_delay = hedge_delay
+    agent.slow_seconds = agent_prompt.SLOW_SECONDS
+    return agent
+
+
+def test_concurrent_requests_send_one_trial_to_a_half_open_backend(clock):
+    calls = []
+    local, together = fake_backend("local", calls), fake_backend("together", calls)
+    open_circuit(local)
+    clock.now += CIRCUIT_RESET_SECONDS
+    agent = agent_with(local, together)
+
+    async def ask():
+        return await asyncio.gather(*[agent._hedge(lambda backend: agent._async_request(backend, []))
+                                      for _ in range(3)])
+
+    answers = asyncio.run(ask())
+    assert calls.count("local") == 1
+    assert sorted(answers) == ["answer from local", "answer from together", "answer from together"]
+    assert local.opened_at is None
+
+
+def test_fails_fast_when_every_circuit_is_open(clock):
+    calls = []
+    local, together = fake_backend("local", calls), fake_backend("together", calls)
+    open_circuit(local)
+    open_circuit(together)
+    with pytest.raises(RuntimeError, match="No LLM backend is available"):
+        agent_with(local, together).ordered_backends()
+
+
+def test_failover_records_the_failure(clock):
+    calls = []
+    local, together = fake_backend("local", calls, fail=True), fake_backend("together", calls)
+    agent = agent_with(local, together)
+    answer = asyncio.run(agent._hedge(lambda backend: agent._async_request(backend, [])))
+    assert answer == "answer from together"
+    assert local.consecutive_failures == 1
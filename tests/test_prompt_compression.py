@@ -0,0 +1,85 @@
+import prompt_compression
+from prompt_compression import PromptCompressor
+
+
+class WordTokenizer:
+    """ Counts words and punctuation, close enough to CLIP for the compressor's decisions and needs no download """
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_sequence_length(self, prompt):
+        self.calls += 1
+        return len(prompt.replace(",", " , ").replace(";", " ; ").split())
+
+
+def compress(prompt, budget):
+    return PromptCompressor(WordTokenizer()).compress(prompt, budget)
+
+
+def test_a_prompt_that_fits_is_left_alone():
+    prompt = "a red fox in fresh snow, soft light"
+    compression = compress(prompt, 50)
+    assert compression == (prompt, WordTokenizer().get_sequence_length(prompt), True)
+
+
+def test_fillers_go_first():
+    compression = compress("a very old lighthouse, really dramatic storm", 6)
+    assert compression.prompt == "an old lighthouse, dramatic storm"
+    assert compression.fits
+
+
+def test_the_article_agrees_with_the_word_left_after_the_fillers():
+    assert prompt_compression.strip_fillers("An incredibly tall tower, a really unusual sky") == \
+        "A tall tower, an unusual sky"
+
+
+def test_repeated_modifiers_are_dropped():
+    assert prompt_compression.drop_repeated_modifiers("soft light, soft shadows, golden hour") == \
+        "soft light, shadows, golden hour"
+
+
+def test_a_repeated_word_that_is_a_subject_stays():
+    # "light" ends its clause the second time, it names something rather than describing it
+    assert prompt_compression.drop_repeated_modifiers("light rain, warm light") == "light rain, warm light"
+
+
+def test_articles_go_before_clauses():
+    compression = compress("the fox in the snow, an old barn", 7)
+    # Only the articles starting a clause go, the rest hold the phrase together
+    assert compression.prompt == "fox in the snow, old barn"
+    assert compression.fits
+
+
+def test_an_article_that_is_part_of_a_name_stays():
+    assert prompt_compression.strip_articles("bottle of Vitamin A, A Starry Night poster") == \
+        "bottle of Vitamin A, A Starry Night poster"
+
+
+def test_line_breaks_are_kept():
+    assert compress("a very old lighthouse\nthe storm, rain\ngulls", 5).prompt == "old lighthouse\nstorm, rain"
+
+
+def test_lowest_weight_clauses_are_dropped_and_the_subject_kept():
+    prompt = "portrait of a fisherman, (weathered hands:1.4), harbour at dawn, film grain, muted colours"
+    compression = compress(prompt, 9)
+    assert compression.prompt.startswith("portrait of a fisherman")
+    # Explicit emphasis outlives the later, unweighted clauses
+    assert "(weathered hands:1.4)" in compression.prompt
+    assert "muted colours" not in compression.prompt
+    assert compression.fits
+    assert compression.tokens <= 9
+
+
+def test_reports_when_the_budget_cannot_be_reached():
+    compression = compress("an enormous ancient oak tree standing alone, fog", 2)
+    # Only the subject clause is left and it is still too long
+    assert compression.prompt == "enormous ancient oak tree standing alone"
+    assert not compression.fits
+
+
+def test_stops_as_soon_as_it_fits():
+    tokenizer = WordTokenizer()
+    PromptCompressor(tokenizer).compress("a very old lighthouse, storm, rain, gulls, spray", 11)
+    # Counted once as given and once after the fillers went, nothing more was tried
+    assert tokenizer.calls == 2
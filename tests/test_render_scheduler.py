@@ -0,0 +1,159 @@
+import asyncio
+import random
+
+import pytest
+
+import render_scheduler
+from render_scheduler import PRIORITY_PREVIEW, PRIORITY_RENDER, PRIORITY_UPSCALE, AGING_SECONDS, RenderScheduler
+
+
+async def idle():
+    pass
+
+
+def queue(scheduler, *jobs):
+    """ Puts jobs straight in the queue without waking the workers, so _pick can be driven by hand.
+    jobs are (session id, priority, seconds waited) """
+    queued = []
+    for session_id, priority, waited in jobs:
+        job = render_scheduler.RenderJob(session_id, priority, idle, (), {}, next(scheduler._sequence))
+        job.submitted -= waited
+        scheduler._queued.append(job)
+        queued.append(job)
+    return queued
+
+
+def picking_order(scheduler):
+    order = []
+    while scheduler._queued:
+        order.append(scheduler._pick())
+    return order
+
+
+def run(coroutine):
+    return asyncio.run(coroutine())
+
+
+def test_priority_order():
+    async def check():
+        scheduler = RenderScheduler()
+        upscale, render, preview = queue(scheduler, ("a", PRIORITY_UPSCALE, 0), ("a", PRIORITY_RENDER, 0),
+                                         ("a", PRIORITY_PREVIEW, 0))
+        assert picking_order(scheduler) == [preview, render, upscale]
+    run(check)
+
+
+def test_same_priority_is_first_come_first_served():
+    async def check():
+        scheduler = RenderScheduler()
+        first, second = queue(scheduler, ("a", PRIORITY_RENDER, 0), ("a", PRIORITY_RENDER, 0))
+        assert picking_order(scheduler) == [first, second]
+    run(check)
+
+
+def test_waiting_jobs_age_past_newer_better_ones():
+    async def check():
+        scheduler = RenderScheduler()
+        preview, upscale = queue(scheduler, ("a", PRIORITY_PREVIEW, 0),
+                                 ("b", PRIORITY_UPSCALE, 3 * AGING_SECONDS + 1))
+        # Three levels of aging take the upscale past a fresh preview
+        assert picking_order(scheduler) == [upscale, preview]
+    run(check)
+
+
+def test_aging_to_the_same_level_keeps_the_queue_order():
+    async def check():
+        scheduler = RenderScheduler()
+        preview, upscale = queue(scheduler, ("a", PRIORITY_PREVIEW, 0),
+                                 ("b", PRIORITY_UPSCALE, 2 * AGING_SECONDS + 1))
+        assert picking_order(scheduler) == [preview, upscale]
+    run(check)
+
+
+def test_sessions_take_turns():
+    async def check():
+        scheduler = RenderScheduler()
+        a1, a2, a3, b1, c1 = queue(scheduler, ("a", PRIORITY_RENDER, 0), ("a", PRIORITY_RENDER, 0),
+                                   ("a", PRIORITY_RENDER, 0), ("b", PRIORITY_RENDER, 0), ("c", PRIORITY_RENDER, 0))
+        # a queued first but doesn't get to run all of its jobs before b and c run one
+        assert picking_order(scheduler)[:3] == [a1, b1, c1]
+    run(check)
+
+
+def test_position_matches_the_picking_order():
+    async def check():
+        scheduler = RenderScheduler()
+        jobs = queue(scheduler, ("a", PRIORITY_RENDER, 0), ("a", PRIORITY_RENDER, 0), ("b", PRIORITY_UPSCALE, 0),
+                     ("c", PRIORITY_PREVIEW, 0))
+        positions = {job: scheduler.position(job) for job in jobs}
+        assert [positions[job] for job in picking_order(scheduler)] == [0, 1, 2, 3]
+    run(check)
+
+
+def test_positions_match_the_picking_order_of_a_long_queue():
+    async def check():
+        scheduler = RenderScheduler()
+        scheduler._last_served["b"] = 1
+        shuffled = random.Random(7)
+        queue(scheduler, *[(shuffled.choice("abcd"), shuffled.choice([PRIORITY_PREVIEW, PRIORITY_RENDER,
+                                                                      PRIORITY_UPSCALE]),
+                            shuffled.choice([0, AGING_SECONDS + 1])) for _ in range(40)])
+        positions = scheduler.positions()
+        assert [positions[job] for job in picking_order(scheduler)] == list(range(40))
+    run(check)
+
+
+def test_jobs_run_and_return_their_result():
+    async def check():
+        scheduler = RenderScheduler()
+
+        async def double(value):
+            return value * 2
+
+        try:
+            job = scheduler.submit("a", double, 21)
+            assert await job.wait() == 42
+            assert job.state == job.DONE
+        finally:
+            await scheduler.stop()
+    run(check)
+
+
+def test_failures_reach_the_waiter():
+    async def check():
+        scheduler = RenderScheduler()
+
+        async def fail():
+            raise RuntimeError("A1111 is down")
+
+        try:
+            with pytest.raises(RuntimeError):
+                await scheduler.submit("a", fail).wait()
+        finally:
+            await scheduler.stop()
+    run(check)
+
+
+def test_cancel_session_cancels_queued_and_running_jobs_of_that_session_only():
+    async def check():
+        scheduler = RenderScheduler(workers=1)
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        try:
+            running = scheduler.submit("a", slow)
+            queued = scheduler.submit("a", slow)
+            other = scheduler.submit("b", slow)
+            await asyncio.sleep(0.05)
+            assert running.state == running.RUNNING
+            scheduler.cancel_session("a")
+            await asyncio.sleep(0.05)
+            assert running.state == queued.state == running.CANCELLED
+            # The worker moved on to the other session's job
+            assert other.state == other.RUNNING
+            with pytest.raises(asyncio.CancelledError):
+                await queued.wait()
+        finally:
+            await scheduler.stop()
+    run(check)
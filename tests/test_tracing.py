@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+import pytest
+
+from tracing import Tracer
+
+
+def metric_lines(tracer):
+    return [line for line in tracer.render_metrics().splitlines() if not line.startswith("#")]
+
+
+def value(tracer, metric):
+    """ The value of one sample line, e.g. 'promptglow_errors_total{span="llm.request"}' """
+    for line in metric_lines(tracer):
+        name, _, number = line.rpartition(" ")
+        if name == metric:
+            return float(number)
+    raise AssertionError(f"{metric} is not in the metrics")
+
+
+def test_quantiles_are_nearest_rank():
+    tracer = Tracer()
+    for duration in range(1, 101):
+        tracer.record("a1111.img2img", duration / 100)
+    assert value(tracer, 'promptglow_span_seconds{span="a1111.img2img",quantile="0.5"}') == 0.5
+    assert value(tracer, 'promptglow_span_seconds{span="a1111.img2img",quantile="0.95"}') == 0.95
+    assert value(tracer, 'promptglow_span_seconds{span="a1111.img2img",quantile="0.99"}') == 0.99
+    assert value(tracer, 'promptglow_span_seconds_count{span="a1111.img2img"}') == 100
+    assert value(tracer, 'promptglow_span_seconds_sum{span="a1111.img2img"}') == pytest.approx(50.5)
+
+
+def test_a_single_sample_is_every_quantile():
+    tracer = Tracer()
+    tracer.record("review", 2.0)
+    for quantile in ("0.5", "0.95", "0.99"):
+        assert value(tracer, f'promptglow_span_seconds{{span="review",quantile="{quantile}"}}') == 2.0
+
+
+def test_errors_and_cancellations_are_counted_but_not_timed():
+    tracer = Tracer()
+    tracer.record("llm.request", 1.0)
+    tracer.record("llm.request", 60.0, status="error")
+    tracer.record("llm.request", 30.0, status="cancelled")
+    assert value(tracer, 'promptglow_span_seconds{span="llm.request",quantile="0.99"}') == 1.0
+    assert value(tracer, 'promptglow_span_seconds_sum{span="llm.request"}') == 1.0
+    assert value(tracer, 'promptglow_span_seconds_count{span="llm.request"}') == 1
+    assert value(tracer, 'promptglow_calls_total{span="llm.request"}') == 3
+    assert value(tracer, 'promptglow_errors_total{span="llm.request"}') == 1
+    assert value(tracer, 'promptglow_cancelled_total{span="llm.request"}') == 1
+
+
+def test_span_status_follows_how_the_block_ended():
+    tracer = Tracer()
+    with tracer.span("flux"):
+        pass
+    with pytest.raises(ValueError):
+        with tracer.span("flux"):
+            raise ValueError("bad input")
+
+    async def cancelled():
+        with tracer.span("flux"):
+            await asyncio.sleep(10)
+
+    async def cancel():
+        task = asyncio.ensure_future(cancelled())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert value(tracer, 'promptglow_calls_total{span="flux"}') == 3
+    assert value(tracer, 'promptglow_errors_total{span="flux"}') == 1
+    assert value(tracer, 'promptglow_cancelled_total{span="flux"}') == 1
+    assert value(tracer, 'promptglow_span_seconds_count{span="flux"}') == 1
+
+
+def test_counted_attributes_are_summed():
+    tracer = Tracer()
+    tracer.record("llm.complete", 0.1, tokens=120, payload_bytes=400)
+    tracer.record("llm.complete", 0.1, tokens=80)
+    assert value(tracer, 'promptglow_tokens_total{span="llm.complete"}') == 200
+    assert value(tracer, 'promptglow_payload_bytes_total{span="llm.complete"}') == 400
+
+
+def test_metrics_are_in_the_prometheus_text_format():
+    tracer = Tracer()
+    tracer.record("b", 0.2)
+    tracer.record("a", 0.1)
+    text = tracer.render_metrics()
+    assert text.endswith("\n")
+    assert "# TYPE promptglow_span_seconds summary" in text
+    assert "# TYPE promptglow_cancelled_total counter" in text
+    # Spans are listed by name
+    lines = metric_lines(tracer)
+    assert lines.index('promptglow_calls_total{span="a"} 1') < lines.index('promptglow_calls_total{span="b"} 1')
+    for line in lines:
+        name, _, number = line.rpartition(" ")
+        float(number)
+        assert name.startswith("promptglow_")
+
+
+def test_traced_functions_and_annotations():
+    tracer = Tracer()
+
+    @tracer.traced("tokenizer.count", annotate=lambda count: {"tokens": count})
+    def count(prompt):
+        return len(prompt.split())
+
+    @tracer.traced("a1111.txt2img")
+    async def render():
+        return ["output.png"]
+
+    assert count("a fox in snow") == 4
+    assert asyncio.run(render()) == ["output.png"]
+    assert value(tracer, 'promptglow_tokens_total{span="tokenizer.count"}') == 4
+    assert value(tracer, 'promptglow_calls_total{span="a1111.txt2img"}') == 1
+
+
+def test_spans_are_written_to_jsonl(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(str(path))
+    tracer.record("render.queue_wait", 1.5, priority=1)
+    tracer.record("llm.request", 2.0, status="cancelled", backend="local")
+    tracer.close()
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(span["name"], span["status"], span["duration"]) for span in spans] == [
+        ("render.queue_wait", "ok", 1.5), ("llm.request", "cancelled", 2.0)]
+    assert spans[0]["priority"] == 1 and spans[1]["backend"] == "local"
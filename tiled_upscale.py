@@ -0,0 +1,74 @@
+import io
+
+from PIL import Image, ImageChops
+
+DEFAULT_TILE_SIZE = 512
+DEFAULT_OVERLAP = 64
+
+
+def _starts(length, tile_size, overlap):
+    """ Offsets of the tiles along one side, the last tile is pulled back so it ends on the edge """
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size + 1, step))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def tile_boxes(width, height, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    """ (left, top, right, bottom) of each tile, row by row. Neighbouring tiles share at least overlap pixels """
+    if overlap >= tile_size:
+        raise ValueError("overlap must be smaller than tile_size")
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in _starts(height, tile_size, overlap)
+            for left in _starts(width, tile_size, overlap)]
+
+
+def encode_tile(image, box):
+    """ PNG bytes of one tile of image """
+    buffer = io.BytesIO()
+    image.crop(box).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _ramp(length, size, horizontal):
+    """ Mask rising from 0 to 255 across the first length pixels, 255 after """
+    # linear_gradient runs from black at the top to white at the bottom
+    ramp = Image.linear_gradient("L")
+    if horizontal:
+        ramp = ramp.transpose(Image.Transpose.TRANSPOSE)
+    mask = Image.new("L", size, 255)
+    if length > 0:
+        if horizontal:
+            mask.paste(ramp.resize((length, size[1])), (0, 0))
+        else:
+            mask.paste(ramp.resize((size[0], length)), (0, 0))
+    return mask
+
+
+def stitch(size, scale, boxes, tile_paths):
+    """ Joins the upscaled tiles (in the order of boxes) into one image of size * scale.
+    Tiles are laid left to right, top to bottom, each fading in across the pixels it shares with the tiles to its
+    left and above, so the seams between tiles are blended rather than cut """
+    result = Image.new("RGB", (size[0] * scale, size[1] * scale))
+    previous_right = {}
+    previous_bottom = {}
+    for box, tile_path in zip(boxes, tile_paths):
+        left, top, right, bottom = box
+        target = (left * scale, top * scale, right * scale, bottom * scale)
+        target_size = (target[2] - target[0], target[3] - target[1])
+        with Image.open(tile_path) as upscaled:
+            tile = upscaled.convert("RGB")
+        if tile.size != target_size:
+            tile = tile.resize(target_size, Image.Resampling.LANCZOS)
+        # How far this tile reaches back into the tile to its left / the row above
+        overlap_left = max(0, previous_right.get(top, left) - left) * scale
+        overlap_top = max(0, previous_bottom.get(left, top) - top) * scale
+        mask = ImageChops.multiply(_ramp(overlap_left, target_size, horizontal=True),
+                                   _ramp(overlap_top, target_size, horizontal=False))
+        result.paste(tile, target[:2], mask)
+        previous_right[top] = right
+        previous_bottom[left] = bottom
+    return result
@@ -1,14 +1,137 @@
-from transformers import CLIPTokenizer
+import asyncio
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-# Load the tokenizer used by the Stable Diffusion model
-tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
+import tracing
+
+# The tokenizer used by the Stable Diffusion model
+CLIP_MODEL = "openai/clip-vit-large-patch14"
+
+# CLIP never merges tokens across whitespace, so a prompt can be cut into chunks at any whitespace and the
+# token counts of the chunks summed. Cutting after punctuation and newlines keeps chunks stable while typing
+CHUNK_PATTERN = re.compile(r'(?<=[.,;:!?\n])\s+')
+
+TokenCount = namedtuple("TokenCount", ["count", "seconds"])
+
+_clip_tokenizer = None
+_clip_tokenizer_lock = threading.Lock()
+
+
+def get_clip_tokenizer():
+    """ Loads the (fast, rust backed) CLIP tokenizer the first time it is needed.
+    transformers is imported here rather than at module level so importing this module stays cheap """
+    global _clip_tokenizer
+    if _clip_tokenizer is None:
+        with _clip_tokenizer_lock:
+            if _clip_tokenizer is None:
+                from transformers import CLIPTokenizerFast
+                _clip_tokenizer = CLIPTokenizerFast.from_pretrained(CLIP_MODEL)
+    return _clip_tokenizer
+
+
+def preload():
+    """ Loads the tokenizer on a background thread so the first keystroke doesn't pay for it """
+    thread = threading.Thread(target=get_clip_tokenizer, name="clip-tokenizer-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+@functools.lru_cache(maxsize=1024)
+def count_tokens(text):
+    """ Memoized token count of a whole piece of text """
+    return len(get_clip_tokenizer().tokenize(text))
+
+
+class ChunkCountCache:
+    """ LRU memo of token counts for prompt chunks """
+
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chunk):
+        with self._lock:
+            count = self._counts.get(chunk)
+            if count is not None:
+                self._counts.move_to_end(chunk)
+            return count
+
+    def put(self, chunk, count):
+        with self._lock:
+            self._counts[chunk] = count
+            self._counts.move_to_end(chunk)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+
+
+_chunk_counts = ChunkCountCache()
+
+
+def count_tokens_incremental(text):
+    """ Token count of text that only tokenizes the chunks not seen before.
+    While a user types only the edited chunk is new, so the cost stays flat however long the prompt gets """
+    chunks = [chunk for chunk in CHUNK_PATTERN.split(text) if chunk]
+    counts = {chunk: _chunk_counts.get(chunk) for chunk in chunks}
+    misses = [chunk for chunk, count in counts.items() if count is None]
+    if misses:
+        # All the new chunks go to the rust tokenizer in a single batch call
+        input_ids = get_clip_tokenizer()(misses, add_special_tokens=False)["input_ids"]
+        for chunk, ids in zip(misses, input_ids):
+            counts[chunk] = len(ids)
+            _chunk_counts.put(chunk, len(ids))
+    return sum(counts[chunk] for chunk in chunks)
 
 
 class Tokenizer:
-    def __init__(self):
+    def __init__(self, incremental=True):
         self.name = "Tokenizer"
+        self.incremental = incremental
+
+    def preload(self):
+        return preload()
 
     def get_sequence_length(self, prompt):
-        tokens = tokenizer.tokenize(prompt)
-        return len(tokens)
+        if not prompt:
+            return 0
+        with tracing.span("tokenizer.count", payload_bytes=len(prompt)) as span:
+            count = count_tokens_incremental(prompt) if self.incremental else count_tokens(prompt)
+            span.set(tokens=count)
+            return count
+
+
+class SequenceLengthCounter:
+    """ Debounced, coalescing token counter for one text field.
+    Counting happens on a small thread pool shared by all sessions so the event loop is never blocked.
+    A call that is overtaken by newer text before its count is ready returns None instead of a stale count
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="token-count")
+
+    def __init__(self, tokenizer, delay=0.15):
+        self.tokenizer = tokenizer
+        self.delay = delay
+        self._generation = 0
+
+    def _is_stale(self, generation):
+        return generation != self._generation
 
+    async def count(self, text):
+        """ Returns a TokenCount of text with the time tokenization took, or None if newer text arrived """
+        self._generation += 1
+        generation = self._generation
+        # Wait for typing to pause, anything typed meanwhile supersedes this request
+        await asyncio.sleep(self.delay)
+        if self._is_stale(generation):
+            return None
+        start = time.perf_counter()
+        count = await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                 self.tokenizer.get_sequence_length, text)
+        seconds = time.perf_counter() - start
+        if self._is_stale(generation):
+            return None
+        return TokenCount(count, seconds)
@@ -0,0 +1,178 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Durations kept per span name for the percentiles, the oldest are dropped beyond this
+SAMPLES_PER_SPAN = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+# Attributes that are added up into counters on /metrics
+COUNTED_ATTRIBUTES = ("payload_bytes", "tokens")
+
+
+class Span:
+    """ One timed call. Attributes (backend, payload_bytes, tokens, cached...) can be added while it runs """
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+
+class SpanStats:
+    def __init__(self):
+        self.durations = deque(maxlen=SAMPLES_PER_SPAN)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        # Lost hedged races, cancelled renders... their durations say nothing about how long the call takes
+        self.cancelled = 0
+        self.counters = dict.fromkeys(COUNTED_ATTRIBUTES, 0)
+
+
+class Tracer:
+    """ Records how long every traced call takes (see span) and how it ended.
+    Keeps recent durations of successful calls per span name for p50/p95/p99, totals of counts, errors,
+    cancellations, payload bytes and tokens for the Prometheus style /metrics page, and optionally appends each
+    finished span to a JSONL file.
+    """
+
+    def __init__(self, jsonl_path=None):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._file = None
+        if jsonl_path:
+            self.configure(jsonl_path)
+
+    def configure(self, jsonl_path=None):
+        """ Starts (or with None stops) writing spans to jsonl_path """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(jsonl_path, "a", buffering=1) if jsonl_path else None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """ Times the block. Exceptions mark the span as an error (cancellation as cancelled) and are re-raised """
+        span = Span(name, attributes)
+        try:
+            yield span
+        except (asyncio.CancelledError, GeneratorExit):
+            span.status = "cancelled"
+            raise
+        except BaseException as e:
+            span.status = "error"
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.duration = span.elapsed()
+            self.finish(span)
+
+    def record(self, name, duration, status="ok", **attributes):
+        """ Adds a span measured elsewhere, e.g. the time a job spent queued """
+        span = Span(name, attributes)
+        span.duration = duration
+        span.status = status
+        self.finish(span)
+
+    def finish(self, span):
+        with self._lock:
+            stats = self._stats.get(span.name)
+            if stats is None:
+                stats = self._stats[span.name] = SpanStats()
+            stats.count += 1
+            if span.status == "error":
+                stats.errors += 1
+            elif span.status == "cancelled":
+                stats.cancelled += 1
+            else:
+                stats.durations.append(span.duration)
+                stats.total += span.duration
+            for attribute in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)):
+                    stats.counters[attribute] += value
+            if self._file is not None:
+                self._file.write(json.dumps({"name": span.name, "start": span.start, "duration": span.duration,
+                                             "status": span.status, **span.attributes}, default=str) + "\n")
+
+    def traced(self, name, annotate=None):
+        """ Decorator tracing every call of a function or coroutine function.
+        annotate(result) may return attributes to add to the span """
+        def decorate(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name) as span:
+                        result = await func(*args, **kwargs)
+                        if annotate is not None:
+                            span.set(**annotate(result))
+                        return result
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name) as span:
+                    result = func(*args, **kwargs)
+                    if annotate is not None:
+                        span.set(**annotate(result))
+                    return result
+            return wrapper
+        return decorate
+
+    @staticmethod
+    def _quantile(ordered, quantile):
+        # Nearest rank
+        return ordered[min(len(ordered) - 1, max(0, int(round(quantile * len(ordered))) - 1))]
+
+    def render_metrics(self, prefix="promptglow"):
+        """ The metrics in the Prometheus text exposition format """
+        with self._lock:
+            snapshot = {name: (sorted(stats.durations), stats.count, stats.total, stats.errors, stats.cancelled,
+                               dict(stats.counters))
+                        for name, stats in self._stats.items()}
+        lines = [f"# HELP {prefix}_span_seconds Duration of successful traced calls",
+                 f"# TYPE {prefix}_span_seconds summary"]
+        for name, (ordered, count, total, errors, cancelled, counters) in sorted(snapshot.items()):
+            for quantile in QUANTILES:
+                if ordered:
+                    lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{quantile}"}} '
+                                 f'{self._quantile(ordered, quantile):.6f}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {count - errors - cancelled}')
+        for metric, help_text, index in (("calls_total", "Traced calls, including failures", 1),
+                                         ("errors_total", "Traced calls that raised", 3),
+                                         ("cancelled_total", "Traced calls cancelled before they finished", 4)):
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for name, values in sorted(snapshot.items()):
+                lines.append(f'{prefix}_{metric}{{span="{name}"}} {values[index]}')
+        for attribute in COUNTED_ATTRIBUTES:
+            lines.append(f"# HELP {prefix}_{attribute}_total Sum of {attribute} over traced calls")
+            lines.append(f"# TYPE {prefix}_{attribute}_total counter")
+            for name, values in sorted(snapshot.items()):
+                if values[5][attribute]:
+                    lines.append(f'{prefix}_{attribute}_total{{span="{name}"}} {values[5][attribute]}')
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self.configure(None)
+
+
+# Shared by every agent in the process
+tracer = Tracer()
+span = tracer.span
+record = tracer.record
+traced = tracer.traced